@@ -0,0 +1,195 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.join(BENCHMARKS_PATH, "..")
+SCRIPT_PATH = os.path.join(REPO_PATH, "gibkey-config.py")
+BASELINE_PATH = os.path.join(BENCHMARKS_PATH, "baseline.json")
+MACRO_REPEATS = 3
+# Smallest change that counts as a regression, on top of the threshold. Short runs vary by more than 20% between runs on their own.
+NOISE_FLOORS = {
+    "wall_time": {"micro": 0.000001, "macro": 0.0005},
+    "peak_bytes": {"micro": 1024, "macro": 16384},
+}
+
+sys.path.insert(0, REPO_PATH)  # For the gibkey package next to it
+import reference
+from gibkey import packets, session, frames, profiles
+
+# Load gibkey-config.py as a module, with the simulated keyboard as its backend
+def load_gibkey():
+    os.environ["GIBKEY_BACKEND"] = "fake"
+    spec = importlib.util.spec_from_file_location("gibkey_config", SCRIPT_PATH)
+    gibkey = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gibkey)
+    # Macro runs measure the program's own work, not the pauses the real keyboard needs between packets
+    session.PACING_DEFAULT_GAP = 0.0
+    return gibkey
+
+# Get a per-key color table covering every key
+def get_full_key_color():
+    key_color = {}
+    for index, key in enumerate(packets.KEY_CODES_SORTED):
+        key_color[key] = f"{(index * 0x020406) % 0x1000000:06x}"
+    return key_color
+
+# Get a key map with a mix of regular and FN layer remaps
+def get_key_map():
+    return {"a": "up", "b": "escape", "x": "u", "capslock": "lctrl", "pageup_fn": "home", "1_fn": "f1", "p_fn": "function_toggle_rgb"}
+
+# Run gibkey-config.py's CLI against a fresh simulated keyboard, without a daemon or any pacing
+def run_cli(gibkey, args):
+    from gibkey.device import reset_fake_devices
+    session.default_session = None
+    reset_fake_devices()
+    sys.argv = ["gibkey-config.py", "--backend", "fake", "--no-daemon", "--min-gap", "0", "-s"] + args
+    gibkey.run_program()
+
+# Get all scenarios, as (name, kind, function) tuples
+def get_scenarios(gibkey, temp_path):
+    key_color = get_full_key_color()
+    sparse_key_color = {"all": "102030", "escape": "ff0000", "enter": "00ff00"}
+    key_map = get_key_map()
+    frame = frames.key_color_to_frame(key_color)
+    config_path = os.path.join(temp_path, "config.json")
+    profiles.save_config("custom", 50, "default", 0, 3, key_map, key_color, config_path)
+    compiled_path = os.path.join(temp_path, "config.g68bin")
+    profiles.compile_profile(config_path, compiled_path)
+
+    return [
+        ("reference_pattern_packet", "micro", lambda: reference.encode_reference_packets([reference.generate_pattern_packet(6, 50, 3, 0, "ff00aa")])),
+        ("reference_key_rgb_packets", "micro", lambda: reference.encode_reference_packets(reference.generate_key_rgb_packets(key_color))),
+        ("reference_key_rgb_sparse", "micro", lambda: reference.encode_reference_packets(reference.generate_key_rgb_packets(sparse_key_color))),
+        ("reference_key_map_packets", "micro", lambda: reference.encode_reference_packets(reference.generate_key_map_packets(key_map))),
+        ("encode_pattern_packet", "micro", lambda: packets.encode_pattern_packet(6, 50, 3, 0, "ff00aa")),
+        ("generate_pattern_packet", "micro", lambda: packets.generate_pattern_packet(6, 50, 3, 0, "ff00aa")),
+        ("encode_key_rgb_packets", "micro", lambda: packets.encode_key_rgb_packets(key_color)),
+        ("encode_key_rgb_sparse", "micro", lambda: packets.encode_key_rgb_packets(sparse_key_color)),
+        ("generate_key_rgb_packets", "micro", lambda: packets.generate_key_rgb_packets(key_color)),
+        ("encode_key_map_packets", "micro", lambda: packets.encode_key_map_packets(key_map)),
+        ("generate_key_map_packets", "micro", lambda: packets.generate_key_map_packets(key_map)),
+        ("encode_frame_packets", "micro", lambda: frames.encode_frame_packets(frame)),
+        ("effect_wave", "micro", lambda: frames.effect_wave("ff0000", 0.5)),
+        ("effect_ripple", "micro", lambda: frames.effect_ripple("g", "00ff00", 0.5)),
+        ("load_config", "micro", lambda: profiles.load_config(None, None, None, None, None, {}, {}, config_path)),
+        ("save_config", "micro", lambda: profiles.save_config("custom", 50, "default", 0, 3, key_map, key_color, config_path)),
+        ("cli_pattern", "macro", lambda: run_cli(gibkey, ["-p", "wave", "-b", "80"])),
+        ("cli_key_map", "macro", lambda: run_cli(gibkey, ["-km"] + [f"{key}={value}" for key, value in key_map.items()] + ["-p", "static"])),
+        ("cli_key_color", "macro", lambda: run_cli(gibkey, ["-kc"] + [f"{key}={value}" for key, value in key_color.items()])),
+        ("cli_config_input", "macro", lambda: run_cli(gibkey, ["-i", config_path, "-kc", "a=ffffff"])),
+        ("cli_compiled_input", "macro", lambda: run_cli(gibkey, ["-i", compiled_path])),
+    ]
+
+# Measure a scenario's wall time (seconds per call) and its memory use under tracemalloc
+def measure(kind, function):
+    if kind == "micro":
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        wall_time = min(timer.repeat(5, number)) / number
+    else:
+        timings = []
+        for repeat in range(MACRO_REPEATS):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        wall_time = min(timings)
+
+    # Run once more with allocation tracing on
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    function()
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # Count the memory blocks the run allocated and still holds afterwards, e.g. caches it filled
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+
+    return {"kind": kind, "wall_time": wall_time, "peak_bytes": peak, "retained_blocks": retained_blocks}
+
+# Run the selected scenarios
+def run_benchmarks(name_filter = None):
+    gibkey = load_gibkey()
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_path:
+        for name, kind, function in get_scenarios(gibkey, temp_path):
+            if name_filter != None and name_filter not in name:
+                continue
+            results[name] = measure(kind, function)
+            print_result(name, results[name])
+    return results
+
+# Print a single result row
+def print_result(name, result, baseline = None):
+    wall_time = result["wall_time"]
+    unit, scale = ("ms", 1000) if wall_time >= 0.001 else ("us", 1000000)
+    row = f"{name:<26}{result['kind']:<7}{wall_time * scale:>10.2f} {unit}{result['peak_bytes'] / 1024:>10.1f} KiB{result['retained_blocks']:>8} kept"
+    if baseline != None:
+        row += f"{(wall_time / baseline['wall_time'] - 1) * 100:>+9.1f}%"
+    print(row)
+
+# Compare results to the baseline. A metric regressed if it grew beyond both the threshold and its noise floor. Returns the names of the regressed metrics.
+def compare_results(results, baseline, threshold):
+    regressions = []
+    print()
+    print("Compared to baseline:")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        print_result(name, result, baseline[name])
+        for metric in ("wall_time", "peak_bytes"):
+            limit = max(baseline[name][metric] * (1 + threshold), baseline[name][metric] + NOISE_FLOORS[metric][result["kind"]])
+            if baseline[name][metric] > 0 and result[metric] > limit:
+                regressions.append(f"{name}.{metric}")
+    return regressions
+
+# Run the benchmarks
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gibkey-config.py against a simulated keyboard")
+    parser.add_argument(
+        "-f", "--filter", type=str, metavar="<name>", help="Only run scenarios whose name contains this."
+    )
+    parser.add_argument(
+        "-r", "--results", type=str, metavar="<filepath>", default=BASELINE_PATH, help="Baseline results file (default benchmarks/baseline.json, not tracked by git)."
+    )
+    parser.add_argument(
+        "--save", action='store_true', help="Store the results as the new baseline."
+    )
+    parser.add_argument(
+        "--compare", action='store_true', help="Fail if a metric regressed beyond the threshold."
+    )
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=0.2, metavar="<ratio>", help="Allowed regression before failing (default 0.2, i.e. 20%%)."
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.filter)
+
+    if args.compare:
+        if not os.path.isfile(args.results):
+            print(f"No baseline at {args.results}, run with --save first to store one for this machine.")
+            sys.exit(1)
+        with open(args.results, "r") as input_file:
+            baseline = json.load(input_file)
+        regressions = compare_results(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print(f"Regressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+    if args.save:
+        baseline = {}
+        if args.filter != None and os.path.isfile(args.results):
+            with open(args.results, "r") as input_file:
+                baseline = json.load(input_file)
+        baseline.update(results)
+        with open(args.results, "w") as json_file:
+            json.dump(baseline, json_file, indent=2)
+
+if __name__ == "__main__":
+    main()
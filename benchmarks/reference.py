@@ -0,0 +1,113 @@
+# The original hex string encoders, from before gibkey.packets. Kept as the reference workload the benchmarks are measured against.
+from gibkey.packets import KEY_CODES_SORTED, DEFAULT_FN_KEYS
+
+# Generate packet verification
+def generate_verification(packet_data):
+    verification = 0x00
+    packet_bytes = bytearray.fromhex(packet_data)
+    for byte in packet_bytes:
+        verification = (verification + byte)
+    verification = f"{(verification % 0x100):02x}"
+
+    return verification
+
+# Split the string into different packets
+def split_data_into_packets(data, header):
+    packets = []
+    current_data_length = 0
+
+    # Split data into parts
+    parts = [data[i:i + 112] for i in range(0, len(data), 112)]
+    if len(parts[-1]) < 112:
+        parts[-1] = parts[-1].ljust(112, '0')  # Pad with '0' if less than 112
+
+    # Generate the packets using the header, signature, size and data parts
+    for part in parts:
+        first_index_byte = int(current_data_length/0x100)
+        second_index_byte = (current_data_length % 0x100)
+        packet_data = f"38{second_index_byte:02x}{first_index_byte:02x}00{part}"
+
+        verification = generate_verification(packet_data)
+        packet = f"{header}{verification}{packet_data}"
+        packets.append(packet)
+        current_data_length = current_data_length + 0x38
+
+    return packets
+
+# Generate the pattern packet
+def generate_pattern_packet(pattern_int, brightness_int, speed_int, direction_val, color):
+    brightness = f"{brightness_int:02x}"
+    pattern = f"{pattern_int:02x}"
+
+    # Add up the RGB values
+    use_default_color = f"{int(color == 'default'):02x}"
+    if (color == "default"):
+        color = "ffffff"
+
+    if (len(color) != 6):
+        raise ValueError("Color value is invalid")
+
+    # Set direction value
+    if direction_val == "normal":
+        direction_val = 0
+    elif direction_val == "reverse":
+        direction_val = 1
+    direction = f"{direction_val:02x}"
+
+    # Set speed value
+    speed = f"{speed_int:02x}"
+
+    # Create the packet data
+    packet_data = f"2000000002aa{pattern}{brightness}{speed}{direction}{use_default_color}00{color}0000ff00000400000100000000ffffffffffffffff000000000000000000000000000000000000000000000000"
+
+    verification = generate_verification(packet_data)
+    return f"550600{verification}{packet_data}"
+
+# Generate the packets for indivual key RGB
+def generate_key_rgb_packets(key_color):
+    # Create hex string with RGB values for each key
+    data = ""
+    for index, key in enumerate(KEY_CODES_SORTED):
+        color = "000000"
+        if key in key_color:
+            color = key_color[key]
+        elif 'all' in key_color:
+            color = key_color['all']
+        data += color
+
+    return split_data_into_packets(data, "550b00")
+
+# Generate the packets for indivual key remaps
+def generate_key_map_packets(key_map):
+    # Create hex string with keymap values for each key
+    data = ""
+    for index, key in enumerate(KEY_CODES_SORTED):
+        data += "1000"
+        mapped_key = key
+
+        # Ignore functions
+        if "function" in key:
+            mapped_key = "unknown1"
+
+        if "default" not in key_map and key in key_map:
+            mapped_key = key_map[key] # Set remap value
+        data += f"{KEY_CODES_SORTED[mapped_key]:02X}"
+
+        divider = "1000"
+
+        # Apply default FN layer values
+        mapped_key = DEFAULT_FN_KEYS.get(key, key)
+        if "function" in mapped_key:
+            divider = ""
+
+        # Set FN layer value
+        if "default" not in key_map and f"{key}_fn" in key_map:
+            mapped_key = key_map[f"{key}_fn"]
+            divider = "1000"
+        data += divider + f"{KEY_CODES_SORTED[mapped_key]:02X}"
+
+    return split_data_into_packets(data, "550900")
+
+# Encode packets the way the original set_* functions did, converting each hex packet to bytes before sending
+def encode_reference_packets(packets):
+    return [bytes.fromhex(packet) for packet in packets]
@@ -1,161 +1,54 @@
-import usb.core
-import usb.util
 import time
+startup_start = time.perf_counter()
 import argparse
 import json
+import os
+import threading
+import logging
+
+from gibkey import settings
+from gibkey.packets import RGB_PATTERNS, KEY_CODES_SORTED, USABLE_KEYS, PATTERN_HEADER, KEY_RGB_HEADER, encode_pattern_packet, encode_key_rgb_packets, get_default_fn_id
+from gibkey.layout import KEY_LABEL_IDS, KEYBOARD_LAYOUT, KEY_WIDTH, SPECIAL_KEY_WIDTHS, get_key_id
+from gibkey.session import (
+    PACKET_TRACE_LENGTH, UploadStats, get_session, find_devices, setup_device, pace, retry_policy, get_packet_phase,
+    set_packet_trace_length, dump_packet_trace, send_packets,
+)
+from gibkey.upload import (
+    set_pattern, get_config_packet_groups, plan_upload, count_packets_to_send, estimate_plan_time, run_plan, apply_config,
+    get_device_label, select_devices, upload_to_devices,
+)
+from gibkey.profiles import load_config, save_config, compile_profiles, is_compiled_profile, read_compiled_profile, apply_compiled_profile
+from gibkey.streaming import stream_frames, read_stream_frames
+from gibkey.daemon import run_daemon, send_daemon_command, run_batch
 
-RGB_PATTERNS = {
-    'custom': 0,
-    'runner_light': 1,
-    'static': 3,
-    'breathe': 4,
-    'flower': 5,
-    'wave': 6,
-    'wave_vertical': 7,
-    'bubbler': 8,
-    'wave_light': 9,
-    'vortex': 10,
-    'wave_bar': 22,
-    'sea_wave': 12,
-    'ripple': 13,
-    'star': 20,
-    'single': 15,
-    'cell': 16
-}
-
-KEY_CODES_SORTED = {
-    'escape': 0x29,
-    'tilde': 0x35,
-    'tab': 0x2B,
-    'capslock': 0x39,
-    'lshift': 0xE1,
-    'lctrl': 0xE0,
-    'f1': 0x3A,
-    '1': 0x1E,
-    'q': 0x14,
-    'a': 0x04,
-    'z': 0x1D,
-    'lwin': 0xE3,
-    'f2': 0x3B,
-    '2': 0x1F,
-    'w': 0x1A,
-    's': 0x16,
-    'x': 0x1B,
-    'lalt': 0xE2,
-    'f3': 0x3C,
-    '3': 0x20,
-    'e': 0x08,
-    'd': 0x07,
-    'c': 0x06,
-    'unknown1': 0x00,
-    'f4': 0x3D,
-    '4': 0x21,
-    'r': 0x15,
-    'f': 0x09,
-    'v': 0x19,
-    'unknown2': 0x00,
-    'f5': 0x3E,
-    '5': 0x22,
-    't': 0x17,
-    'g': 0x0A,
-    'b': 0x05,
-    'space': 0x2C,
-    'f6': 0x3F,
-    '6': 0x23,
-    'y': 0x1C,
-    'h': 0x0B,
-    'n': 0x11,
-    'unknown3': 0x00,
-    'f7': 0x40,
-    '7': 0x24,
-    'u': 0x18,
-    'j': 0x0D,
-    'm': 0x10,
-    'unknown4': 0x00,
-    'f8': 0x41,
-    '8': 0x25,
-    'i': 0x0C,
-    'k': 0x0E,
-    'comma': 0x36,
-    'unknown5': 0x00,
-    'f9': 0x42,
-    '9': 0x26,
-    'o': 0x12,
-    'l': 0x0F,
-    'period': 0x37,
-    'unknown6': 0x00,
-    'f10': 0x43,
-    '0': 0x27,
-    'p': 0x13,
-    'semicolon': 0x33,
-    'slash': 0x38,
-    'ralt': 0xE6,
-    'f11': 0x44,
-    'dash': 0x2D,
-    'lbracket': 0x2F,
-    'quote': 0x34,
-    'unknown7': 0x00,
-    'unknown8': 0x00,
-    'f12': 0x45,
-    'equals': 0x2E,
-    'rbracket': 0x30,
-    'unknown9': 0x00,
-    'rshift': 0xE5,
-    'fn': 0x00,
-    'unknown10': 0x00,
-    'backspace': 0x2A,
-    'backslash': 0x31,
-    'enter': 0x28,
-    'unknown11': 0x00,
-    'rctrl': 0xE4,
-    'unknown12': 0x00,
-    'unknown13': 0x00,
-    'delete': 0x4C,
-    'unknown14': 0x00,
-    'unknown15': 0x00,
-    'left': 0x50,
-    'unknown16': 0x00,
-    'print_screen': 0x46,
-    'pause': 0x48,
-    'scroll_lock': 0x47,
-    'up': 0x52,
-    'down': 0x51,
-    'insert': 0x49,
-    'pageup': 0x4B,
-    'pagedown': 0x4E,
-    'home': 0x4A,
-    'end': 0x4D,
-    'right': 0x4F,
-    'function_toggle_rgb': 0xf03c00,
-    'function_swap_wasd': 0xF00300,
-    'function_change_keyboard_index': 0xF05200,
-    'function_change_rgb_color': 0xf02b00,
-    'function_change_rgb_pattern': 0xf01000,
-    'function_increase_rgb_brightness': 0xf02500,
-    'function_decrease_rgb_brightness': 0xf02600,
-    'function_make_rgb_faster': 0xf02700,
-    'function_make_rgb_slower': 0xf01800,
-    'function_toggle_charging_light': 0xf05100,
-    'function_bt_matching_2': 0xf04002,
-    'function_bt_matching_3': 0xf04003,
-    'function_reset_settings': 0xf02c00,
-    'function_bt_matching_1': 0xf04001,
-    'function_mac_mode': 0xf00500,
-    'function_windows_mode': 0xf00600,
-    'function_enter_wired_mode': 0xf04004,
-    'function_enter_wireless_mode': 0xf04000,
-}
-
-# Constants for vendor and product IDs
-VENDOR_ID = 0x258A
-PRODUCT_ID = 0x0049
 DEFAULT_GUI_RGB = "000000"
 
-device = None
-out_endpoint = None
+device_selectors = []
+all_devices = False
 parser = None
 silent = False
-gui_objects = []
+gui_objects = {}
+key_buttons = {}
+selected_key = None
+gui_root = None
+pending_gui_updates = {}
+applied_gui_options = {}
+gui_flush_scheduled = False
+gui_update_start = None
+gui_edit_pending = False
+redraw_stats = False
+upload_worker = None
+live_preview = None
+preview_rate = 10
+preview_scheduled = False
+stream_fps = None
+compile_path = None
+batch_input = None
+daemon_mode = False
+use_daemon = True
+no_apply = False
+plan_only = False
+logger = logging.getLogger("gibkey")
 
 ###################
 ## GUI functions ##
@@ -174,8 +67,10 @@ def load_gui(error_message):
         return False
 
     # Create main window
+    global gui_root
     root = tk.Tk()
     root.title("GIBKEY G68 Config")
+    gui_root = root
 
     # Load icon
     try:
@@ -208,7 +103,7 @@ def load_gui(error_message):
     pattern_label = tk.Label(pattern_frame, text="Pattern", **label_style)
     pattern_label.pack(side="left", padx=5)
     pattern_dropdown = ttk.Combobox(pattern_frame, values=pattern_values, style="TCombobox", state="readonly", width=15, name="pattern")
-    pattern_dropdown.bind("<<ComboboxSelected>>", lambda event: adjust_key_fields())
+    pattern_dropdown.bind("<<ComboboxSelected>>", lambda event: (adjust_key_fields(), preview_changes()))
     pattern_dropdown.current(1)
     pattern_dropdown.pack(side="right", pady=(1,0))
 
@@ -229,6 +124,7 @@ def load_gui(error_message):
     direction_label = tk.Label(direction_frame, text="Direction", **label_style)
     direction_label.pack(side="left", padx=5)
     direction_dropdown = ttk.Combobox(direction_frame, values=["Normal", "Reverse"], style="TCombobox", state="readonly", width=10, name="direction")
+    direction_dropdown.bind("<<ComboboxSelected>>", lambda event: preview_changes())
     direction_dropdown.current(0)
     direction_dropdown.pack(side="right", pady=(1,0))
 
@@ -250,37 +146,14 @@ def load_gui(error_message):
     # Keyboard layout
     keyboard_frame = tk.Frame(root, bg="#2E2E2E")
     keyboard_frame.pack(side="top", padx=20, pady=10, fill="x"),
-    keyboard_keys_buttons = [
-        ["Esc", "1", "2", "3", "4", "5", "6", "7", "8", "9", "0", "-", "=", "Backspace", "~"],
-        ["Tab", "Q", "W", "E", "R", "T", "Y", "U", "I", "O", "P", "[", "]", "\\", "Del"],
-        ["CapsLock", "A", "S", "D", "F", "G", "H", "J", "K", "L", ";", "'", "Enter", "PU"],
-        ["LShift", "Z", "X", "C", "V", "B", "N", "M", ",", ".", "/", "RShift", "Up", "PD"],
-        ["LCtrl", "LWin", "LAlt", "Space", "RAlt", "Fn", "RCtrl", "Left", "Down", "Right"]
-    ]
-
-    # Button sizes
-    key_width = 5
     key_spacing = 5
-    special_keys = {
-        "Backspace": 2 * (key_width) - 1,
-        "Tab": 1.5 * (key_width),
-        "\\": 1.5 * (key_width),
-        "CapsLock": 1.75 * (key_width) + 1,
-        "LShift": 2 * (key_width) + 1,
-        "Space": 8 * (key_width) + 2,
-        "Enter": 2.5 * (key_width),
-        "RShift": 1.75 * (key_width) + 2,
-        "LCtrl": 1.25 * (key_width),
-        "LWin": 1.25 * (key_width),
-        "LAlt": 1.25 * (key_width) + 1
-    }
 
     # Add keyboard buttons
     buttons_collection = []
-    for row in keyboard_keys_buttons:
+    for row in KEYBOARD_LAYOUT:
         row_frame = tk.Frame(keyboard_frame, bg="#2E2E2E")
         for key in row:
-            width = special_keys.get(key, key_width)
+            width = SPECIAL_KEY_WIDTHS.get(key, KEY_WIDTH)
             key_button = tk.Button(row_frame, text=key, width=int(width), height=1, command=lambda k=key: select_key_button(k), name=f"key_button_{get_key_id(key)}")
             key_button.pack(side="left", padx=key_spacing, ipady=11, pady=5)
             key_button.config(background=f"#{DEFAULT_GUI_RGB}", foreground="white", font=("Arial", 11), borderwidth=0, activebackground="#202020", activeforeground="white", highlightthickness=4, relief="flat")
@@ -300,7 +173,13 @@ def load_gui(error_message):
     # Add bottom buttons
     bottom_buttons_frame = tk.Frame(root, bg="#2E2E2E")
     bottom_buttons_frame.pack(pady=(5,12), side="right")
-    load_config_button = ttk.Button(bottom_buttons_frame, text="Load Config", padding=5, command=lambda: load_config_gui(), style="Custom.TButton")
+    upload_status_label = tk.Label(bottom_buttons_frame, text="", **label_style, name="upload_status")
+    upload_status_label.pack(side="left", padx=10)
+    cancel_upload_button = ttk.Button(bottom_buttons_frame, text="Cancel", padding=5, command=lambda: cancel_upload(), style="Custom.TButton", name="cancel_upload")
+    live_preview_value = tk.BooleanVar(root, False)
+    live_preview_checkbox = tk.Checkbutton(bottom_buttons_frame, text="Live Preview", variable=live_preview_value, command=lambda: toggle_live_preview(live_preview_value.get()), **label_style, selectcolor="#3C3C3C", activebackground="#2E2E2E", activeforeground="#FFFFFF", highlightthickness=0, name="live_preview")
+    live_preview_checkbox.pack(side="left", padx=10)
+    load_config_button = ttk.Button(bottom_buttons_frame, text="Load Config", padding=5, command=lambda: load_config_gui(), style="Custom.TButton", name="load_config_button")
     load_config_button.pack(side="left", ipadx=15, padx=10)
     save_config_button = ttk.Button(bottom_buttons_frame, text="Save Config", padding=5, command=lambda: save_config_gui(), style="Custom.TButton")
     save_config_button.pack(side="left", ipadx=15, padx=10)
@@ -311,11 +190,7 @@ def load_gui(error_message):
     key_buttons_frame = tk.Frame(root, bg="#2E2E2E", name="key_options")
     key_buttons_frame.pack(pady=(0,10), side="bottom")
 
-    key_button_values = []
-    for index, key in enumerate(KEY_CODES_SORTED):
-        if "function" not in key and "unknown" not in key:
-            key_button_values.append(key)
-    key_button_values = sorted(key_button_values, key=lambda key_id: (len(key_id) > 1, key_id))
+    key_button_values = sorted(USABLE_KEYS, key=lambda key_id: (len(key_id) > 1, key_id))
     
     key_map_frame = tk.Frame(key_buttons_frame, bg="#2E2E2E")
     key_map_frame.pack(side="left", fill="x", pady=5)
@@ -343,18 +218,12 @@ def load_gui(error_message):
     key_rgb_field.bind("<Return>", lambda event: open_color_picker(event))
     key_rgb_field.bind("<KeyRelease>", lambda event: set_key_rgb_gui(get_selected_key()))
 
-    # Create a list that will hold all the gui objects
-    global gui_objects
-    gui_objects.append(pattern_dropdown)
-    gui_objects.append(direction_dropdown)
-    gui_objects.append(color_field)
-    gui_objects.append(speed_slider)
-    gui_objects.append(brightness_slider)
-    gui_objects.append(key_map_dropdown)
-    gui_objects.append(key_fn_map_dropdown)
-    gui_objects.append(key_rgb_field)
-    gui_objects.append(key_rgb_frame)
-    gui_objects.extend(buttons_collection)
+    # Register all the gui objects, so they can be looked up by name
+    register_gui_objects(pattern_dropdown, direction_dropdown, color_field, speed_slider, brightness_slider, key_map_dropdown, key_fn_map_dropdown, key_rgb_field, key_rgb_frame, upload_status_label, cancel_upload_button, load_config_button)
+    register_gui_objects(*buttons_collection)
+
+    # Keep the upload status up to date
+    root.after(100, update_upload_status)
     
     # Run the gui
     root.mainloop()
@@ -368,19 +237,22 @@ def select_key_button(key):
     map_field = get_gui_object("map")
     fn_map_field = get_gui_object("fn_map")
     rgb_field = get_gui_object("rgb")
-    key_button = get_gui_object(f"key_button_{key_id}")
+    key_button = key_buttons[key_id]
     map_value = key_id
     rgb_value = "Default"
     fn_map_value = default_fn_key_id
 
     # Unset the previously selected key
-    for key_object in get_all_keys():
-        key_object.selected = False
-        key_object.config(font=("Arial", 11))
+    global selected_key
+    if selected_key != None and selected_key is not key_button:
+        selected_key.selected = False
+        selected_key.config(font=("Arial", 11))
 
     # Set the selected key and BOLDIFY it
-    key_button.selected = True
-    key_button.config(font=("Arial", 11, "bold"))
+    if selected_key is not key_button:
+        key_button.selected = True
+        key_button.config(font=("Arial", 11, "bold"))
+        selected_key = key_button
 
     # Get the button's values
     if key_button.map != None:
@@ -419,18 +291,70 @@ def set_key_rgb_gui(key = None, rgb_code = None):
     if key == "all":
         keys = get_all_keys()
     
-    # Set key rgb
+    # Skip colors that are still being typed in
+    if len(rgb_code) != 6 or not validate_color(rgb_code):
+        return
+
+    # Set key rgb. Darken text if key is too light.
+    foreground = get_key_foreground(rgb_code)
     for key_object in keys:
-        key_object.config(background=f"#{rgb_code}")
         key_object.rgb = rgb_code
-
-        # Darken text if key is too light
+        queue_gui_update(key_object, background=f"#{rgb_code}", foreground=foreground)
+    preview_changes()
+
+# Get the text color for a key of the given color, caching the result since the same few colors are used over and over
+key_foreground_cache = {}
+def get_key_foreground(rgb_code):
+    foreground = key_foreground_cache.get(rgb_code)
+    if foreground is None:
         r, g, b = int(rgb_code[0:2], 16), int(rgb_code[2:4], 16), int(rgb_code[4:6], 16)
         luminance = (0.299 * r + 0.587 * g + 0.114 * b)
-        if luminance > 186:
-            key_object.config(foreground="black")
-        else:
-            key_object.config(foreground="white")
+        foreground = "black" if luminance > 186 else "white"
+        key_foreground_cache[rgb_code] = foreground
+    return foreground
+
+# Queue widget option changes. All changes queued until the GUI is idle are applied together, once.
+def queue_gui_update(widget, edit = True, **options):
+    global gui_flush_scheduled, gui_update_start, gui_edit_pending
+    pending_gui_updates.setdefault(widget, {}).update(options)
+
+    # Only edits are timed by --redraw-stats, not the GUI's own periodic updates
+    if edit and not gui_edit_pending:
+        gui_edit_pending = True
+        gui_update_start = time.perf_counter()
+
+    # Without a GUI loop there's nothing to batch with
+    if gui_root is None:
+        flush_gui_updates()
+    elif not gui_flush_scheduled:
+        gui_flush_scheduled = True
+        gui_root.after_idle(flush_gui_updates)
+
+# Apply the queued widget changes, skipping the options that already have the queued value
+def flush_gui_updates():
+    global gui_flush_scheduled, gui_edit_pending
+    gui_flush_scheduled = False
+    edited = gui_edit_pending
+    gui_edit_pending = False
+    flush_start = time.perf_counter()
+    config_calls = 0
+
+    for widget, options in pending_gui_updates.items():
+        applied_options = applied_gui_options.setdefault(widget, {})
+        changed_options = {option: value for option, value in options.items() if applied_options.get(option) != value}
+        if len(changed_options) > 0:
+            widget.config(**changed_options)
+            applied_options.update(changed_options)
+            config_calls += 1
+    widget_count = len(pending_gui_updates)
+    pending_gui_updates.clear()
+
+    if redraw_stats and edited:
+        if gui_root != None:
+            gui_root.update_idletasks() # Include the actual redraw in the measurement
+        flush_end = time.perf_counter()
+        waited = (flush_start - gui_update_start) * 1000 if gui_update_start != None else 0
+        print(f"Redraw: {widget_count} widgets queued, {config_calls} updated, {(flush_end - flush_start) * 1000:.1f} ms (queued for {waited:.1f} ms)")
 
 # Set specific key's FN mapping
 def set_key_fn_map_gui(key = None, fn_map = None):
@@ -472,13 +396,13 @@ def adjust_key_text(key):
 
     if key.map != key.key_id:
         label = key.map.capitalize()
-        mapped_key = get_gui_object(f"key_button_{key.map}")
+        mapped_key = key_buttons.get(key.map)
         if mapped_key != None:
             label = mapped_key.config("text")[-1].split("\n")[0]
         key_map = truncate_text(f"\n\u2937 {label}", round(button_size * 1.5))
     if "forbidden" != default_fn_map and key.fn_map != default_fn_map:
         label = key.fn_map.capitalize()
-        mapped_key = get_gui_object(f"key_button_{key.fn_map}")
+        mapped_key = key_buttons.get(key.fn_map)
         if mapped_key != None:
             label = mapped_key.config("text")[-1].split("\n")[0]
         if button_size == 9:
@@ -529,27 +453,283 @@ def generate_key_map_and_rgb():
     
     return (key_map_collection, keys_color_collection)
 
-# Apply values from GUI to device
-def apply_changes():
-
-    # Get values
+# Get the pattern values from the GUI
+def get_pattern_values_gui():
     pattern = get_gui_object("pattern").get().lower().replace(" ", "_")
     brightness = int(get_gui_object("brightness").get())
     speed = 5 - int(get_gui_object("speed").get())
     direction = get_gui_object("direction").get().lower()
     color = f"{get_gui_object("color").get().lower():0<6}"
+    return (pattern, brightness, speed, direction, color)
+
+# Apply values from GUI to device
+def apply_changes():
+
+    # Get values
+    pattern, brightness, speed, direction, color = get_pattern_values_gui()
 
     # Get key map and RGB collections
     key_map_collection, keys_color_collection = generate_key_map_and_rgb()
 
-    # Apply all changes, as necessary. Similar to the CLI functionality, adding some pauses just to be safe.
-    if len(key_map_collection) > 0:
-        set_key_map(key_map_collection)
-        time.sleep(0.1)
-    if len(keys_color_collection) >0:
-        set_keys_color(keys_color_collection)
-        time.sleep(0.1)
-    set_pattern(pattern, brightness, speed, direction, color)
+    # Upload in the background, replacing any upload that is still going on
+    global upload_worker
+    if upload_worker is None:
+        upload_worker = UploadWorker()
+    upload_worker.submit(lambda progress: upload_changes(pattern, brightness, speed, direction, color, key_map_collection, keys_color_collection, progress))
+    update_upload_status()
+
+# Upload the changes from the GUI, reporting progress after each packet
+def upload_changes(pattern, brightness, speed, direction, color, key_map_collection, keys_color_collection, progress):
+    # Only what the keyboard doesn't have yet is sent, e.g. no RGB table unless the pattern is custom
+    plan = plan_upload(get_config_packet_groups(pattern, brightness, color, direction, speed, key_map_collection, keys_color_collection), get_session().shadow_packets)
+
+    total = sum(len(packets) for packets, paced, pause in plan)
+    done = 0
+    def packet_done():
+        nonlocal done
+        done += 1
+        progress(done, total)
+    progress(done, total)
+
+    run_plan(plan, packet_done)
+
+    # Whatever was being previewed is now applied
+    if live_preview != None:
+        live_preview.commit()
+
+# Cancel the current upload
+def cancel_upload():
+    if upload_worker != None:
+        upload_worker.cancel()
+    update_upload_status()
+
+# Show the upload progress, and the cancel button while uploading. The label is only queued for an update when its text changes.
+def update_upload_status():
+    status = None
+    if upload_worker != None and (upload_worker.is_busy() or live_preview is None or not live_preview.running):
+        status = upload_worker.get_status()
+    elif live_preview != None and live_preview.running:
+        status = live_preview.get_status()
+    status_label = get_gui_object("upload_status")
+    if status != None and status != pending_gui_updates.get(status_label, applied_gui_options.get(status_label, {})).get("text"):
+        queue_gui_update(status_label, False, text=status)
+    if upload_worker != None:
+        cancel_button = get_gui_object("cancel_upload")
+        if upload_worker.is_busy() and not cancel_button.winfo_ismapped():
+            cancel_button.pack(side="left", ipadx=15, padx=10, before=get_gui_object("load_config_button"))
+        elif not upload_worker.is_busy() and cancel_button.winfo_ismapped():
+            cancel_button.pack_forget()
+    gui_root.after(100, update_upload_status)
+
+# Raised inside an upload when it gets cancelled
+class UploadCancelled(Exception):
+    pass
+
+# Runs uploads on a background thread, so the GUI doesn't freeze while packets are sent.
+# There's at most one upload waiting: submitting a new one replaces it, and cancels the one in progress.
+class UploadWorker:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.cancel_event = threading.Event()
+        self.pending_job = None
+        self.busy = False
+        self.progress = (0, 0)
+        self.status = ""
+        threading.Thread(target=self.run, name="gibkey-upload", daemon=True).start()
+
+    # Queue an upload. job is called with a progress(done, total) callback.
+    def submit(self, job):
+        with self.condition:
+            self.pending_job = job
+            if self.busy:
+                self.cancel_event.set()
+            self.condition.notify()
+
+    # Drop the waiting upload and stop the one in progress
+    def cancel(self):
+        with self.condition:
+            self.pending_job = None
+            if self.busy:
+                self.cancel_event.set()
+
+    # Check if an upload is waiting or in progress
+    def is_busy(self):
+        return self.busy or self.pending_job != None
+
+    # Get a short description of the upload state
+    def get_status(self):
+        if self.busy:
+            return f"Uploading {self.progress[0]}/{self.progress[1]}"
+        return self.status
+
+    # Worker thread loop
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending_job is None:
+                    self.condition.wait()
+                job = self.pending_job
+                self.pending_job = None
+                self.cancel_event.clear()
+                self.progress = (0, 0)
+                self.busy = True
+
+            try:
+                job(self.report_progress)
+                self.status = "Applied"
+            except UploadCancelled:
+                self.status = "Cancelled"
+            except Exception as e:
+                self.status = f"Upload failed: {e}"
+            self.busy = False
+
+    # Progress callback for the running job. Stops the job if it has been cancelled.
+    def report_progress(self, done, total):
+        if self.cancel_event.is_set():
+            raise UploadCancelled()
+        self.progress = (done, total)
+
+# Turn the live preview on or off. Turning it off discards the previewed changes that haven't been applied.
+def toggle_live_preview(enabled):
+    global live_preview
+    if enabled:
+        if live_preview is None:
+            live_preview = LivePreview(preview_rate)
+        live_preview.start(get_gui_packets())
+        preview_changes()
+    elif live_preview != None:
+        live_preview.stop(True)
+    update_upload_status()
+
+# Preview the current GUI values on the keyboard, once the GUI is idle so a burst of edits is only previewed once
+def preview_changes():
+    global preview_scheduled
+    if live_preview is None or not live_preview.running or preview_scheduled:
+        return
+    preview_scheduled = True
+    gui_root.after_idle(push_preview)
+
+# Get the packets of what the GUI shows, by family: the pattern packet and the per-key RGB table
+def get_gui_packets():
+    pattern, brightness, speed, direction, color = get_pattern_values_gui()
+    return {KEY_RGB_HEADER.hex(): encode_key_rgb_packets(generate_key_map_and_rgb()[1]), PATTERN_HEADER.hex(): [encode_pattern_packet(RGB_PATTERNS[pattern], brightness, speed, direction, color)]}
+
+# Send the current GUI values to the live preview
+def push_preview():
+    global preview_scheduled
+    preview_scheduled = False
+    if live_preview is None or not live_preview.running:
+        return
+
+    pattern, brightness, speed, direction, color = get_pattern_values_gui()
+    pattern_packet = encode_pattern_packet(RGB_PATTERNS[pattern], brightness, speed, direction, color)
+
+    # Per-key colors only show on the custom pattern
+    key_rgb_packets = None
+    if pattern == "custom":
+        key_rgb_packets = encode_key_rgb_packets(generate_key_map_and_rgb()[1])
+
+    live_preview.push(pattern_packet, key_rgb_packets)
+
+# Previews the pattern and per-key colors on the keyboard while the GUI controls move.
+# Updates are sent from a separate thread, at most rate times per second, and only the newest one is kept.
+# Only packets that differ from what the keyboard has are sent: the pattern packet, and the changed per-key RGB chunks, which are paced so the keyboard keeps up with them.
+# The state from before the preview (or from the last Apply) is kept, so the previewed changes can be discarded. Where the keyboard's state isn't known,
+# e.g. before the first upload of the session, what the GUI showed when the preview started is put back instead.
+class LivePreview:
+    def __init__(self, rate = 10):
+        self.interval = 1 / rate
+        self.condition = threading.Condition()
+        self.pending_update = None
+        self.running = False
+        self.run_state = {"running": False, "discard": False}   # Whether the current sender thread keeps going, and if it discards when it stops
+        self.committed_packets = {}
+        self.gui_packets = {}               # What the GUI showed when the preview started, by family
+        self.thread = None
+        self.updates_sent = 0
+        self.error = None
+
+    # Start previewing, from the keyboard's current state. gui_packets are what the GUI shows, restored for the families the keyboard's state isn't known for.
+    # Called from the GUI, so the waiting is left to the new sender thread: for the last one to be done, and for the keyboard's state, which an upload can hold for seconds.
+    def start(self, gui_packets = None):
+        self.gui_packets = gui_packets or {}
+        with self.condition:
+            self.run_state["running"] = False
+            self.condition.notify_all()
+        self.running = True
+        self.error = None
+        self.run_state = {"running": True, "discard": False}
+        self.thread = threading.Thread(target=self.run, args=(self.run_state, self.thread), name="gibkey-preview", daemon=True)
+        self.thread.start()
+
+    # Keep the keyboard's current state, so it's what gets restored when discarding
+    def commit(self):
+        session = get_session()
+        with session.lock:
+            self.committed_packets = {}
+            for header in (KEY_RGB_HEADER, PATTERN_HEADER):
+                packets = list(session.shadow_packets.get(header.hex(), []))
+                if len(packets) < 1:
+                    packets = list(self.gui_packets.get(header.hex(), []))
+                self.committed_packets[header.hex()] = packets
+
+    # Queue an update, replacing the one still waiting to be sent
+    def push(self, pattern_packet, key_rgb_packets = None):
+        with self.condition:
+            self.pending_update = (pattern_packet, key_rgb_packets)
+            self.condition.notify()
+
+    # Stop previewing. With discard, the keyboard goes back to the committed state.
+    def stop(self, discard = True):
+        with self.condition:
+            self.running = False
+            self.run_state["running"] = False
+            self.run_state["discard"] = discard
+            self.pending_update = None
+            self.condition.notify_all()
+
+    # Get a short description of the preview state
+    def get_status(self):
+        if self.error != None:
+            return f"Preview failed: {self.error}"
+        return "Previewing"
+
+    # Sender thread loop. Sends the newest update at most once per interval, until run_state is stopped.
+    def run(self, run_state, previous_thread):
+        if previous_thread != None:
+            previous_thread.join()
+        self.commit()
+
+        next_update_time = time.perf_counter()
+        while True:
+            with self.condition:
+                while self.pending_update is None and run_state["running"]:
+                    self.condition.wait()
+                if not run_state["running"]:
+                    break
+                pattern_packet, key_rgb_packets = self.pending_update
+                self.pending_update = None
+
+            try:
+                if key_rgb_packets != None:
+                    send_packets(key_rgb_packets)
+                send_packets([pattern_packet], False)
+                self.updates_sent += 1
+            except Exception as e:
+                self.error = e
+
+            # Hold off until the next update is due
+            next_update_time = max(next_update_time + self.interval, time.perf_counter())
+            time.sleep(max(0, next_update_time - time.perf_counter()))
+
+        # Put back whatever the keyboard had before previewing
+        if run_state["discard"]:
+            try:
+                for packets in self.committed_packets.values():
+                    if len(packets) > 0:
+                        send_packets(packets)
+            except Exception as e:
+                self.error = e
 
 # Load config from JSON file to GUI
 def load_config_gui():
@@ -668,39 +848,32 @@ def open_color_picker(event, apply_to_all = False):
         set_key_rgb_gui(get_selected_key(), color_code)
         
 
+# Register GUI objects by name. Key buttons are also indexed by their key id.
+def register_gui_objects(*objects):
+    for object in objects:
+        object_name = str(object).lower().rsplit(".", 1)[-1].replace(":", "")
+        gui_objects[object_name] = object
+        if "key_button_" in object_name and hasattr(object, "key_id"):
+            key_buttons[object.key_id] = object
+
 # Get selected key button
 def get_selected_key():
-    global gui_objects
-
-    for object in gui_objects:
-        if "key_button_" in str(object) and hasattr(object, "selected") and object.selected:
-            return object
-
-    return None
+    return selected_key
 
 # Get a GUI object by name
 def get_gui_object(name, partial_match = False):
-    global gui_objects
-
-    for object in gui_objects:
-        object_name = str(object).lower().rsplit(".", 1)[-1].replace(":", "")
-        if name == object_name:
-            return object
-        elif partial_match and name in object_name:
-            return object
+    object = gui_objects.get(name)
+    if object is None and partial_match:
+        for object_name, object in gui_objects.items():
+            if name in object_name:
+                return object
+        return None
 
-    return None
+    return object
 
 # Get all keys
 def get_all_keys():
-    global gui_objects
-
-    keys = []
-    for object in gui_objects:
-        if "key_button_" in str(object) and hasattr(object, "selected"):
-            keys.append(object)
-
-    return keys
+    return list(key_buttons.values())
 
 # Validate color value
 def validate_color(value):
@@ -750,27 +923,12 @@ def snap_slider(value, slider, label):
         label_text = f"{label_text} ({int_value})"
         label_text = label.config(text=label_text)
         slider.set(int_value)
+        preview_changes()
 
 # Get a key id from its name
 def get_key_id(key_name):
     key_name = key_name.lower()
-    if key_name == "esc": key_name = "escape"
-    if key_name == "\\": key_name = "backslash"
-    if key_name == "/": key_name = "slash"
-    if key_name == "~": key_name = "tilde"
-    if key_name == "pu": key_name = "pageup"
-    if key_name == "pd": key_name = "pagedown"
-    if key_name == ",": key_name = "comma"
-    if key_name == ".": key_name = "period"
-    if key_name == "[": key_name = "lbracket"
-    if key_name == "]": key_name = "rbracket"
-    if key_name == "-": key_name = "dash"
-    if key_name == "=": key_name = "equals"
-    if key_name == ";": key_name = "semicolon"
-    if key_name == "del": key_name = "delete"
-    if key_name == "'": key_name = "quote"
-
-    return key_name
+    return KEY_LABEL_IDS.get(key_name, key_name)
 
 ###################
 ## CLI functions ##
@@ -823,6 +981,87 @@ def parse_args():
     parser.add_argument(
         "-i", "--config-input", type=str, metavar="<filepath>", help="Load the config from a JSON file."
     )
+    parser.add_argument(
+        "--compile", type=str, metavar="<path>", help="Compile a JSON profile, or a directory of them, into .g68bin files that apply without any parsing. With -o, sets the output file (or directory)."
+    )
+    parser.add_argument(
+        "--batch", type=str, nargs='?', const="-", metavar="<filepath>", help="Run newline-delimited JSON commands from a file, or from stdin without one, over a single keyboard session."
+    )
+    parser.add_argument(
+        "--list-devices", action='store_true', help="List the connected keyboards, by bus:address and serial number."
+    )
+    parser.add_argument(
+        "--device", type=str, action='append', metavar="<bus:address|serial>[=<config>]", help="Use this keyboard. Can be given more than once, to upload to several keyboards at once; with =<config>, that keyboard gets its own JSON or compiled profile."
+    )
+    parser.add_argument(
+        "--all-devices", action='store_true', help="Upload to every connected keyboard at once."
+    )
+    parser.add_argument(
+        "--full", action='store_true', help="Resend every packet, even the ones the keyboard should already have."
+    )
+    parser.add_argument(
+        "--state-file", type=str, metavar="<filepath>", help="Remember the last applied packets in this file, so later runs only send what changed."
+    )
+    parser.add_argument(
+        "--min-gap", type=int, metavar="<ms>", help="Smallest pause between packets in milliseconds (default 80)."
+    )
+    parser.add_argument(
+        "--retries", type=int, metavar="<count>", help="Write attempts per packet before giving up (default 5)."
+    )
+    parser.add_argument(
+        "--write-timeout", type=int, metavar="<ms>", help="Timeout of a single USB write in milliseconds (default 1500)."
+    )
+    parser.add_argument(
+        "--retry-deadline", type=float, metavar="<seconds>", help="Give up on a packet once it has taken this long, retries included (default 3)."
+    )
+    parser.add_argument(
+        "--no-reconnect", action='store_true', help="Don't wait for the keyboard to come back when it goes away mid-upload."
+    )
+    parser.add_argument(
+        "--reconnect-timeout", type=float, metavar="<seconds>", help="How long to wait for the keyboard to come back after it goes away mid-upload (default 10)."
+    )
+    parser.add_argument(
+        "--backend", type=str, choices=["usb", "fake"], help="Talk to the keyboard over USB, or to a simulated one (default usb, or $GIBKEY_BACKEND)."
+    )
+    parser.add_argument(
+        "-n", "--no-apply", action='store_true', help="Don't send anything to the keyboard, e.g. to only save the config with -o."
+    )
+    parser.add_argument(
+        "--plan", action='store_true', help="Print the packets that would be sent and how long that should take, without sending anything."
+    )
+    parser.add_argument(
+        "--log-level", type=str, choices=["debug", "info", "warning", "error"], help="Show log messages of this level and up (default info, or error with -s). debug shows every packet sent."
+    )
+    parser.add_argument(
+        "--trace-size", type=int, default=PACKET_TRACE_LENGTH, metavar="<count>", help=f"Number of packets kept in the packet trace (default {PACKET_TRACE_LENGTH})."
+    )
+    parser.add_argument(
+        "--trace-file", type=str, metavar="<filepath>", help="Write the packet trace to this file when a packet fails, or on SIGUSR1, instead of the log."
+    )
+    parser.add_argument(
+        "--startup-report", action='store_true', help="Print how long each startup phase took."
+    )
+    parser.add_argument(
+        "--stats", type=str, nargs='?', const="table", choices=["table", "json"], help="Print packet, byte, latency, retry and sleep statistics per upload phase when done, as a table (default) or JSON."
+    )
+    parser.add_argument(
+        "--redraw-stats", action='store_true', help="Print how long the GUI takes to redraw after each edit."
+    )
+    parser.add_argument(
+        "--preview-rate", type=float, default=10, metavar="<per second>", help="Maximum number of live preview updates sent per second in the GUI (default 10)."
+    )
+    parser.add_argument(
+        "--daemon", action='store_true', help="Keep running, owning the keyboard, and take commands from other runs through a local socket."
+    )
+    parser.add_argument(
+        "--socket", type=str, metavar="<filepath>", help="Socket of the daemon (default $GIBKEY_SOCKET, or gibkey-g68-<uid>.sock in the temp directory)."
+    )
+    parser.add_argument(
+        "--no-daemon", action='store_true', help="Talk to the keyboard directly, even if a daemon is running."
+    )
+    parser.add_argument(
+        "--stream", type=int, nargs='?', const=30, metavar="FPS", help="Stream per-key colors from stdin, one JSON object of key=color per line, at up to FPS frames per second (default 30)."
+    )
 
     args = parser.parse_args()
 
@@ -830,11 +1069,115 @@ def parse_args():
     global silent, show_help
     silent = args.silent
 
-    # Process list
+    # Process logging
+    log_level = args.log_level
+    if log_level is None:
+        log_level = "error" if silent else "info"
+    setup_logging(log_level.upper())
+
+    # Process backend, first, since the keyboard's session is made with it
+    if args.backend != None:
+        settings.backend = args.backend
+
+    # Process packet trace. It can also be dumped on demand with SIGUSR1.
+    if args.trace_size != PACKET_TRACE_LENGTH:
+        set_packet_trace_length(max(1, args.trace_size))
+    settings.trace_file = args.trace_file
+    import signal
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda signal_number, frame: dump_packet_trace())
+
+    # Process upload options
+    settings.full_upload = args.full
+    settings.state_file = args.state_file
+    if args.min_gap != None:
+        if args.min_gap < 0:
+            raise ValueError(f"Error: Minimum gap must be 0 or more.")
+        settings.pacing_min_gap = args.min_gap / 1000
+        get_session().pacing_gap = max(get_session().pacing_gap, settings.pacing_min_gap)
+
+    # Process retry policy
+    if args.retries != None:
+        retry_policy.retries = max(1, args.retries)
+    if args.write_timeout != None:
+        retry_policy.timeout = args.write_timeout
+    if args.retry_deadline != None:
+        retry_policy.deadline = args.retry_deadline
+    retry_policy.reconnect = not args.no_reconnect
+    if args.reconnect_timeout != None:
+        retry_policy.reconnect_timeout = args.reconnect_timeout
+
+    # Process daemon
+    global daemon_mode, use_daemon
+    daemon_mode = args.daemon
+    use_daemon = not args.no_daemon
+    # The daemon uploads with its own backend, state and transfer settings, so changes that come with any of these are sent from here
+    local_options = (args.backend, args.state_file, args.min_gap, args.retries, args.write_timeout, args.retry_deadline, args.reconnect_timeout)
+    if args.full or args.no_reconnect or any(option != None for option in local_options):
+        use_daemon = False
+    if args.socket != None:
+        settings.daemon_socket_path = args.socket
+
+    # Process device selection. The daemon only owns one keyboard, so it's skipped when picking them.
+    global device_selectors, all_devices
+    device_selectors = []
+    for selector in args.device or []:
+        selector, _, config_path = selector.partition("=")
+        device_selectors.append((selector, config_path if len(config_path) > 0 else None))
+    all_devices = args.all_devices
+    if len(device_selectors) > 0 or all_devices:
+        use_daemon = False
+
+    # Process compile
+    global compile_path
+    compile_path = args.compile
+
+    # Process batch
+    global batch_input
+    batch_input = args.batch
+
+    # Process stream
+    global stream_fps
+    stream_fps = args.stream
+    if stream_fps != None and stream_fps < 1:
+        raise ValueError(f"Error: Stream FPS must be at least 1.")
+
+    # Process startup report, printed however the program ends
+    if args.startup_report:
+        import atexit
+        atexit.register(print_startup_report)
+
+    # Process stats, also printed however the program ends
+    if args.stats != None:
+        import atexit
+        settings.upload_stats = UploadStats()
+        atexit.register(print_upload_stats, args.stats)
+
+    # Process redraw_stats
+    global redraw_stats
+    redraw_stats = args.redraw_stats
+
+    # Process preview_rate
+    global preview_rate
+    preview_rate = args.preview_rate
+    if preview_rate <= 0:
+        raise ValueError(f"Error: Preview rate must be above 0.")
+
+    # Process no_apply
+    global no_apply, plan_only
+    no_apply = args.no_apply or args.plan
+    plan_only = args.plan
+
+    # Process list. Nothing else to do after listing.
     if (args.list_keys):
         list_keys()
+        parser.exit()
     elif (args.list_patterns):
         list_patterns()
+        parser.exit()
+    elif (args.list_devices):
+        list_devices()
+        parser.exit()
 
     # Process key_color
     key_color = {}
@@ -885,14 +1228,18 @@ def parse_args():
     # Process config
     config_output = args.config_output
     config_input = args.config_input
+    if config_input != None and is_compiled_profile(config_input) and compile_path == None:
+        # A compiled profile is sent as it is, so nothing can be changed on top of it or saved from it
+        options = (args.pattern, args.brightness, args.color, args.direction, args.speed, args.key_color, args.key_map, config_output)
+        if any(option != None for option in options):
+            raise ValueError(f"Error: A compiled profile can't be combined with -p, -b, -c, -d, -sp, -kc, -km or -o. Apply the JSON profile instead.")
 
     return (pattern, brightness, color, direction, speed, key_color, key_map, config_output, config_input)
 
 # List usable keys
 def list_keys():
-    for index, key in enumerate(KEY_CODES_SORTED):
-        if "unknown" not in key and "function" not in key: 
-            print(key)
+    for key in USABLE_KEYS:
+        print(key)
     print("all [RGB ONLY] Fallback color for all unspecified keys")
     print("default [REMAP ONLY] Reset all keys to default")
 
@@ -901,365 +1248,225 @@ def list_patterns():
     for index, key in enumerate(RGB_PATTERNS): 
         print(key)
 
-# Load libusb from a local file
-def load_libusb():
-    import os, sys
-    from ctypes import CDLL
-
-    # Load the DLL from the base path where the script/exe is located
-    if getattr(sys, 'frozen', False):  # Check if running from PyInstaller's bundle
-        base_path = os.path.dirname(sys.executable)  # Path to the executable
-    else:
-        base_path = os.path.dirname(os.path.abspath(__file__))  # Path to the script
-    
-    # Define the DLL path in the original directory
-    dll_path = os.path.join(base_path, 'libusb-1.0.dll')
-
-    # Try loading the DLL from the original directory (where the .exe/.py is located)
-    if os.path.isfile(dll_path):
-        try:
-            # Load the DLL and reurn without error
-            CDLL(dll_path)
-            return None
-        except OSError as e:
-            return f"Error loading DLL from : {e}"
-    else:
-        return "libusb-1.0.dll not found."
-
-# Find and set up USB device
-def setup_device():
-    global device, out_endpoint
-    error_message = load_libusb()
-    if error_message != None:
-        return error_message
-    device = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
-    if device is None:
-        return "ERROR: Device not found.\n\nMake sure that the keyboard is connected via a USB cable and is set to wired mode."
-    device.set_configuration()
-    
-    mi_02_interface = None
-    for cfg in device:
-        for intf in cfg:
-            if intf.bInterfaceNumber == 2:  # MI_02 is interface number 2
-                mi_02_interface = intf
-                break
-        if mi_02_interface:
-            break
-
-    # Ensure we found the MI_02 interface
-    if mi_02_interface is None:
-        return "MI_02 interface not found"
-
-    # Select the OUT endpoint of the MI_02 interface
-    out_endpoint = None
-    for ep in mi_02_interface:
-        ep_address = ep.bEndpointAddress
-        if usb.util.endpoint_direction(ep_address) == usb.util.ENDPOINT_OUT:
-            out_endpoint = ep
-            break
-
-    # Ensure we found the OUT endpoint
-    if out_endpoint is None:
-        return "OUT endpoint for MI_02 not found"
-    
-    return None
-
-# Send the data to the USB device
-def send_data(data):
-    global device, out_endpoint, silent
-    retries = 5
-    timeout = 1500
-    for attempt in range(retries):
-        try:
-            device.write(out_endpoint.bEndpointAddress, data, timeout=timeout)
-            if not silent:
-                print(f"Packet sent: {data.hex()}")
-            break
-        except usb.core.USBError as e:
-            if not silent:
-                print(f"Error during data transfer: {e}")
-            if attempt < retries - 1:
-                if not silent:
-                    print(f"Retrying...")
-                time.sleep(1)
-            else:
-                raise RuntimeError("Max retries reached. Failed to send chunk.")
-
-# Generate packet verification
-def generate_verification(packet_data):
-    verification = 0x00
-    packet_bytes = bytearray.fromhex(packet_data)
-    for byte in packet_bytes:
-        verification = (verification + byte)
-    verification = f"{(verification % 0x100):02x}"
-
-    return verification
-
-# Split the string into different packets
-def split_data_into_packets(data, header):
-    packets = []
-    current_data_length = 0
-
-    # Split data into parts
-    parts = [data[i:i + 112] for i in range(0, len(data), 112)]
-    if len(parts[-1]) < 112:
-        parts[-1] = parts[-1].ljust(112, '0')  # Pad with '0' if less than 112
-
-    # Generate the packets using the header, signature, size and data parts
-    for part in parts:
-        first_index_byte = int(current_data_length/0x100)
-        second_index_byte = (current_data_length % 0x100)
-        packet_data = f"38{second_index_byte:02x}{first_index_byte:02x}00{part}"
-
-        verification = generate_verification(packet_data)
-        packet = f"{header}{verification}{packet_data}"
-        packets.append(packet)
-        current_data_length = current_data_length + 0x38
-    
-    return packets
-
-# Generate the pattern packet
-def generate_pattern_packet(pattern_int, brightness_int, speed_int, direction_val, color):
-    brightness = f"{brightness_int:02x}"
-    pattern = f"{pattern_int:02x}"
-
-    # Add up the RGB values
-    use_default_color = f"{int(color == 'default'):02x}" # Keep the different quotes to avoid breaking older Pythons
-    if (color == "default"):
-        color = "ffffff"
-
-    if (len(color) != 6):
-        raise ValueError("Color value is invalid")
-
-    # Set direction value
-    direction = None
-    if direction_val == "normal":
-        direction_val = 0
-    elif direction_val == "reverse":
-        direction_val = 1
-    direction = f"{direction_val:02x}"
-    
-    # Set speed value
-    speed = f"{speed_int:02x}"
-
-    # Create the packet data
-    packet_data = f"2000000002aa{pattern}{brightness}{speed}{direction}{use_default_color}00{color}0000ff00000400000100000000ffffffffffffffff000000000000000000000000000000000000000000000000"
-    
-    # Generate verificationgenerate_verification
-    verification = generate_verification(packet_data)
-    packet = f"550600{verification}{packet_data}"
-
-    return packet
-
-# Generate the packets for indivual key RGB
-def generate_key_rgb_packets(key_color):
-    current_data_length = 0
-
-    # Create hex string with RGB values for each key
-    data = ""
-    for index, key in enumerate(KEY_CODES_SORTED):
-        color = "000000"
-        if key in key_color:
-            color = key_color[key]
-        elif 'all' in key_color:
-            color = key_color['all']
-        data += color
-    
-    packets = split_data_into_packets(data, "550b00")
-
-    return packets
-
-# Get the default FN layer key for this key_id. Function keys should NOT be remapped in the FN layer.
-def get_default_fn_id(key_id, return_functions = False):
-        fn_key_id = key_id
-        if key_id in ["1", "2", "3", "4", "5", "6", "7", "8", "9"]:
-            fn_key_id = "f" + fn_key_id
-        elif key_id == "0":
-            fn_key_id = "f10"
-        elif key_id == "dash":
-            fn_key_id = "f11"
-        elif key_id == "equals":
-            fn_key_id = "f12"
-        elif key_id == "rbracket":
-            fn_key_id = "end"
-        elif key_id == "lbracket":
-            fn_key_id = "home"
-        elif key_id == "delete":
-            fn_key_id = "insert"
-        elif key_id == "pageup":
-            fn_key_id = "pause"
-        elif key_id == "pagedown":
-            fn_key_id = "scroll_lock"
-        elif key_id == "tilde":
-            fn_key_id = "print_screen"
-        elif key_id == "p":
-            fn_key_id = "function_toggle_rgb"
-        elif key_id == "left":
-            fn_key_id = "function_make_rgb_slower"
-        elif key_id == "right":
-            fn_key_id = "function_make_rgb_faster"
-        elif key_id == "up":
-            fn_key_id = "function_increase_rgb_brightness"
-        elif key_id == "down":
-            fn_key_id = "function_decrease_rgb_brightness"
-        elif key_id == "backslash":
-            fn_key_id = "function_change_rgb_pattern"
-        elif key_id == "tab":
-            fn_key_id = "function_change_rgb_color"
-        elif key_id == "w":
-            fn_key_id = "function_swap_wasd"
-        elif key_id == "space":
-            fn_key_id = "function_change_keyboard_index"
-        elif key_id == "l":
-            fn_key_id = "function_toggle_charging_light"
-        elif key_id == "e":
-            fn_key_id = "function_bt_matching_1"
-        elif key_id == "r":
-            fn_key_id = "function_bt_matching_2"
-        elif key_id == "t":
-            fn_key_id = "function_bt_matching_3"
-        elif key_id == "escape":
-            fn_key_id = "function_reset_settings"
-        elif key_id == "period":
-            fn_key_id = "function_mac_mode"
-        elif key_id == "comma":
-            fn_key_id = "function_windows_mode"
-        elif key_id == "y":
-            fn_key_id = "function_enter_wired_mode"
-        elif key_id == "q":
-            fn_key_id = "function_enter_wireless_mode"
-
-        if ("function" in fn_key_id or "fn" == fn_key_id) and not return_functions:
-            fn_key_id = "forbidden"
-        
-        return fn_key_id
+# List the connected keyboards
+def list_devices():
+    devices = find_devices()
+    for device in devices:
+        print(get_device_label(device))
+    if len(devices) < 1:
+        print("No keyboards found.")
+
+# Print how each keyboard's upload went
+def print_device_report(results):
+    for label, upload_time, error in results:
+        if error != None:
+            print(f"{label}: failed, {error}")
+        elif upload_time is None:
+            print(f"{label}: skipped, no config given for it")
+        elif not silent:
+            print(f"{label}: ok, upload took {upload_time:.3f}s")
+
+# Print the upload statistics, as a table or as JSON
+def print_upload_stats(output_format = "table"):
+    summary = settings.upload_stats.get_summary()
+    if output_format == "json":
+        print(json.dumps(summary, indent=2))
+        return
 
-# Generate the packets for indivual key remaps
-def generate_key_map_packets(key_map):
+    print(f"{'Phase':<10}{'Packets':>9}{'Skipped':>9}{'Bytes':>8}{'Retries':>9}{'Write ms':>10}{'Avg ms':>8}{'Max ms':>8}{'Paced ms':>10}{'Retry ms':>10}")
+    rows = list(summary["phases"].items()) + [("total", summary["total"])]
+    for phase, counters in rows:
+        print(f"{phase:<10}{counters['packets']:>9}{counters['skipped']:>9}{counters['bytes']:>8}{counters['retries']:>9}{counters['write_time'] * 1000:>10.1f}{counters['avg_latency'] * 1000:>8.2f}{counters['max_latency'] * 1000:>8.2f}{counters['pacing_sleep'] * 1000:>10.1f}{counters['retry_sleep'] * 1000:>10.1f}")
+    print(f"Run took {summary['run_time']:.3f}s")
+
+# Set up the log output. Messages are printed as they are, to stdout like the rest of the output.
+def setup_logging(level):
+    import sys
+    if len(logger.handlers) < 1:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+
+# Print a plan and how long it should take, without sending anything
+def print_plan(plan, shadow_packets = None):
+    if len(plan) < 1:
+        print("Nothing to send, the keyboard already has all of it.")
+        return
 
-    # Create hex string with keymap values for each key
-    data = ""
-    for index, key in enumerate(KEY_CODES_SORTED):
-        data += "1000"
-        mapped_key = key
+    total = 0
+    for packets, paced, pause in plan:
+        to_send = count_packets_to_send(packets, shadow_packets)
+        total += to_send
+        details = [f"{to_send} of {len(packets)} packets"]
+        if paced:
+            details.append("paced")
+        if pause:
+            details.append("after a pause")
+        print(f"{get_packet_phase(packets[0]):<10}{', '.join(details)}")
+    print(f"{total} packets to send, about {estimate_plan_time(plan, shadow_packets):.2f}s at {get_session().pacing_gap * 1000:.0f} ms pacing")
+
+# Apply a config through the daemon. Returns False if no daemon is running.
+def apply_config_through_daemon(pattern, brightness, color, direction, speed, key_map, key_color):
+    if "default" in key_map:
+        key_map = {"default": True}  # Sets aren't JSON serializable
+    command = {"command": "apply", "pattern": pattern, "brightness": brightness, "color": color, "direction": direction, "speed": speed, "key_map": key_map, "key_color": key_color}
+    reply = send_daemon_command(command)
+    if reply is None:
+        return False
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    if not silent:
+        print(f"Applied through the daemon, upload took {reply['upload_time']:.3f}s")
+    return True
+
+# Apply a compiled profile through the daemon. Returns False if no daemon is running.
+def apply_compiled_profile_through_daemon(path):
+    reply = send_daemon_command({"command": "load_config", "path": os.path.abspath(path)})
+    if reply is None:
+        return False
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    if not silent:
+        print(f"Applied through the daemon, upload took {reply['upload_time']:.3f}s")
+    return True
+
+# Print the time each batch command took, and the ones that failed
+def print_batch_report(results):
+    total_time = sum(result[2] for result in results)
+    failures = [result for result in results if result[3] != None]
+    if not silent:
+        print(f"{'Line':>6}  {'Command':<12}{'Time':>12}")
+        for line_number, command_name, command_time, error in results:
+            print(f"{line_number:>6}  {str(command_name or "-"):<12}{command_time * 1000:>9.1f} ms  {'failed' if error != None else 'ok'}")
+        print(f"{len(results)} commands in {total_time:.3f}s, {len(failures)} failed")
+    for line_number, command_name, command_time, error in failures:
+        print(f"Line {line_number}: {error}")
+
+# Print the streaming statistics
+def print_stream_stats(stats):
+    print(f"Frames: {stats['frames_sent']} sent, {stats['frames_dropped']} dropped, {stats['fps']:.1f} FPS sent")
+    print(f"Latency: {stats['latency_avg'] * 1000:.1f} ms average, {stats['latency_max'] * 1000:.1f} ms max")
+
+# Print how long each startup phase took
+def print_startup_report():
+    phases = [("import", "importing"), ("arguments", "parsing arguments"), ("usb_import", "importing pyusb"), ("setup", "setting up the keyboard")]
+    report = []
+    for phase, description in phases:
+        if phase in settings.startup_times:
+            report.append(f"{settings.startup_times[phase] * 1000:.1f} ms {description}")
+    print(f"Startup: {', '.join(report)}")
 
-        # Ignore functions
-        if "function" in key:
-            mapped_key = "unknown1"
-            
-        if "default" not in key_map and key in key_map:
-            mapped_key = key_map[key] # Set remap value
-        data += f"{KEY_CODES_SORTED[mapped_key]:02X}"
+# Run the program
+def run_program():
+    # Load arguments
+    settings.startup_times["import"] = time.perf_counter() - startup_start
+    arguments_start = time.perf_counter()
+    pattern, brightness, color, direction, speed, key_color, key_map, config_output, config_input = parse_args()
+    settings.startup_times["arguments"] = time.perf_counter() - arguments_start
 
-        divider = "1000"
+    # Run as a daemon
+    if daemon_mode:
+        run_daemon()
+        return
 
-        # Apply default FN layer values
-        mapped_key = get_default_fn_id(key, True)
-        if "function" in mapped_key:
-            divider = ""
-        
-        # Set FN layer value
-        if "default" not in key_map and f"{key}_fn" in key_map:
-            mapped_key = key_map[f"{key}_fn"]
-            divider = "1000"
-        data += divider + f"{KEY_CODES_SORTED[mapped_key]:02X}"
-
-    packets = split_data_into_packets(data, "550900")
-
-    return packets
-
-# Set light pattern
-def set_pattern(pattern_val, brightness_val, speed_val, direction_val, color = "000000"):
-    send_data(bytes.fromhex(generate_pattern_packet(RGB_PATTERNS[pattern_val], brightness_val, speed_val, direction_val, color)))
-
-# Set individual key RGB
-def set_keys_color(key_color):
-    for packet_data in generate_key_rgb_packets(key_color):
-        send_data(bytes.fromhex(packet_data))
-        time.sleep(0.1)
-
-# Set inidividual key mappings
-def set_key_map(key_map):
-    for packet_data in generate_key_map_packets(key_map):
-        send_data(bytes.fromhex(packet_data))
-        time.sleep(0.1)
-
-# Load config from JSON file
-def load_config(pattern, brightness, color, direction, speed, key_map, key_color, config_input):
-    with open(config_input, "r") as input_file:
-        json_file = json.load(input_file)
-        
-        # Add the stored values to the given key_map and key_color object.
-        # Config values don't override ones already in key_map and key_color.
-        if "key_map" in json_file:
-            for index, key in enumerate(json_file["key_map"]):
-                if key not in key_map:
-                    key_map[key] = json_file["key_map"][key]
-        if "key_color" in json_file:
-            for index, key in enumerate(json_file["key_color"]):
-                if key not in key_color:
-                    key_color[key] = json_file["key_color"][key]
-        if "pattern" in json_file and pattern is None:
-            pattern = json_file["pattern"]
-        if "brightness" in json_file and brightness is None:
-            brightness = json_file["brightness"]
-        if "color" in json_file and color is None:
-            color = json_file["color"]
-        if "direction" in json_file and direction is None:
-            direction = json_file["direction"]
-        if "speed" in json_file and speed is None:
-            speed = json_file["speed"]
-        
-        return (pattern, brightness, color, direction, speed, key_map, key_color)
-
-# Save config to JSON file
-def save_config(pattern, brightness, color, direction, speed, key_map, key_color, config_output):
-    out_key_map = {}
-    if "default" not in key_map: # Ignore key_map if default value is used
-        out_key_map = key_map
-    config = {"key_color": key_color, "key_map": out_key_map, "brightness": brightness, "color": color, "direction": direction, "speed": speed}
-    
-    if pattern != None:
-        config["pattern"] = pattern
-    elif len(key_map) > 0:
-        config["pattern"] = "custom"
+    # Compile profiles
+    if compile_path != None:
+        compile_profiles(compile_path, config_output)
+        return
 
-    with open(config_output, "w") as json_file:
-        json.dump(config, json_file, indent=2)
+    # Pick the keyboards. A single one is used like usual, several get the same upload in parallel.
+    if len(device_selectors) > 0 or all_devices:
+        targets = select_devices(device_selectors, all_devices)
+        if len(targets) < 1:
+            raise ValueError(f"Error: No keyboards found.")
+        if len(targets) == 1 and targets[0][1] is None:
+            get_session().usb_device = targets[0][0]
+        elif batch_input != None or stream_fps != None or (len(key_map) < 1 and len(key_color) < 1 and pattern == None and config_input is None and all(config_path is None for device, config_path in targets)):
+            raise ValueError(f"Error: Several keyboards can only be given a config, not the GUI, a batch or a stream.")
+        elif plan_only:
+            raise ValueError(f"Error: Plans can only be printed for a single keyboard.")
+        else:
+            config_path = None
+            if config_input != None and is_compiled_profile(config_input):
+                config_path = config_input
+            elif config_input != None:
+                pattern, brightness, color, direction, speed, key_map, key_color = load_config(pattern, brightness, color, direction, speed, key_map, key_color, config_input)
+            # Without a config from the command line, only the keyboards given one of their own get an upload
+            config = (pattern, brightness, color, direction, speed, key_map, key_color)
+            if len(key_map) < 1 and len(key_color) < 1 and pattern == None and config_input is None:
+                config = None
+            results = []
+            if not no_apply:
+                results = upload_to_devices(targets, config_path, config)
+                print_device_report(results)
+            if (config_output != None):
+                save_config(pattern, brightness, color, direction, speed, key_map, key_color, config_output)
+            if any(error != None for label, upload_time, error in results):
+                raise ValueError(f"Error: Some keyboards failed.")
+            return
+
+    # The state file keeps the last applied packets per keyboard, so the keyboard is opened before anything gets planned against them.
+    # If it can't be, there's nothing to plan against, and the upload reports why.
+    if settings.state_file != None and (plan_only or not no_apply):
+        setup_device()
+
+    # Run a batch of commands
+    if batch_input != None:
+        import sys
+        if batch_input == "-":
+            results = run_batch(sys.stdin, use_daemon)
+        else:
+            with open(batch_input, "r") as input_file:
+                results = run_batch(input_file, use_daemon)
+        print_batch_report(results)
+        if any(result[3] != None for result in results):
+            raise ValueError(f"Error: Some batch commands failed.")
+        return
 
-# Run the program
-def run_program():
-    # Load USB device and arguments
-    error_message = setup_device()
-    pattern, brightness, color, direction, speed, key_color, key_map, config_output, config_input = parse_args()
+    # Apply a compiled profile
+    if config_input != None and is_compiled_profile(config_input):
+        if plan_only:
+            shadow_packets = get_session().shadow_packets
+            print_plan(plan_upload(read_compiled_profile(config_input), shadow_packets), shadow_packets)
+        elif no_apply:
+            pass
+        elif not use_daemon or not apply_compiled_profile_through_daemon(config_input):
+            apply_compiled_profile(config_input)
+        return
 
     # If no usable parameters are given, load the GUI
-    if (len(key_map) < 1 and len(key_color) < 1 and pattern == None):
-        load_gui(error_message)
+    if (len(key_map) < 1 and len(key_color) < 1 and pattern == None and stream_fps == None and not no_apply):
+        load_gui(setup_device())
+    elif stream_fps != None:
+        # Streaming functionality. The keyboard gets set up with the first packet, which can't be done while the daemon holds it.
+        import sys
+        if use_daemon and send_daemon_command({"command": "ping"}) != None:
+            raise ValueError(f"Error: A daemon is running and holds the keyboard. Stop it to stream, or use --no-daemon.")
+        set_pattern('custom', brightness, speed, direction)
+        pace()
+        # A file's frames are all there at once, so they're taken at the target FPS instead of mostly getting dropped. A pipe is paced by whatever writes to it.
+        import stat
+        pace_input = stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode)
+        stats = stream_frames(read_stream_frames(sys.stdin), stream_fps, pace_input)
+        if not silent:
+            print_stream_stats(stats)
     else:
         # CLI functionality
 
-        # Throw error if device didn't connect
-        if error_message != None:
-            raise ValueError(error_message)
-
         # Load config
         if (config_input != None):
             pattern, brightness, color, direction, speed, key_map, key_color = load_config(pattern, brightness, color, direction, speed, key_map, key_color, config_input)
-        
-        # Load key maps
-        if (len(key_map) > 0):
-            set_key_map(key_map)
-
-        # Load key RGB or pattern. Adding some pauses here just to be extra safe.
-        if (len(key_color) > 0):
-            time.sleep(0.1)
-            set_pattern('custom', brightness, speed, direction)
-            time.sleep(0.1)
-            set_keys_color(key_color)
-        elif (pattern != None):
-            time.sleep(0.1)
-            set_pattern(pattern, brightness, speed, direction, color)
+
+        # Hand the changes over to the daemon if one is running, otherwise send them from here. The keyboard gets set up with the first packet.
+        if plan_only:
+            shadow_packets = get_session().shadow_packets
+            print_plan(plan_upload(get_config_packet_groups(pattern, brightness, color, direction, speed, key_map, key_color), shadow_packets), shadow_packets)
+        elif no_apply:
+            pass
+        elif not use_daemon or not apply_config_through_daemon(pattern, brightness, color, direction, speed, key_map, key_color):
+            apply_config(pattern, brightness, color, direction, speed, key_map, key_color)
 
         # Save config
         if (config_output != None):
@@ -1267,4 +1474,21 @@ def run_program():
 
 
 # Run the main functionality
-run_program()
\ No newline at end of file
+if __name__ == "__main__":
+    import sys
+    if getattr(sys, 'frozen', False):
+        # Lets the profile compiler's worker processes start from a PyInstaller executable
+        import multiprocessing
+        multiprocessing.freeze_support()
+
+    # Profile the whole run into the file given by GIBKEY_PROFILE, e.g. for snakeviz or pstats
+    profile_path = os.environ.get("GIBKEY_PROFILE")
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run_program)
+        finally:
+            profiler.dump_stats(profile_path)
+    else:
+        run_program()
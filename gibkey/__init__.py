@@ -0,0 +1,22 @@
+# Configure a GIBKEY G68 from Python. Packets are built by the functions in gibkey.packets and sent through a DeviceSession,
+# which paces, retries and resumes them the way the command line does:
+#
+#     import gibkey
+#     with gibkey.DeviceSession() as keyboard:
+#         keyboard.set_keys_color({"all": "ff0000", "escape": "00ff00"})
+#
+# A plain G68Device sends packets as they are, with a fixed pause between them.
+# gibkey-config.py is the command line and GUI built on top of this package.
+from gibkey.packets import (
+    RGB_PATTERNS, KEY_CODES_SORTED, DEFAULT_FN_KEYS, USABLE_KEYS, PACKET_LENGTH, CHUNK_LENGTH, PATTERN_HEADER, KEY_MAP_HEADER, KEY_RGB_HEADER,
+    encode_chunked_packets, encode_pattern_packet, encode_key_rgb_data, encode_key_rgb_chunks, encode_key_rgb_packets, encode_key_map_data, encode_key_map_packets,
+)
+from gibkey.device import VENDOR_ID, PRODUCT_ID, G68Device, FakeDevice, find_devices, get_device_serial, get_fake_devices, reset_fake_devices
+from gibkey.session import DeviceSession, RetryPolicy, UploadStats, get_session, setup_device, send_packets, load_shadow_state, save_shadow_state, save_pacing, format_packet_trace
+from gibkey.upload import set_pattern, set_keys_color, set_key_map, get_config_packet_groups, plan_upload, run_plan, apply_config, select_devices, upload_to_devices
+from gibkey.profiles import load_config, save_config, compile_profile, compile_profiles, read_compiled_profile, apply_compiled_profile
+from gibkey.frames import KeyFrame, key_color_to_frame, encode_frame_packets, effect_gradient, effect_wave, effect_breathe, effect_ripple, effect_noise
+from gibkey.streaming import FrameStreamer, stream_frames
+from gibkey.transport import AsyncTransport, set_pattern_async, set_keys_color_async, set_key_map_async
+from gibkey.writer import PacketWriter
+from gibkey.daemon import run_daemon, send_daemon_command, run_batch
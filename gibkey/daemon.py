@@ -0,0 +1,259 @@
+# The daemon, keeping the keyboard open and taking newline-delimited JSON commands over a Unix domain socket, and batches of the same commands.
+import json
+import logging
+import os
+import socket
+import time
+
+from gibkey import settings
+from gibkey.packets import RGB_PATTERNS, KEY_CODES_SORTED, KEY_INDEXES, encode_pattern_packet, encode_key_rgb_packets, encode_key_map_packets
+from gibkey.profiles import load_config, is_compiled_profile, read_compiled_profile
+from gibkey.session import get_session, setup_device, format_packet_trace
+from gibkey.upload import get_config_packet_groups, plan_upload, run_plan
+from gibkey.writer import PacketWriter
+
+logger = logging.getLogger("gibkey")
+
+# Get the path of the daemon's control socket
+def get_daemon_socket_path():
+    import tempfile
+    if settings.daemon_socket_path != None:
+        return settings.daemon_socket_path
+    user_id = os.getuid() if hasattr(os, "getuid") else "user"
+    return os.path.join(tempfile.gettempdir(), f"gibkey-g68-{user_id}.sock")
+
+# Get the apply command a JSON profile comes down to, with the defaults filled in for the values it doesn't set
+def get_config_command(config_path):
+    try:
+        pattern, brightness, color, direction, speed, key_map, key_color = load_config(None, None, None, None, None, {}, {}, config_path)
+    except (TypeError, AttributeError) as e:
+        raise ValueError(f"Error: {config_path} is not a valid config file: {e}")
+    return {"command": "apply", "pattern": pattern, "brightness": brightness if brightness != None else 50, "color": color if color != None else "default", "direction": direction if direction != None else 0, "speed": speed if speed != None else 3, "key_map": key_map, "key_color": key_color}
+
+# Get the packet groups a daemon command sends, as (packets, paced, pause)
+def get_command_packet_groups(command):
+    command_name = command.get("command")
+    if command_name == "apply":
+        return get_config_packet_groups(command.get("pattern"), command.get("brightness", 50), command.get("color", "default"), command.get("direction", 0), command.get("speed", 3), command.get("key_map", {}), command.get("key_color", {}))
+    elif command_name == "pattern":
+        return [([encode_pattern_packet(RGB_PATTERNS[command["pattern"]], command.get("brightness", 50), command.get("speed", 3), command.get("direction", 0), command.get("color", "default"))], False, False)]
+    elif command_name == "key_color":
+        return [(encode_key_rgb_packets(command["key_color"]), True, False)]
+    elif command_name == "key_map":
+        return [(encode_key_map_packets(command["key_map"]), True, False)]
+    elif command_name == "load_config" and is_compiled_profile(command["path"]):
+        return read_compiled_profile(command["path"])
+    elif command_name == "load_config":
+        return get_command_packet_groups(get_config_command(command["path"]))
+    return []
+
+# Run a single daemon command and get its reply. Packets go through the packet writer, so they can be reordered with the ones of other clients' commands.
+# superseded tells the client that part of its command got replaced by a newer one before it was sent.
+def run_daemon_command(command, packet_writer):
+    validate_command(command)
+    command_name = command.get("command")
+    if command_name == "ping":
+        return {"ok": True}
+    elif command_name == "trace":
+        return {"ok": True, "trace": format_packet_trace()}
+
+    # Not planned against the shadow packets here: jobs already queued on the writer would change them. The writer skips what the keyboard has once it gets to each packet.
+    upload_start = time.perf_counter()
+    applied = packet_writer.wait(packet_writer.submit(get_command_packet_groups(command)))
+    reply = {"ok": True, "upload_time": time.perf_counter() - upload_start}
+    if not applied:
+        reply["superseded"] = True
+    return reply
+
+# Run the daemon, listening for newline-delimited JSON commands on a Unix domain socket
+def run_daemon():
+    import socketserver
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("Error: The daemon needs Unix domain sockets, which this system doesn't support.")
+
+    # Refuse to start twice, but clean up the socket of a daemon that didn't exit properly. Anything else at the path is left alone.
+    import stat
+    socket_path = get_daemon_socket_path()
+    if send_daemon_command({"command": "ping"}) != None:
+        raise ValueError(f"Error: A daemon is already listening on {socket_path}")
+    try:
+        socket_mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        socket_mode = None
+    if socket_mode != None:
+        if not stat.S_ISSOCK(socket_mode):
+            raise ValueError(f"Error: {socket_path} exists and isn't a socket, refusing to replace it.")
+        os.remove(socket_path)
+
+    # The keyboard only ever sees one writer. It gets set up again with the next packet if it went away.
+    packet_writer = PacketWriter()
+    packet_writer.start()
+
+    # Each connection can send any number of commands, one JSON object per line
+    class DaemonRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    command = json.loads(line)
+                except ValueError as e:
+                    response = {"ok": False, "error": f"Invalid command: {e}"}
+                else:
+                    try:
+                        response = run_daemon_command(command, packet_writer)
+                    except Exception as e:
+                        response = {"ok": False, "error": str(e)}
+                self.wfile.write((json.dumps(response) + "\n").encode())
+
+    error_message = setup_device()
+    if error_message != None:
+        logger.info("%s\nWaiting for the keyboard, it will be set up with the first command.", error_message)
+
+    # Shut down cleanly when terminated, not just on Ctrl+C
+    import signal
+    def stop_daemon(signal_number, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop_daemon)
+
+    with socketserver.ThreadingUnixStreamServer(socket_path, DaemonRequestHandler) as server:
+        server.daemon_threads = True
+        logger.info("Listening on %s", socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+# Send a command to the daemon and get its reply. Returns None if no daemon is running.
+def send_daemon_command(command, timeout = 30):
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(get_daemon_socket_path())
+            client.sendall((json.dumps(command) + "\n").encode())
+            with client.makefile("r") as reply_file:
+                reply = reply_file.readline()
+    except OSError:
+        return None
+
+    if len(reply) < 1:
+        return None
+    return json.loads(reply)
+
+# Check that a command is well formed before anything gets sent, raising a ValueError describing the first problem.
+# The commands are the daemon's, plus sleep in batch mode.
+def validate_command(command, allow_sleep = False):
+    if not isinstance(command, dict):
+        raise ValueError("Error: Command must be a JSON object.")
+    command_name = command.get("command")
+    if command_name not in ("ping", "trace", "apply", "pattern", "key_color", "key_map", "load_config") and not (allow_sleep and command_name == "sleep"):
+        raise ValueError(f"Unknown command: {command_name}")
+
+    if command_name == "sleep":
+        seconds = command.get("seconds")
+        if not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or seconds < 0:
+            raise ValueError("Error: sleep needs a number of seconds, 0 or more.")
+    elif command_name == "load_config":
+        if not isinstance(command.get("path"), str) or not os.path.isfile(command["path"]):
+            raise ValueError(f"Error: Config file {command.get('path')} doesn't exist.")
+        # A JSON profile is checked like the apply command it comes down to
+        if not is_compiled_profile(command["path"]):
+            try:
+                validate_command(get_config_command(command["path"]))
+            except ValueError as e:
+                raise ValueError(f"Error: {command['path']}: {str(e).removeprefix('Error: ')}") from e
+    elif command_name == "pattern" and command.get("pattern") not in RGB_PATTERNS:
+        raise ValueError(f"Error: Given pattern is not valid.")
+    elif command_name == "key_color" and "key_color" not in command:
+        raise ValueError("Error: key_color command needs a key_color object.")
+    elif command_name == "key_map" and "key_map" not in command:
+        raise ValueError("Error: key_map command needs a key_map object.")
+
+    # Check the values shared by the pattern, apply and key commands
+    if command.get("pattern") != None and command["pattern"] not in RGB_PATTERNS:
+        raise ValueError(f"Error: Given pattern is not valid.")
+    brightness = command.get("brightness", 50)
+    if not isinstance(brightness, int) or isinstance(brightness, bool) or not 0 <= brightness <= 100:
+        raise ValueError("Error: brightness must be 0-100.")
+    speed = command.get("speed", 3)
+    if not isinstance(speed, int) or isinstance(speed, bool) or not 0 <= speed <= 4:
+        raise ValueError("Error: speed must be 0-4, as stored in config files.")
+    if command.get("direction", 0) not in (0, 1, "normal", "reverse"):
+        raise ValueError("Error: direction must be normal or reverse.")
+    color = command.get("color", "default")
+    if color != "default" and not is_color_code(color):
+        raise ValueError(f"Error: Color {color} is not valid.")
+
+    key_color = command.get("key_color", {})
+    if not isinstance(key_color, dict):
+        raise ValueError("Error: key_color must be an object of key=color.")
+    for key, color in key_color.items():
+        if key != "all" and key not in KEY_INDEXES:
+            raise ValueError(f"Error: Key {key} is not valid.")
+        if not is_color_code(color):
+            raise ValueError(f"Error: Color {color} of key {key} is not valid.")
+
+    key_map = command.get("key_map", {})
+    if not isinstance(key_map, dict):
+        raise ValueError("Error: key_map must be an object of key=mapped_key.")
+    if "default" not in key_map:
+        for key, mapped_key in key_map.items():
+            if key not in KEY_INDEXES and not (key.endswith("_fn") and key[:-3] in KEY_INDEXES):
+                raise ValueError(f"Error: Key {key} is not valid.")
+            if mapped_key not in KEY_CODES_SORTED:
+                raise ValueError(f"Error: Mapped key {mapped_key} of key {key} is not valid.")
+
+# Check if a value is a 6 digit hex color
+def is_color_code(value):
+    if not isinstance(value, str) or len(value) != 6:
+        return False
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        return False
+    return True
+
+# Run newline-delimited JSON commands from a file object, as they come in, over a single keyboard session.
+# Goes through the daemon if one is running and use_daemon is set. Returns (line number, command name, seconds taken, error) for each command.
+def run_batch(input_file, use_daemon = True):
+    through_daemon = use_daemon and send_daemon_command({"command": "ping"}) != None
+    results = []
+
+    for line_number, line in enumerate(input_file, 1):
+        if len(line.strip()) < 1:
+            continue
+
+        command_start = time.perf_counter()
+        command_name = None
+        try:
+            command = json.loads(line)
+            if isinstance(command, dict):
+                command_name = command.get("command")
+            validate_command(command, True)
+            if command_name == "sleep":
+                time.sleep(command["seconds"])
+            elif command_name in ("ping", "trace") and not through_daemon:
+                pass  # Only the daemon has anything to answer these with
+            elif through_daemon:
+                # The daemon runs from its own working directory
+                if command_name == "load_config":
+                    command["path"] = os.path.abspath(command["path"])
+                reply = send_daemon_command(command)
+                if reply is None:
+                    raise RuntimeError("The daemon stopped responding.")
+                if not reply["ok"]:
+                    raise RuntimeError(reply["error"])
+            else:
+                run_plan(plan_upload(get_command_packet_groups(command), get_session().shadow_packets))
+            error = None
+        except (ValueError, RuntimeError, OSError) as e:
+            # Drop the handle after a failed transfer, so the next command starts with a fresh one
+            if isinstance(e, RuntimeError) and not through_daemon:
+                get_session().device = None
+            error = e
+        results.append((line_number, command_name, time.perf_counter() - command_start, error))
+
+    return results
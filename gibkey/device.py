@@ -0,0 +1,317 @@
+# Connection to a GIBKEY G68: finding keyboards and opening a reusable, thread-safe handle to one of them.
+# A simulated keyboard can stand in for the real one, for testing without hardware.
+import errno
+import os
+import random
+import threading
+import time
+
+from gibkey.packets import (
+    KEY_CODES_SORTED, KEY_NAMES_BY_CODE, PACKET_LENGTH, PATTERN_HEADER, KEY_MAP_HEADER, KEY_RGB_HEADER, RGB_PATTERNS,
+    encode_pattern_packet, encode_key_rgb_packets, encode_key_map_packets,
+)
+
+# Constants for vendor and product IDs
+VENDOR_ID = 0x258A
+PRODUCT_ID = 0x0049
+
+# Pause after each packet when writing several, in seconds. The keyboard drops packets that come in too fast.
+DEFAULT_WRITE_GAP = 0.1
+
+# Write timeout, in milliseconds
+DEFAULT_WRITE_TIMEOUT = 1500
+
+usb = None
+fake_devices = None
+
+# Load libusb from a local file. Only needed on Windows, elsewhere pyusb finds the system's libusb.
+def load_libusb():
+    import os, sys
+    if sys.platform != "win32":
+        return None
+    from ctypes import CDLL
+
+    # Load the DLL from the base path where the script/exe is located
+    if getattr(sys, 'frozen', False):  # Check if running from PyInstaller's bundle
+        base_path = os.path.dirname(sys.executable)  # Path to the executable
+    else:
+        base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # Path to the script, next to this package
+    
+    # Define the DLL path in the original directory
+    dll_path = os.path.join(base_path, 'libusb-1.0.dll')
+
+    # Try loading the DLL from the original directory (where the .exe/.py is located)
+    if os.path.isfile(dll_path):
+        try:
+            # Load the DLL and reurn without error
+            CDLL(dll_path)
+            return None
+        except OSError as e:
+            return f"Error loading DLL from : {e}"
+    else:
+        return "libusb-1.0.dll not found."
+
+# Import pyusb. Only done once a keyboard is actually needed.
+def import_usb():
+    global usb
+    if usb is None:
+        import usb.core
+        import usb.util
+    return usb
+
+# Find every connected keyboard. backend is "usb", or "fake" for the simulated ones.
+def find_devices(backend = "usb"):
+    if backend == "fake":
+        return [fake for fake in get_fake_devices() if fake.present]
+    import_usb()
+    error_message = load_libusb()
+    if error_message != None:
+        raise ValueError(error_message)
+    return list(usb.core.find(find_all=True, idVendor=VENDOR_ID, idProduct=PRODUCT_ID))
+
+# Get the serial number of a keyboard, or "unknown" if it can't be read
+def get_device_serial(device):
+    if isinstance(device, FakeDevice):
+        return device.serial
+    serial = "unknown"
+    try:
+        if device.iSerialNumber:
+            serial = usb.util.get_string(device, device.iSerialNumber)
+    except (usb.core.USBError, ValueError):
+        pass
+    return serial
+
+# A GIBKEY G68 keyboard. The handle stays open from open() to close(), so it can be reused for any number of changes, and can be used as a context manager:
+#
+#     with G68Device() as keyboard:
+#         keyboard.set_pattern("wave", brightness=80)
+#
+# Writes are serialized by a lock, so the keyboard can be shared between threads. Hold the lock to send several packets without other threads' packets in between.
+class G68Device:
+    def __init__(self, usb_device = None, backend = "usb"):
+        self.usb_device = usb_device        # Keyboard to open, None picks the first one found
+        self.backend = backend              # "usb", or "fake" for a simulated keyboard
+        self.device = None                  # Open keyboard handle
+        self.out_endpoint = None
+        self.serial = None                  # Serial number, to find the keyboard again after a replug
+        self.lock = threading.RLock()       # Held while writing
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Check if the keyboard is open
+    def is_open(self):
+        return self.device != None
+
+    # Open the keyboard, unless it's open already. Raises a ValueError if it can't be found or set up. Returns the device.
+    def open(self):
+        with self.lock:
+            if self.device != None:
+                return self
+            if self.backend == "fake":
+                self.open_fake()
+            elif self.backend == "usb":
+                self.open_usb()
+            else:
+                raise ValueError(f"Unknown backend: {self.backend}")
+        return self
+
+    # Open a real keyboard over USB, through the OUT endpoint of its MI_02 interface
+    def open_usb(self):
+        import_usb()
+        error_message = load_libusb()
+        if error_message != None:
+            raise ValueError(error_message)
+        device = self.usb_device
+        if device is None:
+            device = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
+        if device is None:
+            raise ValueError("ERROR: Device not found.\n\nMake sure that the keyboard is connected via a USB cable and is set to wired mode.")
+        device.set_configuration()
+
+        mi_02_interface = None
+        for cfg in device:
+            for intf in cfg:
+                if intf.bInterfaceNumber == 2:  # MI_02 is interface number 2
+                    mi_02_interface = intf
+                    break
+            if mi_02_interface:
+                break
+
+        # Ensure we found the MI_02 interface
+        if mi_02_interface is None:
+            raise ValueError("MI_02 interface not found")
+
+        # Select the OUT endpoint of the MI_02 interface
+        out_endpoint = None
+        for ep in mi_02_interface:
+            ep_address = ep.bEndpointAddress
+            if usb.util.endpoint_direction(ep_address) == usb.util.ENDPOINT_OUT:
+                out_endpoint = ep
+                break
+
+        # Ensure we found the OUT endpoint
+        if out_endpoint is None:
+            raise ValueError("OUT endpoint for MI_02 not found")
+
+        self.device = device
+        self.out_endpoint = out_endpoint
+        self.serial = get_device_serial(device)
+
+    # Open a simulated keyboard. A replugged one is the same FakeDevice, so it keeps its settings just like a real keyboard.
+    def open_fake(self):
+        fakes = [self.usb_device] if self.usb_device != None else get_fake_devices()
+        fakes = [fake for fake in fakes if fake.present]
+        if len(fakes) < 1:
+            raise ValueError("ERROR: Device not found.")
+        self.device = fakes[0]
+        self.out_endpoint = FakeEndpoint()
+        self.serial = self.device.serial
+
+    # Release the keyboard handle. It can be opened again later.
+    def close(self):
+        with self.lock:
+            if self.device != None and not isinstance(self.device, FakeDevice):
+                try:
+                    usb.util.dispose_resources(self.device)
+                except usb.core.USBError:
+                    pass  # Already gone
+            self.device = None
+
+    # Write a single packet. Raises pyusb's USBError if the transfer fails.
+    def write(self, packet, timeout = DEFAULT_WRITE_TIMEOUT):
+        with self.lock:
+            if self.device is None:
+                raise ValueError("The keyboard isn't open.")
+            return self.device.write(self.out_endpoint.bEndpointAddress, packet, timeout=timeout)
+
+    # Write packets that belong together, like the chunks of a table, pausing for gap seconds after each one
+    def write_packets(self, packets, gap = DEFAULT_WRITE_GAP, timeout = DEFAULT_WRITE_TIMEOUT):
+        with self.lock:
+            for packet in packets:
+                self.write(packet, timeout)
+                time.sleep(gap)
+
+    # Set the light pattern
+    def set_pattern(self, pattern, brightness = 50, speed = 3, direction = 0, color = "default"):
+        self.write_packets([encode_pattern_packet(RGB_PATTERNS[pattern], brightness, speed, direction, color)])
+
+    # Set the color of individual keys, switching to the custom pattern that shows them
+    def set_keys_color(self, key_color, brightness = 50, speed = 3, direction = 0):
+        with self.lock:
+            self.write_packets([encode_pattern_packet(RGB_PATTERNS["custom"], brightness, speed, direction, "000000")])
+            self.write_packets(encode_key_rgb_packets(key_color))
+
+    # Set individual key mappings
+    def set_key_map(self, key_map):
+        self.write_packets(encode_key_map_packets(key_map))
+
+# Simulated G68 that stands in for the real keyboard, so uploads can be tested and benchmarked without hardware.
+# It validates every packet like the keyboard would, and rebuilds the per-key RGB and keymap tables from the chunks it receives.
+class FakeDevice:
+    iSerialNumber = 0
+
+    def __init__(self, latency = 0.0, error_rate = 0.0, errors = None, address = 1, serial = "FAKE0"):
+        self.bus = 1                            # Where the keyboard is plugged in, like pyusb's Device
+        self.address = address
+        self.serial = serial
+        self.present = True                     # Whether it's plugged in. Unplugged, it fails every write and can't be found.
+        self.latency = latency                  # Time each write takes (seconds)
+        self.error_rate = error_rate            # Chance of a write timing out, like on a keyboard that can't keep up
+        self.errors = list(errors or [])        # Errnos to fail the next writes with, in order. None lets a write through.
+        self.packets = []                       # Every packet accepted, in order
+        self.payloads = {KEY_RGB_HEADER: bytearray(), KEY_MAP_HEADER: bytearray()}
+        self.pattern = None
+        import_usb()                            # Failed writes raise pyusb's errors
+
+    # Accept a packet, the same way pyusb's Device.write does
+    def write(self, endpoint, data, timeout = None):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if not self.present:
+            raise usb.core.USBError(os.strerror(errno.ENODEV), errno=errno.ENODEV)
+        if self.errors:
+            error = self.errors.pop(0)
+            if error != None:
+                raise usb.core.USBError(os.strerror(error), errno=error)
+        elif self.error_rate > 0 and random.random() < self.error_rate:
+            raise usb.core.USBError("Simulated transfer timeout", errno=errno.ETIMEDOUT)
+
+        data = bytes(data)
+        header = data[0:3]
+        if len(data) != PACKET_LENGTH:
+            raise ValueError(f"Invalid packet length {len(data)}")
+        if header not in (PATTERN_HEADER, KEY_MAP_HEADER, KEY_RGB_HEADER):
+            raise ValueError(f"Unknown packet header {header.hex()}")
+        if data[3] != sum(data[4:]) % 0x100:
+            raise ValueError(f"Invalid packet checksum {data[3]:02x}")
+
+        # Store the pattern, or place the chunk at its offset in the table it belongs to
+        if header == PATTERN_HEADER:
+            self.pattern = {"pattern": data[10], "brightness": data[11], "speed": data[12], "direction": data[13], "color": "default" if data[14] else data[16:19].hex()}
+        else:
+            length = data[4]
+            offset = data[5] + data[6] * 0x100
+            payload = self.payloads[header]
+            if len(payload) < offset + length:
+                payload.extend(bytes(offset + length - len(payload)))
+            payload[offset:offset + length] = data[8:8 + length]
+        self.packets.append(data)
+        return len(data)
+
+    # Get the color of every key, as uploaded
+    def get_key_colors(self):
+        payload = self.payloads[KEY_RGB_HEADER]
+        key_colors = {}
+        for index, key in enumerate(KEY_CODES_SORTED):
+            if len(payload) >= index * 3 + 3:
+                key_colors[key] = payload[index * 3:index * 3 + 3].hex()
+        return key_colors
+
+    # Get the mapping of every key (and its FN layer as key_fn), as uploaded
+    def get_key_map(self):
+        payload = self.payloads[KEY_MAP_HEADER]
+
+        # Each entry is 10 00 followed by a key code. Function codes take 3 bytes and may come without the 10 00 divider.
+        codes = []
+        index = 0
+        while index + 1 < len(payload) and len(codes) < len(KEY_CODES_SORTED) * 2:
+            if payload[index] == 0x10 and payload[index + 1] == 0x00:
+                index += 2
+                if index >= len(payload):
+                    break
+            if payload[index] == 0xF0:
+                codes.append(int.from_bytes(payload[index:index + 3], "big"))
+                index += 3
+            else:
+                codes.append(payload[index])
+                index += 1
+
+        key_map = {}
+        for index, key in enumerate(KEY_CODES_SORTED):
+            if index * 2 + 1 < len(codes):
+                key_map[key] = KEY_NAMES_BY_CODE.get(codes[index * 2])
+                key_map[f"{key}_fn"] = KEY_NAMES_BY_CODE.get(codes[index * 2 + 1])
+        return key_map
+
+# Stand-in for the OUT endpoint of the fake device
+class FakeEndpoint:
+    bEndpointAddress = 0x02
+
+# Get the simulated keyboards. Settings come from GIBKEY_FAKE_DEVICES (count), GIBKEY_FAKE_LATENCY (ms) and GIBKEY_FAKE_ERROR_RATE (0-1).
+def get_fake_devices():
+    global fake_devices
+    if fake_devices is None:
+        count = int(os.environ.get("GIBKEY_FAKE_DEVICES", 1))
+        latency = float(os.environ.get("GIBKEY_FAKE_LATENCY", 0)) / 1000
+        error_rate = float(os.environ.get("GIBKEY_FAKE_ERROR_RATE", 0))
+        fake_devices = [FakeDevice(latency, error_rate, address=index + 1, serial=f"FAKE{index}") for index in range(count)]
+    return fake_devices
+
+# Forget the simulated keyboards, so the next lookup connects fresh ones
+def reset_fake_devices():
+    global fake_devices
+    fake_devices = None
@@ -0,0 +1,165 @@
+# Per-key color frames and the RGB effects that build them, for streaming to the keyboard.
+# Frames are backed by NumPy arrays when NumPy is installed, and by plain bytearrays otherwise.
+import math
+import random
+
+from gibkey.layout import KEYBOARD_LAYOUT, KEY_WIDTH, SPECIAL_KEY_WIDTHS, get_key_id
+from gibkey.packets import KEY_CODES_SORTED, KEY_INDEXES, color_to_bytes, encode_key_rgb_data, encode_key_rgb_chunks, encode_key_rgb_packets
+
+numpy = None
+numpy_loaded = False
+
+# Import NumPy the first time frames need it. NumPy is optional, frames fall back to plain bytearrays without it.
+def load_numpy():
+    global numpy, numpy_loaded
+    if not numpy_loaded:
+        numpy_loaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+# Colors of every key, in KEY_CODES_SORTED order. Backed by an (N, 3) uint8 NumPy array, or a flat bytearray without NumPy.
+class KeyFrame:
+    def __init__(self, colors = None):
+        if colors is None:
+            colors = bytearray(len(KEY_CODES_SORTED) * 3)
+        elif not isinstance(colors, bytearray) and not (load_numpy() is not None and isinstance(colors, numpy.ndarray)):
+            colors = bytearray(colors)      # Copied, so frames made from bytes can be written to
+        if load_numpy() is not None:
+            colors = numpy.frombuffer(colors, numpy.uint8).reshape(-1, 3) if not isinstance(colors, numpy.ndarray) else colors
+        self.colors = colors
+
+    # Get the raw 550b00 payload. It's only copied if the colors aren't contiguous in memory, e.g. a slice of a bigger array.
+    def get_payload(self):
+        if load_numpy() is not None:
+            return memoryview(numpy.ascontiguousarray(self.colors)).cast("B")
+        return memoryview(self.colors)
+
+    # Set the color of a single key
+    def set_key_color(self, key, color):
+        index = KEY_INDEXES[key]
+        # Written to the colors themselves, since the payload can be a copy
+        if load_numpy() is not None:
+            color_array = numpy.frombuffer(color_to_bytes(color), numpy.uint8)
+            if self.colors.ndim == 1:
+                self.colors[index * 3:index * 3 + 3] = color_array
+            else:
+                self.colors[index] = color_array
+            return
+        self.get_payload()[index * 3:index * 3 + 3] = color_to_bytes(color)
+
+    # Convert the frame to a key_color dict
+    def to_key_color(self):
+        payload = self.get_payload()
+        key_color = {}
+        for index, key in enumerate(KEY_CODES_SORTED):
+            key_color[key] = payload[index * 3:index * 3 + 3].hex()
+        return key_color
+
+# Create a frame from a key_color dict
+def key_color_to_frame(key_color):
+    return KeyFrame(bytearray(encode_key_rgb_data(key_color)))
+
+# Encode the per-key RGB packets of a KeyFrame or key_color dict
+def encode_frame_packets(frame):
+    if isinstance(frame, KeyFrame):
+        return encode_key_rgb_chunks(frame.get_payload())
+    return encode_key_rgb_packets(frame)
+
+# Get the position of each key on the layout, in key widths, in KEY_CODES_SORTED order. Keys not on the layout get None.
+key_positions = None
+def get_key_positions():
+    global key_positions
+    if key_positions is None:
+        layout_positions = {}
+        for row_index, row in enumerate(KEYBOARD_LAYOUT):
+            x = 0
+            for key in row:
+                width = SPECIAL_KEY_WIDTHS.get(key, KEY_WIDTH) / KEY_WIDTH
+                layout_positions[get_key_id(key)] = (x + width / 2, row_index + 0.5)
+                x += width
+        key_positions = [layout_positions.get(key) for key in KEY_CODES_SORTED]
+    return key_positions
+
+# Get the key positions as NumPy arrays of x and y. Keys not on the layout are NaN.
+def get_key_position_arrays():
+    positions = [position if position != None else (math.nan, math.nan) for position in get_key_positions()]
+    positions = numpy.array(positions, numpy.float64)
+    return (positions[:, 0], positions[:, 1])
+
+# Create a frame blending from start_color to end_color by a per-key weight (0-1). Keys without a weight are left black.
+def blend_frame(weights, start_color, end_color):
+    start = color_to_bytes(start_color)
+    end = color_to_bytes(end_color)
+
+    if load_numpy() is not None:
+        weights = numpy.clip(numpy.asarray(weights, numpy.float64), 0, 1)[:, None]
+        start_array = numpy.array(list(start), numpy.float64)
+        end_array = numpy.array(list(end), numpy.float64)
+        colors = numpy.floor(start_array + (end_array - start_array) * weights + 0.5)
+        colors[numpy.isnan(weights[:, 0])] = 0
+        return KeyFrame(colors.astype(numpy.uint8))
+
+    colors = bytearray(len(KEY_CODES_SORTED) * 3)
+    for index, weight in enumerate(weights):
+        if weight is None:
+            continue
+        weight = min(max(weight, 0), 1)
+        for channel in range(3):
+            colors[index * 3 + channel] = math.floor(start[channel] + (end[channel] - start[channel]) * weight + 0.5)
+    return KeyFrame(colors)
+
+# Horizontal gradient from start_color on the left to end_color on the right
+def effect_gradient(start_color, end_color):
+    width = max(position[0] for position in get_key_positions() if position != None)
+    if load_numpy() is not None:
+        x, y = get_key_position_arrays()
+        return blend_frame(x / width, start_color, end_color)
+    return blend_frame([position[0] / width if position != None else None for position in get_key_positions()], start_color, end_color)
+
+# Sine wave moving across the keyboard. t is the time in seconds, speed in waves per second and wavelength in key widths.
+def effect_wave(color, t, speed = 1.0, wavelength = 8.0):
+    if load_numpy() is not None:
+        x, y = get_key_position_arrays()
+        return blend_frame((numpy.sin(2 * math.pi * (x / wavelength - speed * t)) + 1) / 2, "000000", color)
+    weights = []
+    for position in get_key_positions():
+        weights.append((math.sin(2 * math.pi * (position[0] / wavelength - speed * t)) + 1) / 2 if position != None else None)
+    return blend_frame(weights, "000000", color)
+
+# All keys fading in and out. period is the length of one breath in seconds.
+def effect_breathe(color, t, period = 2.0):
+    weight = (1 - math.cos(2 * math.pi * t / period)) / 2
+    if load_numpy() is not None:
+        x, y = get_key_position_arrays()
+        return blend_frame(numpy.where(numpy.isnan(x), math.nan, weight), "000000", color)
+    return blend_frame([weight if position != None else None for position in get_key_positions()], "000000", color)
+
+# Ring spreading out from a key. speed is in key widths per second and width is the thickness of the ring.
+def effect_ripple(key, color, t, speed = 10.0, width = 2.0):
+    center_x, center_y = get_key_positions()[KEY_INDEXES[key]]
+    radius = speed * t
+    if load_numpy() is not None:
+        x, y = get_key_position_arrays()
+        distance = numpy.hypot(x - center_x, y - center_y)
+        return blend_frame(1 - numpy.abs(distance - radius) / width, "000000", color)
+    weights = []
+    for position in get_key_positions():
+        if position != None:
+            distance = math.hypot(position[0] - center_x, position[1] - center_y)
+            weights.append(1 - abs(distance - radius) / width)
+        else:
+            weights.append(None)
+    return blend_frame(weights, "000000", color)
+
+# Random brightness of the given color on each key, or fully random colors without one
+def effect_noise(color = None, seed = None):
+    # Drawn in one block, shared by the NumPy and plain paths, so a seed always gives the same frame
+    values = random.Random(seed).randbytes(len(KEY_CODES_SORTED) * (3 if color is None else 1))
+    if color is None:
+        return KeyFrame(bytearray(values))
+    if load_numpy() is not None:
+        return blend_frame(numpy.frombuffer(values, numpy.uint8) / 255, "000000", color)
+    return blend_frame([value / 255 for value in values], "000000", color)
@@ -0,0 +1,48 @@
+# Physical layout of the G68, as shown on the GUI. Also used to place keys for the RGB effects.
+
+# Key ids of the GUI labels that aren't just the lowercase label
+KEY_LABEL_IDS = {
+    'esc': 'escape',
+    '\\': 'backslash',
+    '/': 'slash',
+    '~': 'tilde',
+    'pu': 'pageup',
+    'pd': 'pagedown',
+    ',': 'comma',
+    '.': 'period',
+    '[': 'lbracket',
+    ']': 'rbracket',
+    '-': 'dash',
+    '=': 'equals',
+    ';': 'semicolon',
+    'del': 'delete',
+    "'": 'quote',
+}
+
+# Keyboard layout, as shown on the GUI. Widths are in GUI text units.
+KEYBOARD_LAYOUT = [
+    ["Esc", "1", "2", "3", "4", "5", "6", "7", "8", "9", "0", "-", "=", "Backspace", "~"],
+    ["Tab", "Q", "W", "E", "R", "T", "Y", "U", "I", "O", "P", "[", "]", "\\", "Del"],
+    ["CapsLock", "A", "S", "D", "F", "G", "H", "J", "K", "L", ";", "'", "Enter", "PU"],
+    ["LShift", "Z", "X", "C", "V", "B", "N", "M", ",", ".", "/", "RShift", "Up", "PD"],
+    ["LCtrl", "LWin", "LAlt", "Space", "RAlt", "Fn", "RCtrl", "Left", "Down", "Right"]
+]
+KEY_WIDTH = 5
+SPECIAL_KEY_WIDTHS = {
+    "Backspace": 2 * (KEY_WIDTH) - 1,
+    "Tab": 1.5 * (KEY_WIDTH),
+    "\\": 1.5 * (KEY_WIDTH),
+    "CapsLock": 1.75 * (KEY_WIDTH) + 1,
+    "LShift": 2 * (KEY_WIDTH) + 1,
+    "Space": 8 * (KEY_WIDTH) + 2,
+    "Enter": 2.5 * (KEY_WIDTH),
+    "RShift": 1.75 * (KEY_WIDTH) + 2,
+    "LCtrl": 1.25 * (KEY_WIDTH),
+    "LWin": 1.25 * (KEY_WIDTH),
+    "LAlt": 1.25 * (KEY_WIDTH) + 1
+}
+
+# Get a key id from its name
+def get_key_id(key_name):
+    key_name = key_name.lower()
+    return KEY_LABEL_IDS.get(key_name, key_name)
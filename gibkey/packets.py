@@ -0,0 +1,402 @@
+# Key tables and packet encoding of the GIBKEY G68. Nothing in here talks to the keyboard, it only builds the packets to send.
+
+RGB_PATTERNS = {
+    'custom': 0,
+    'runner_light': 1,
+    'static': 3,
+    'breathe': 4,
+    'flower': 5,
+    'wave': 6,
+    'wave_vertical': 7,
+    'bubbler': 8,
+    'wave_light': 9,
+    'vortex': 10,
+    'wave_bar': 22,
+    'sea_wave': 12,
+    'ripple': 13,
+    'star': 20,
+    'single': 15,
+    'cell': 16
+}
+
+KEY_CODES_SORTED = {
+    'escape': 0x29,
+    'tilde': 0x35,
+    'tab': 0x2B,
+    'capslock': 0x39,
+    'lshift': 0xE1,
+    'lctrl': 0xE0,
+    'f1': 0x3A,
+    '1': 0x1E,
+    'q': 0x14,
+    'a': 0x04,
+    'z': 0x1D,
+    'lwin': 0xE3,
+    'f2': 0x3B,
+    '2': 0x1F,
+    'w': 0x1A,
+    's': 0x16,
+    'x': 0x1B,
+    'lalt': 0xE2,
+    'f3': 0x3C,
+    '3': 0x20,
+    'e': 0x08,
+    'd': 0x07,
+    'c': 0x06,
+    'unknown1': 0x00,
+    'f4': 0x3D,
+    '4': 0x21,
+    'r': 0x15,
+    'f': 0x09,
+    'v': 0x19,
+    'unknown2': 0x00,
+    'f5': 0x3E,
+    '5': 0x22,
+    't': 0x17,
+    'g': 0x0A,
+    'b': 0x05,
+    'space': 0x2C,
+    'f6': 0x3F,
+    '6': 0x23,
+    'y': 0x1C,
+    'h': 0x0B,
+    'n': 0x11,
+    'unknown3': 0x00,
+    'f7': 0x40,
+    '7': 0x24,
+    'u': 0x18,
+    'j': 0x0D,
+    'm': 0x10,
+    'unknown4': 0x00,
+    'f8': 0x41,
+    '8': 0x25,
+    'i': 0x0C,
+    'k': 0x0E,
+    'comma': 0x36,
+    'unknown5': 0x00,
+    'f9': 0x42,
+    '9': 0x26,
+    'o': 0x12,
+    'l': 0x0F,
+    'period': 0x37,
+    'unknown6': 0x00,
+    'f10': 0x43,
+    '0': 0x27,
+    'p': 0x13,
+    'semicolon': 0x33,
+    'slash': 0x38,
+    'ralt': 0xE6,
+    'f11': 0x44,
+    'dash': 0x2D,
+    'lbracket': 0x2F,
+    'quote': 0x34,
+    'unknown7': 0x00,
+    'unknown8': 0x00,
+    'f12': 0x45,
+    'equals': 0x2E,
+    'rbracket': 0x30,
+    'unknown9': 0x00,
+    'rshift': 0xE5,
+    'fn': 0x00,
+    'unknown10': 0x00,
+    'backspace': 0x2A,
+    'backslash': 0x31,
+    'enter': 0x28,
+    'unknown11': 0x00,
+    'rctrl': 0xE4,
+    'unknown12': 0x00,
+    'unknown13': 0x00,
+    'delete': 0x4C,
+    'unknown14': 0x00,
+    'unknown15': 0x00,
+    'left': 0x50,
+    'unknown16': 0x00,
+    'print_screen': 0x46,
+    'pause': 0x48,
+    'scroll_lock': 0x47,
+    'up': 0x52,
+    'down': 0x51,
+    'insert': 0x49,
+    'pageup': 0x4B,
+    'pagedown': 0x4E,
+    'home': 0x4A,
+    'end': 0x4D,
+    'right': 0x4F,
+    'function_toggle_rgb': 0xf03c00,
+    'function_swap_wasd': 0xF00300,
+    'function_change_keyboard_index': 0xF05200,
+    'function_change_rgb_color': 0xf02b00,
+    'function_change_rgb_pattern': 0xf01000,
+    'function_increase_rgb_brightness': 0xf02500,
+    'function_decrease_rgb_brightness': 0xf02600,
+    'function_make_rgb_faster': 0xf02700,
+    'function_make_rgb_slower': 0xf01800,
+    'function_toggle_charging_light': 0xf05100,
+    'function_bt_matching_2': 0xf04002,
+    'function_bt_matching_3': 0xf04003,
+    'function_reset_settings': 0xf02c00,
+    'function_bt_matching_1': 0xf04001,
+    'function_mac_mode': 0xf00500,
+    'function_windows_mode': 0xf00600,
+    'function_enter_wired_mode': 0xf04004,
+    'function_enter_wireless_mode': 0xf04000,
+}
+
+# Default FN layer key of each key that has one
+DEFAULT_FN_KEYS = {
+    '1': 'f1',
+    '2': 'f2',
+    '3': 'f3',
+    '4': 'f4',
+    '5': 'f5',
+    '6': 'f6',
+    '7': 'f7',
+    '8': 'f8',
+    '9': 'f9',
+    '0': 'f10',
+    'dash': 'f11',
+    'equals': 'f12',
+    'rbracket': 'end',
+    'lbracket': 'home',
+    'delete': 'insert',
+    'pageup': 'pause',
+    'pagedown': 'scroll_lock',
+    'tilde': 'print_screen',
+    'p': 'function_toggle_rgb',
+    'left': 'function_make_rgb_slower',
+    'right': 'function_make_rgb_faster',
+    'up': 'function_increase_rgb_brightness',
+    'down': 'function_decrease_rgb_brightness',
+    'backslash': 'function_change_rgb_pattern',
+    'tab': 'function_change_rgb_color',
+    'w': 'function_swap_wasd',
+    'space': 'function_change_keyboard_index',
+    'l': 'function_toggle_charging_light',
+    'e': 'function_bt_matching_1',
+    'r': 'function_bt_matching_2',
+    't': 'function_bt_matching_3',
+    'escape': 'function_reset_settings',
+    'period': 'function_mac_mode',
+    'comma': 'function_windows_mode',
+    'y': 'function_enter_wired_mode',
+    'q': 'function_enter_wireless_mode',
+}
+
+# Lookup tables, built once from the key codes
+KEY_INDEXES = {key: index for index, key in enumerate(KEY_CODES_SORTED)}
+FUNCTION_KEYS = frozenset(key for key in KEY_CODES_SORTED if "function" in key)
+UNKNOWN_KEYS = frozenset(key for key in KEY_CODES_SORTED if "unknown" in key)
+USABLE_KEYS = tuple(key for key in KEY_CODES_SORTED if key not in FUNCTION_KEYS and key not in UNKNOWN_KEYS)
+KEY_NAMES_BY_CODE = {}
+for key, code in KEY_CODES_SORTED.items():
+    KEY_NAMES_BY_CODE.setdefault(code, key)
+
+# Packet layout shared by every command sent to the keyboard
+PACKET_LENGTH = 0x40
+CHUNK_LENGTH = 0x38
+PATTERN_HEADER = b"\x55\x06\x00"
+KEY_MAP_HEADER = b"\x55\x09\x00"
+KEY_RGB_HEADER = b"\x55\x0b\x00"
+PATTERN_TEMPLATE = bytes.fromhex("2000000002aa" + "00" * 9 + "0000ff00000400000100000000ffffffffffffffff" + "00" * 24)
+BLACK_RGB = b"\x00\x00\x00"
+RGB_KEY_ORDER = tuple(KEY_CODES_SORTED)
+RGB_DATA_LENGTH = len(RGB_KEY_ORDER) * 3
+RGB_CHUNK_COUNT = -(-RGB_DATA_LENGTH // CHUNK_LENGTH)
+RGB_PADDING = bytes(RGB_CHUNK_COUNT * CHUNK_LENGTH - RGB_DATA_LENGTH)
+# Bytes 4-7 of each RGB packet (chunk length and offset), with their share of the checksum
+RGB_CHUNK_PREFIXES = tuple((bytes((CHUNK_LENGTH, offset % 0x100, offset // 0x100, 0)), CHUNK_LENGTH + offset % 0x100 + offset // 0x100) for offset in range(0, RGB_CHUNK_COUNT * CHUNK_LENGTH, CHUNK_LENGTH))
+# Maximum number of per-key colors written over a copy of the 'all' table. Fuller tables are joined in one go.
+SPARSE_KEY_COLORS = 8
+
+# Convert a hex color to its 3 raw bytes, caching the result since the same few colors are used over and over
+color_bytes_cache = {}
+def color_to_bytes(color):
+    color_bytes = color_bytes_cache.get(color)
+    if color_bytes is None:
+        color_bytes = bytes.fromhex(color)
+        if len(color_bytes) != 3:
+            raise ValueError("Color value is invalid")
+        color_bytes_cache[color] = color_bytes
+    return color_bytes
+
+# Convert a key code to bytes. Function codes take up 3 bytes, regular keys just 1.
+def key_code_to_bytes(key_code):
+    return key_code.to_bytes(max(1, (key_code.bit_length() + 7) // 8), "big")
+
+# Split raw data into ready-to-send packets. The checksum is added up while each chunk is written into the buffer.
+def encode_chunked_packets(data, header):
+    chunk_count = -(-len(data) // CHUNK_LENGTH)
+    buffer = bytearray(chunk_count * PACKET_LENGTH)
+    view = memoryview(buffer)
+    data_view = memoryview(data)
+
+    packets = []
+    for index in range(chunk_count):
+        offset = index * CHUNK_LENGTH
+        packet = view[index * PACKET_LENGTH:(index + 1) * PACKET_LENGTH]
+        packet[0:3] = header
+        packet[4] = CHUNK_LENGTH
+        packet[5] = offset % 0x100
+        packet[6] = offset // 0x100
+        part = data_view[offset:offset + CHUNK_LENGTH]
+        packet[8:8 + len(part)] = part
+        packet[3] = (CHUNK_LENGTH + packet[5] + packet[6] + sum(part)) % 0x100
+        packets.append(bytes(packet))
+
+    return packets
+
+# Encode the pattern packet
+def encode_pattern_packet(pattern_int, brightness_int, speed_int, direction_val, color):
+    packet = bytearray(PACKET_LENGTH)
+    packet[0:3] = PATTERN_HEADER
+    packet[4:] = PATTERN_TEMPLATE
+
+    # Set direction value
+    if direction_val == "normal":
+        direction_val = 0
+    elif direction_val == "reverse":
+        direction_val = 1
+
+    # Fill in the pattern values
+    use_default_color = int(color == "default")
+    if use_default_color:
+        color = "ffffff"
+    if len(color) != 6:
+        raise ValueError("Color value is invalid")
+    packet[10] = pattern_int
+    packet[11] = brightness_int
+    packet[12] = speed_int
+    packet[13] = direction_val
+    packet[14] = use_default_color
+    packet[16:19] = color_to_bytes(color)
+    packet[3] = sum(memoryview(packet)[4:]) % 0x100
+
+    return bytes(packet)
+
+# Get the whole RGB table in a single color, used as the base of sparse tables
+fallback_rgb_cache = {}
+def get_fallback_rgb_data(color):
+    data = fallback_rgb_cache.get(color)
+    if data is None:
+        data = color_to_bytes(color) * len(RGB_KEY_ORDER)
+        fallback_rgb_cache[color] = data
+    return data
+
+# Encode the per-key RGB table, in RGB_KEY_ORDER. Keys without a color of their own get 'all', or black.
+def encode_key_rgb_data(key_color):
+    fallback = key_color.get("all", "000000")
+    if len(key_color) <= SPARSE_KEY_COLORS:
+        data = get_fallback_rgb_data(fallback)
+        if len(key_color) == ("all" in key_color):
+            return data
+        data = bytearray(data)
+        for key, color in key_color.items():
+            index = KEY_INDEXES.get(key)
+            if index is not None:
+                data[index * 3:index * 3 + 3] = color_to_bytes(color)
+        return bytes(data)
+
+    # Every color is checked for length first, since a short one would shift the rest of the joined table
+    if set(map(len, key_color.values())) - {6}:
+        raise ValueError("Color value is invalid")
+    get = key_color.get
+    return bytes.fromhex("".join([get(key, fallback) for key in RGB_KEY_ORDER]))
+
+# Split an RGB table into ready-to-send packets, building each packet in one go from the prepared chunk prefixes
+def encode_key_rgb_chunks(data):
+    if len(data) != RGB_DATA_LENGTH:
+        return encode_chunked_packets(data, KEY_RGB_HEADER)
+    data = bytes(data) + RGB_PADDING
+    packets = []
+    for index, (prefix, prefix_sum) in enumerate(RGB_CHUNK_PREFIXES):
+        part = data[index * CHUNK_LENGTH:(index + 1) * CHUNK_LENGTH]
+        packets.append(KEY_RGB_HEADER + bytes(((prefix_sum + sum(part)) % 0x100,)) + prefix + part)
+    return packets
+
+# Encode the packets for individual key RGB
+def encode_key_rgb_packets(key_color):
+    return encode_key_rgb_chunks(encode_key_rgb_data(key_color))
+
+# Encode a single key map entry, for the main or FN layer
+def encode_key_map_entry(mapped_key, divider = True):
+    entry = key_code_to_bytes(KEY_CODES_SORTED[mapped_key])
+    if divider:
+        entry = b"\x10\x00" + entry
+    return entry
+
+# Get the default key map entries of each slot, as [main layer, FN layer] pairs
+def get_default_key_map_entries():
+    entries = []
+    for key in KEY_CODES_SORTED:
+        # Functions are ignored on the main layer, and written without the divider on the FN layer
+        mapped_key = "unknown1" if key in FUNCTION_KEYS else key
+        fn_mapped_key = DEFAULT_FN_KEYS.get(key, key)
+        entries.append((encode_key_map_entry(mapped_key), encode_key_map_entry(fn_mapped_key, fn_mapped_key not in FUNCTION_KEYS)))
+    return tuple(entries)
+
+# Get the offset of each default key map entry in the payload, in the same layout as DEFAULT_KEY_MAP_ENTRIES
+def get_default_key_map_offsets():
+    offsets = []
+    offset = 0
+    for main_entry, fn_entry in DEFAULT_KEY_MAP_ENTRIES:
+        offsets.append((offset, offset + len(main_entry)))
+        offset += len(main_entry) + len(fn_entry)
+    return tuple(offsets)
+
+DEFAULT_KEY_MAP_ENTRIES = get_default_key_map_entries()
+DEFAULT_KEY_MAP_OFFSETS = get_default_key_map_offsets()
+DEFAULT_KEY_MAP_DATA = b"".join(main_entry + fn_entry for main_entry, fn_entry in DEFAULT_KEY_MAP_ENTRIES)
+
+# Encode the key map table, in KEY_CODES_SORTED order. Only the remapped entries are encoded, the rest come from the default table.
+def encode_key_map_data(key_map):
+    data = bytearray(DEFAULT_KEY_MAP_DATA)
+    if "default" in key_map:
+        return data
+
+    # Collect the remapped entries as (slot, layer, entry)
+    remaps = []
+    for key, mapped_key in key_map.items():
+        if key in KEY_INDEXES:
+            remaps.append((KEY_INDEXES[key], 0, encode_key_map_entry(mapped_key)))
+        elif key.endswith("_fn") and key[:-3] in KEY_INDEXES:
+            remaps.append((KEY_INDEXES[key[:-3]], 1, encode_key_map_entry(mapped_key)))
+
+    # Write the entries over the default ones, from the end of the payload backwards so that an entry of a different size doesn't move the offsets still to be written
+    for slot, layer, entry in sorted(remaps, reverse=True):
+        offset = DEFAULT_KEY_MAP_OFFSETS[slot][layer]
+        data[offset:offset + len(DEFAULT_KEY_MAP_ENTRIES[slot][layer])] = entry
+    return data
+
+# Encode the packets for individual key remaps
+def encode_key_map_packets(key_map):
+    return encode_chunked_packets(encode_key_map_data(key_map), KEY_MAP_HEADER)
+
+# Generate packet verification
+def generate_verification(packet_data):
+    return f"{sum(bytes.fromhex(packet_data)) % 0x100:02x}"
+
+# Split the string into different packets
+def split_data_into_packets(data, header):
+    if len(data) % 2:
+        data += "0"
+    return [packet.hex() for packet in encode_chunked_packets(bytes.fromhex(data), bytes.fromhex(header))]
+
+# Generate the pattern packet
+def generate_pattern_packet(pattern_int, brightness_int, speed_int, direction_val, color):
+    return encode_pattern_packet(pattern_int, brightness_int, speed_int, direction_val, color).hex()
+
+# Generate the packets for indivual key RGB
+def generate_key_rgb_packets(key_color):
+    return [packet.hex() for packet in encode_key_rgb_packets(key_color)]
+
+# Get the default FN layer key for this key_id. Function keys should NOT be remapped in the FN layer.
+def get_default_fn_id(key_id, return_functions = False):
+    fn_key_id = DEFAULT_FN_KEYS.get(key_id, key_id)
+    if (fn_key_id in FUNCTION_KEYS or "fn" == fn_key_id) and not return_functions:
+        fn_key_id = "forbidden"
+
+    return fn_key_id
+
+# Generate the packets for indivual key remaps
+def generate_key_map_packets(key_map):
+    return [packet.hex() for packet in encode_key_map_packets(key_map)]
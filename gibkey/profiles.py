@@ -0,0 +1,193 @@
+# Profiles: configs saved as JSON, and compiled profiles holding the exact packets a config comes down to, ready to send without any parsing or encoding.
+import json
+import logging
+import os
+
+from gibkey.packets import PACKET_LENGTH
+from gibkey.session import get_session
+from gibkey.upload import get_config_packet_groups, plan_upload, run_plan
+
+# Compiled profile layout: a header (magic, version, group count, SHA-256 of the source profile), one entry per packet group
+# (packet count, paced, pace before the group), then the packets themselves back to back
+COMPILED_PROFILE_MAGIC = b"G68B"
+COMPILED_PROFILE_VERSION = 1
+COMPILED_PROFILE_EXTENSION = ".g68bin"
+COMPILED_PROFILE_HEADER = "<4sBB32s"
+COMPILED_PROFILE_GROUP = "<HBB"
+
+logger = logging.getLogger("gibkey")
+
+# Load config from JSON file
+def load_config(pattern, brightness, color, direction, speed, key_map, key_color, config_input):
+    with open(config_input, "r") as input_file:
+        json_file = json.load(input_file)
+
+        # Add the stored values to the given key_map and key_color object.
+        # Config values don't override ones already in key_map and key_color.
+        if "key_map" in json_file:
+            for index, key in enumerate(json_file["key_map"]):
+                if key not in key_map:
+                    key_map[key] = json_file["key_map"][key]
+        if "key_color" in json_file:
+            for index, key in enumerate(json_file["key_color"]):
+                if key not in key_color:
+                    key_color[key] = json_file["key_color"][key]
+        if "pattern" in json_file and pattern is None:
+            pattern = json_file["pattern"]
+        if "brightness" in json_file and brightness is None:
+            brightness = json_file["brightness"]
+        if "color" in json_file and color is None:
+            color = json_file["color"]
+        if "direction" in json_file and direction is None:
+            direction = json_file["direction"]
+        if "speed" in json_file and speed is None:
+            speed = json_file["speed"]
+
+        return (pattern, brightness, color, direction, speed, key_map, key_color)
+
+# Save config to JSON file
+def save_config(pattern, brightness, color, direction, speed, key_map, key_color, config_output):
+    out_key_map = {}
+    if "default" not in key_map: # Ignore key_map if default value is used
+        out_key_map = key_map
+    config = {"key_color": key_color, "key_map": out_key_map, "brightness": brightness, "color": color, "direction": direction, "speed": speed}
+
+    if pattern != None:
+        config["pattern"] = pattern
+    elif len(key_map) > 0:
+        config["pattern"] = "custom"
+
+    with open(config_output, "w") as json_file:
+        json.dump(config, json_file, indent=2)
+
+# Check if a path is a compiled profile
+def is_compiled_profile(path):
+    return path.lower().endswith(COMPILED_PROFILE_EXTENSION)
+
+# Get the hash a profile is compiled under. It covers the format version too, so a new version recompiles everything.
+def get_profile_hash(config_input):
+    import hashlib
+    with open(config_input, "rb") as input_file:
+        return hashlib.sha256(bytes([COMPILED_PROFILE_VERSION]) + input_file.read()).digest()
+
+# Get the source hash stored in a compiled profile, or None if it's missing or unreadable
+def read_compiled_profile_hash(path):
+    import struct
+    try:
+        with open(path, "rb") as input_file:
+            magic, version, group_count, source_hash = struct.unpack(COMPILED_PROFILE_HEADER, input_file.read(struct.calcsize(COMPILED_PROFILE_HEADER)))
+    except (OSError, struct.error):
+        return None
+    if magic != COMPILED_PROFILE_MAGIC or version != COMPILED_PROFILE_VERSION:
+        return None
+    return source_hash
+
+# Compile a JSON profile into the exact packets apply_config would send. Returns the number of packets.
+def compile_profile(config_input, compiled_output):
+    import struct
+    source_hash = get_profile_hash(config_input)
+    pattern, brightness, color, direction, speed, key_map, key_color = load_config(None, None, None, None, None, {}, {}, config_input)
+    groups = get_config_packet_groups(pattern, brightness if brightness != None else 50, color if color != None else "default", direction if direction != None else 0, speed if speed != None else 3, key_map, key_color)
+
+    data = bytearray(struct.pack(COMPILED_PROFILE_HEADER, COMPILED_PROFILE_MAGIC, COMPILED_PROFILE_VERSION, len(groups), source_hash))
+    for packets, paced, pause in groups:
+        data += struct.pack(COMPILED_PROFILE_GROUP, len(packets), paced, pause)
+    for packets, paced, pause in groups:
+        for packet in packets:
+            data += packet
+
+    # Write to a temporary file first, so a half-written profile never gets applied
+    temp_output = f"{compiled_output}.tmp"
+    with open(temp_output, "wb") as output_file:
+        output_file.write(data)
+    os.replace(temp_output, compiled_output)
+    return sum(len(packets) for packets, paced, pause in groups)
+
+# Compile a profile, or every JSON profile in a directory. Profiles whose compiled file is up to date are skipped.
+# For a single profile, output is the compiled file; for a directory, it's the directory the compiled files go in.
+def compile_profiles(path, output = None):
+    if os.path.isdir(path):
+        output_path = output if output != None else path
+        os.makedirs(output_path, exist_ok=True)
+        jobs = []
+        for file_name in sorted(os.listdir(path)):
+            if file_name.lower().endswith(".json"):
+                jobs.append((os.path.join(path, file_name), os.path.join(output_path, os.path.splitext(file_name)[0] + COMPILED_PROFILE_EXTENSION)))
+    else:
+        jobs = [(path, output if output != None else os.path.splitext(path)[0] + COMPILED_PROFILE_EXTENSION)]
+
+    # Skip the unchanged profiles
+    stale_jobs = []
+    for config_input, compiled_output in jobs:
+        if read_compiled_profile_hash(compiled_output) == get_profile_hash(config_input):
+            logger.info("Skipped %s, unchanged", config_input)
+        else:
+            stale_jobs.append((config_input, compiled_output))
+
+    # Compile the rest, spread over a process pool when there's more than one
+    failures = 0
+    if len(stale_jobs) == 1:
+        results = [run_compile_job(compile_profile, *stale_jobs[0])]
+    elif len(stale_jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor() as executor:
+            futures = [executor.submit(compile_profile, config_input, compiled_output) for config_input, compiled_output in stale_jobs]
+            results = [run_compile_job(future.result) for future in futures]
+    else:
+        results = []
+
+    for (config_input, compiled_output), (packet_count, error) in zip(stale_jobs, results):
+        if error != None:
+            failures += 1
+            logger.error("Failed to compile %s: %s", config_input, error)
+        else:
+            logger.info("Compiled %s to %s (%d packets)", config_input, compiled_output, packet_count)
+
+    if failures > 0:
+        raise ValueError(f"Error: {failures} profile(s) failed to compile.")
+
+# Run a compile job, getting its (result, error)
+def run_compile_job(function, *args):
+    try:
+        return (function(*args), None)
+    except Exception as e:
+        return (None, e)
+
+# Read a compiled profile's packet groups. The file is memory-mapped and its packets are taken as they are, with no parsing or encoding.
+def read_compiled_profile(path):
+    import mmap, struct
+    header_length = struct.calcsize(COMPILED_PROFILE_HEADER)
+    group_length = struct.calcsize(COMPILED_PROFILE_GROUP)
+
+    with open(path, "rb") as input_file:
+        # Empty files can't be memory-mapped
+        if os.fstat(input_file.fileno()).st_size < header_length:
+            raise ValueError(f"Error: {path} is empty or truncated, compile it again.")
+        data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        try:
+            magic, version, group_count, source_hash = struct.unpack_from(COMPILED_PROFILE_HEADER, data)
+        except struct.error:
+            raise ValueError(f"Error: {path} is not a compiled profile.")
+        if magic != COMPILED_PROFILE_MAGIC:
+            raise ValueError(f"Error: {path} is not a compiled profile.")
+        if version != COMPILED_PROFILE_VERSION:
+            raise ValueError(f"Error: {path} was compiled by a different version, compile it again.")
+
+        offset = header_length + group_count * group_length
+        if len(data) < offset:
+            raise ValueError(f"Error: {path} is truncated, compile it again.")
+        groups = [struct.unpack_from(COMPILED_PROFILE_GROUP, data, header_length + index * group_length) for index in range(group_count)]
+        if len(data) != offset + sum(packet_count for packet_count, paced, pause in groups) * PACKET_LENGTH:
+            raise ValueError(f"Error: {path} is truncated, compile it again.")
+
+        packet_groups = []
+        for packet_count, paced, pause in groups:
+            packets = [data[offset + index * PACKET_LENGTH:offset + (index + 1) * PACKET_LENGTH] for index in range(packet_count)]
+            offset += packet_count * PACKET_LENGTH
+            packet_groups.append((packets, bool(paced), bool(pause)))
+        return packet_groups
+
+# Apply a compiled profile. Returns the upload time.
+def apply_compiled_profile(path):
+    return run_plan(plan_upload(read_compiled_profile(path), get_session().shadow_packets))
@@ -0,0 +1,513 @@
+# Reliable uploads to a GIBKEY G68: a DeviceSession keeps the keyboard's handle together with what's needed to get packets through to it.
+# Writes are retried, paced by a gap that adapts to how the keyboard copes, picked up again after the keyboard is replugged,
+# and packets the keyboard already has from the last upload (its shadow) are skipped.
+#
+#     with gibkey.DeviceSession() as keyboard:
+#         keyboard.set_keys_color({"all": "ff0000", "escape": "00ff00"})
+import collections
+import errno
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from gibkey import settings
+from gibkey.device import VENDOR_ID, PRODUCT_ID, G68Device, import_usb, get_device_serial
+from gibkey.device import find_devices as find_backend_devices
+from gibkey.packets import RGB_PATTERNS, PATTERN_HEADER, KEY_MAP_HEADER, KEY_RGB_HEADER, encode_pattern_packet, encode_key_rgb_packets, encode_key_map_packets
+
+# Pacing between packets, in seconds. The gap starts at the default (or the last calibrated value) and adapts from there.
+# It only tightens a little after each paced packet family of at least two packets that went through without a single failed write, and never below the minimum
+# unless --min-gap lowers it, since a write the keyboard accepted doesn't mean the firmware has caught up with it. It only backs off on the errors of a keyboard
+# that can't keep up: a gone device or a stalled endpoint says nothing about the pacing.
+PACING_DEFAULT_GAP = 0.1
+PACING_MAX_GAP = 1.0
+PACING_TIGHTEN_FACTOR = 0.9
+PACING_BACKOFF_FACTOR = 2
+PACING_FILE = ".gibkey-g68-pacing.json"
+
+# USB errors that retrying won't fix. A gone device can still come back through a reconnect.
+STALE_HANDLE_ERRNOS = (errno.ENODEV, errno.ENOENT)
+FATAL_ERRNOS = STALE_HANDLE_ERRNOS + (errno.EPIPE,)
+PACING_BACKOFF_ERRNOS = (errno.ETIMEDOUT, errno.EOVERFLOW)
+
+# Polling for a keyboard that went away, in seconds. The interval doubles after every poll, up to the maximum.
+RECONNECT_POLL_INTERVAL = 0.1
+RECONNECT_MAX_POLL_INTERVAL = 1.0
+
+# Number of packets kept in the packet trace by default
+PACKET_TRACE_LENGTH = 256
+
+# Upload phases, by packet header
+PACKET_PHASES = {KEY_MAP_HEADER: "key_map", KEY_RGB_HEADER: "key_rgb", PATTERN_HEADER: "pattern"}
+
+default_session = None
+session_local = threading.local()
+pacing_file_lock = threading.Lock()
+logger = logging.getLogger("gibkey")
+packet_trace = collections.deque(maxlen=PACKET_TRACE_LENGTH)
+
+# Connection, pacing and upload state of one keyboard: a G68Device that also keeps track of how uploads to it go.
+# Each thread uploads through its own session, or the default one. The device's lock is held while a packet family is being sent.
+class DeviceSession(G68Device):
+    def __init__(self, usb_device = None, backend = None):
+        super().__init__(usb_device, backend if backend != None else settings.backend)
+        self.device_id = None               # VID:PID:serial the pacing is calibrated under
+        self.resumes = []                   # (header, offset, seconds waited) of each upload resumed after a reconnect
+        self.pacing_gap = max(PACING_DEFAULT_GAP, settings.pacing_min_gap)
+        self.pacing_sleep_time = 0.0
+        self.failed_families = set()        # Families being sent that had a failed write, which don't tighten the pacing
+        self.shadow_packets = {}            # Last packets the keyboard accepted, by family
+        self.state_device_id = None         # VID:PID:serial the shadow packets were loaded from the state file for
+        self.phase = None                   # Phase of the packets being sent, for the statistics
+
+    # Open the keyboard, unless it's open already, and pick up the pacing calibrated for it on a previous run. A simulation isn't calibrated against.
+    # The default session also picks up the keyboard's last applied packets from the state file, unless it already has them for this keyboard.
+    def open(self):
+        with self.lock:
+            if self.device is None:
+                super().open()
+                self.device_id = get_device_id(self) if self.backend == "usb" else None
+                if self.device_id != None:
+                    load_pacing(self)
+                if settings.state_file != None and self is default_session and get_device_id(self) != self.state_device_id:
+                    load_shadow_state(self)
+        return self
+
+    # Send a packet family, skipping the chunks the keyboard already has. Returns the number of packets sent.
+    def send_packets(self, packets, paced = True):
+        return send_packets(packets, paced, session=self)
+
+    # Set the light pattern
+    def set_pattern(self, pattern, brightness = 50, speed = 3, direction = 0, color = "default"):
+        self.send_packets([encode_pattern_packet(RGB_PATTERNS[pattern], brightness, speed, direction, color)], False)
+
+    # Set the color of individual keys, switching to the custom pattern that shows them
+    def set_keys_color(self, key_color, brightness = 50, speed = 3, direction = 0):
+        with self.lock:
+            self.set_pattern("custom", brightness, speed, direction, "000000")
+            pace(session=self)
+            self.send_packets(encode_key_rgb_packets(key_color))
+
+    # Set individual key mappings
+    def set_key_map(self, key_map):
+        self.send_packets(encode_key_map_packets(key_map))
+
+# Get the session of the current thread. Threads that haven't picked one use the default session.
+def get_session():
+    global default_session
+    session = getattr(session_local, "session", None)
+    if session is None:
+        if default_session is None:
+            default_session = DeviceSession()
+        session = default_session
+    return session
+
+# Find every connected keyboard, using the selected backend
+def find_devices():
+    return find_backend_devices(settings.backend)
+
+# Find a keyboard that went away again, by its serial number. Returns None if it isn't back yet.
+def find_replugged_device(session):
+    devices = find_devices()
+    if session.serial not in (None, "unknown"):
+        devices = [device for device in devices if get_device_serial(device) == session.serial]
+        return devices[0] if len(devices) > 0 else None
+
+    # Without a serial, only a lone keyboard can safely be taken for the one that went away
+    return devices[0] if len(devices) == 1 else None
+
+# Wait for the session's keyboard to come back and set it up again, running the whole interface and endpoint discovery.
+# Polls with a growing interval, for up to timeout seconds. Returns how long it took, or raises a RuntimeError.
+def reconnect_device(session, timeout):
+    start = time.monotonic()
+    interval = RECONNECT_POLL_INTERVAL
+    session.close()
+
+    while True:
+        error_message = "ERROR: Device not found."
+        if session.usb_device is None and session.serial in (None, "unknown"):
+            error_message = setup_device(session)
+        else:
+            # The replugged keyboard is a new device, which has to be looked up again
+            device = find_replugged_device(session)
+            if device != None:
+                session.usb_device = device
+                error_message = setup_device(session)
+        if error_message is None:
+            return time.monotonic() - start
+
+        if time.monotonic() - start + interval > timeout:
+            raise RuntimeError(f"The keyboard didn't come back within {timeout:g}s: {error_message}")
+        time.sleep(interval)
+        interval = min(interval * 2, RECONNECT_MAX_POLL_INTERVAL)
+
+# Find and set up the session's keyboard, or the current thread's. Returns an error message if it can't be set up.
+def setup_device(session = None):
+    session = session if session != None else get_session()
+    setup_start = time.perf_counter()
+    # pyusb is only imported once the keyboard is actually needed, so that commands that don't touch it start faster
+    import_start = time.perf_counter()
+    import_usb()
+    settings.startup_times.setdefault("usb_import", time.perf_counter() - import_start)
+    try:
+        session.open()
+    except ValueError as e:
+        return str(e)
+    settings.startup_times.setdefault("setup", time.perf_counter() - setup_start)
+    return None
+
+# Get a VID:PID:serial string identifying the session's keyboard
+def get_device_id(session):
+    return f"{VENDOR_ID:04x}:{PRODUCT_ID:04x}:{session.serial}"
+
+# Get the path of the pacing file
+def get_pacing_path():
+    return os.path.join(os.path.expanduser("~"), PACING_FILE)
+
+# Load the calibrated pacing gap of the session's keyboard
+def load_pacing(session):
+    try:
+        with open(get_pacing_path(), "r") as input_file:
+            calibrated_gaps = json.load(input_file)
+    except (OSError, ValueError):
+        return
+    if session.device_id in calibrated_gaps:
+        session.pacing_gap = min(max(float(calibrated_gaps[session.device_id]), settings.pacing_min_gap), max(PACING_MAX_GAP, settings.pacing_min_gap))
+
+# Save the calibrated pacing gap of the session's keyboard, or the current thread's
+def save_pacing(session = None):
+    session = session if session != None else get_session()
+    if session.device_id is None:
+        return
+
+    # Keyboards uploading in parallel all save to the same file
+    with pacing_file_lock:
+        save_pacing_locked(session)
+
+# Save the calibrated pacing gap of a device. The pacing file lock must be held.
+def save_pacing_locked(session):
+    calibrated_gaps = {}
+    try:
+        with open(get_pacing_path(), "r") as input_file:
+            calibrated_gaps = json.load(input_file)
+    except (OSError, ValueError):
+        pass
+    calibrated_gaps[session.device_id] = session.pacing_gap
+
+    try:
+        with open(get_pacing_path(), "w") as json_file:
+            json.dump(calibrated_gaps, json_file, indent=2)
+    except OSError:
+        pass  # Not being able to remember the pacing is no reason to fail the upload
+
+# Wait for the current pacing gap between packets. The time is counted towards the given phase, or the one being sent.
+def pace(phase = None, session = None):
+    session = session if session != None else get_session()
+    time.sleep(session.pacing_gap)
+    session.pacing_sleep_time += session.pacing_gap
+    if settings.upload_stats != None:
+        settings.upload_stats.record_pacing(phase or session.phase, session.pacing_gap)
+
+# Tighten the pacing gap after a packet family went through without a failed write
+def pacing_success(session):
+    session.pacing_gap = max(settings.pacing_min_gap, session.pacing_gap * PACING_TIGHTEN_FACTOR)
+
+# Back off the pacing gap after a write that timed out or overran
+def pacing_failure(session):
+    session.pacing_gap = min(max(PACING_MAX_GAP, settings.pacing_min_gap), max(session.pacing_gap, settings.pacing_min_gap) * PACING_BACKOFF_FACTOR)
+
+# Start timing an upload
+def start_upload_timer(session):
+    session.pacing_sleep_time = 0.0
+    session.resumes = []
+    return time.perf_counter()
+
+# Finish timing an upload, report it and remember the pacing for the next run
+def finish_upload_timer(upload_start, session):
+    upload_time = time.perf_counter() - upload_start
+    logger.info("Upload took %.3fs (%.3fs paused, pacing now %.0f ms)", upload_time, session.pacing_sleep_time, session.pacing_gap * 1000)
+    for header, offset, waited in session.resumes:
+        logger.info("Resumed %s from offset %#06x after the keyboard was gone for %.1fs", header.hex(), offset, waited)
+    save_pacing(session)
+    return upload_time
+
+# Get the upload phase a packet belongs to
+def get_packet_phase(packet):
+    return PACKET_PHASES.get(bytes(packet[0:3]), packet[0:3].hex())
+
+# Upload statistics per phase: packets, bytes, write latency, retries and the time spent sleeping. Only collected with --stats.
+class UploadStats:
+    def __init__(self):
+        self.lock = threading.Lock()    # Keyboards uploading in parallel all record here
+        self.start_time = time.perf_counter()
+        self.phases = {}
+
+    # Get the counters of a phase
+    def get_phase(self, phase):
+        if phase not in self.phases:
+            self.phases[phase] = {"packets": 0, "skipped": 0, "bytes": 0, "retries": 0, "write_time": 0.0, "max_latency": 0.0, "pacing_sleep": 0.0, "retry_sleep": 0.0}
+        return self.phases[phase]
+
+    # Record a packet that was written. latency covers the whole send, retries included.
+    def record_packet(self, phase, length, latency, retries, retry_sleep):
+        with self.lock:
+            counters = self.get_phase(phase)
+            counters["packets"] += 1
+            counters["bytes"] += length
+            counters["retries"] += retries
+            counters["write_time"] += latency
+            counters["max_latency"] = max(counters["max_latency"], latency)
+            counters["retry_sleep"] += retry_sleep
+
+    # Record a packet that was skipped because the keyboard already had it
+    def record_skipped(self, phase):
+        with self.lock:
+            self.get_phase(phase)["skipped"] += 1
+
+    # Record time spent pacing
+    def record_pacing(self, phase, seconds):
+        with self.lock:
+            self.get_phase(phase)["pacing_sleep"] += seconds
+
+    # Get the statistics of each phase and of the whole run
+    def get_summary(self):
+        with self.lock:
+            phases = {str(phase): dict(counters) for phase, counters in self.phases.items()}
+        total = {"packets": 0, "skipped": 0, "bytes": 0, "retries": 0, "write_time": 0.0, "max_latency": 0.0, "pacing_sleep": 0.0, "retry_sleep": 0.0}
+        for counters in phases.values():
+            counters["avg_latency"] = counters["write_time"] / counters["packets"] if counters["packets"] > 0 else 0.0
+            for name, value in counters.items():
+                if name == "max_latency":
+                    total[name] = max(total[name], value)
+                elif name != "avg_latency":
+                    total[name] += value
+        total["avg_latency"] = total["write_time"] / total["packets"] if total["packets"] > 0 else 0.0
+        return {"phases": phases, "total": total, "run_time": time.perf_counter() - self.start_time}
+
+# How send_data retries failed writes: exponential backoff with jitter, capped by an overall deadline per packet
+class RetryPolicy:
+    def __init__(self, retries = 5, timeout = 1500, base_delay = 0.05, max_delay = 1.0, jitter = 0.5, deadline = 3.0, reconnect = True, reconnect_timeout = 10.0):
+        self.retries = retries          # Total write attempts per packet
+        self.timeout = timeout          # Write timeout in milliseconds
+        self.base_delay = base_delay    # Delay before the first retry, doubled on every following one (seconds)
+        self.max_delay = max_delay      # Upper bound for a single delay (seconds)
+        self.jitter = jitter            # Fraction of each delay that is randomized
+        self.deadline = deadline        # Give up once a packet has taken this long (seconds)
+        self.reconnect = reconnect      # Wait for the keyboard and set it up again when the device handle has gone stale
+        self.reconnect_timeout = reconnect_timeout  # How long to wait for the keyboard to come back (seconds)
+
+    # Get the delay before the given retry (0 being the first one)
+    def get_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay * (1 - self.jitter * random.random())
+
+    # Check if an error is worth retrying at all
+    def is_transient(self, error):
+        return getattr(error, "errno", None) not in FATAL_ERRNOS
+
+    # Check if an error means the device handle is no longer valid
+    def is_stale_handle(self, error):
+        return getattr(error, "errno", None) in STALE_HANDLE_ERRNOS
+
+retry_policy = RetryPolicy()
+
+# Send the data to the session's keyboard, or the current thread's. The packet trace is dumped if it can't be sent.
+def send_data(data, policy = None, session = None):
+    session = session if session != None else get_session()
+    if policy is None:
+        policy = retry_policy
+
+    # Set up the keyboard with the first packet
+    if session.device is None:
+        error_message = setup_device(session)
+        if error_message != None:
+            raise ValueError(error_message)
+
+    try:
+        write_packet(session, data, policy)
+    except RuntimeError:
+        dump_packet_trace()
+        raise
+
+# Write a packet to the session's keyboard, retrying as the policy allows
+def write_packet(session, data, policy):
+    usb = import_usb()
+    deadline = time.monotonic() + policy.deadline
+    send_start = time.perf_counter()
+    retry_sleep = 0.0
+    retries = policy.retries
+
+    attempt = 0
+    while attempt < retries:
+        try:
+            session.write(data, policy.timeout)
+            if settings.upload_stats != None:
+                settings.upload_stats.record_packet(get_packet_phase(data), len(data), time.perf_counter() - send_start, attempt, retry_sleep)
+            packet_trace.append((time.time(), bytes(data[0:3]), data[5] | data[6] << 8, data[3], "ok"))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Packet sent: %s", data.hex())
+            return
+        except usb.core.USBError as e:
+            if getattr(e, "errno", None) in PACING_BACKOFF_ERRNOS:
+                pacing_failure(session)
+            session.failed_families.add(data[0:3].hex())
+            packet_trace.append((time.time(), bytes(data[0:3]), data[5] | data[6] << 8, data[3], str(e)))
+            logger.warning("Error during data transfer: %s", e)
+
+            # A stale handle means the keyboard went away. Wait for it to come back, then resume with this packet, since the ones before it got through.
+            # Anything else non-transient fails right away.
+            if policy.is_stale_handle(e) and policy.reconnect:
+                logger.warning("The keyboard went away, waiting for it to come back...")
+                try:
+                    waited = reconnect_device(session, policy.reconnect_timeout)
+                except RuntimeError as reconnect_error:
+                    raise RuntimeError(f"Failed to send chunk, could not reconnect: {reconnect_error}") from e
+                offset = data[5] | data[6] << 8
+                session.resumes.append((bytes(data[0:3]), offset, waited))
+                logger.warning("The keyboard is back after %.1fs, resuming %s from offset %#06x", waited, data[0:3].hex(), offset)
+                deadline = time.monotonic() + policy.deadline
+                # The keyboard coming back on the last attempt still earns the packet one write
+                retries = max(retries, attempt + 2)
+            elif not policy.is_transient(e):
+                raise RuntimeError(f"Failed to send chunk: {e}") from e
+
+            if attempt >= retries - 1:
+                raise RuntimeError("Max retries reached. Failed to send chunk.") from e
+            delay = policy.get_delay(attempt)
+            if time.monotonic() + delay > deadline:
+                raise RuntimeError("Retry deadline reached. Failed to send chunk.") from e
+            logger.info("Retrying...")
+            time.sleep(delay)
+            retry_sleep += delay
+            attempt += 1
+
+# Keep the given number of packets in the packet trace
+def set_packet_trace_length(length):
+    global packet_trace
+    if length != packet_trace.maxlen:
+        packet_trace = collections.deque(packet_trace, maxlen=max(1, length))
+
+# Format the packet trace, oldest packet first
+def format_packet_trace():
+    lines = []
+    for timestamp, header, offset, checksum, result in list(packet_trace):
+        lines.append(f"{time.strftime('%H:%M:%S', time.localtime(timestamp))}.{int(timestamp * 1000) % 1000:03d} {header.hex()} offset {offset:#06x} checksum {checksum:#04x} {result}")
+    return lines
+
+# Dump the packet trace to the trace file, or to the log if there isn't one
+def dump_packet_trace():
+    lines = format_packet_trace()
+    if settings.trace_file != None:
+        try:
+            with open(settings.trace_file, "a") as output_file:
+                output_file.write("\n".join(lines + [""]))
+            logger.error("Packet trace written to %s", settings.trace_file)
+            return
+        except OSError as e:
+            logger.error("Could not write the packet trace to %s: %s", settings.trace_file, e)
+    logger.error("Last %d packets:\n%s", len(lines), "\n".join(lines))
+
+# Read the state file, which holds the last applied packets of each keyboard by VID:PID:serial. Returns an empty state if there's no usable one.
+def read_state_file():
+    try:
+        with open(settings.state_file, "r") as input_file:
+            state = json.load(input_file)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+# Load the last applied packets of the session's keyboard, or the current thread's, from the state file. The keyboard must be open.
+# Entries of other keyboards are ignored: without one for this keyboard, the next upload is a full one.
+def load_shadow_state(session = None):
+    session = session if session != None else get_session()
+    device_id = get_device_id(session)
+    session.state_device_id = device_id
+    session.shadow_packets = {}
+
+    families = read_state_file().get(device_id)
+    if not isinstance(families, dict):
+        return
+    try:
+        session.shadow_packets = {family: [bytes.fromhex(packet) for packet in packets] for family, packets in families.items()}
+    except (TypeError, ValueError):
+        pass  # Damaged entry, the next upload will be a full one
+
+# Save the session's last applied packets to the state file, under its keyboard's entry
+def save_shadow_state(session):
+    state = read_state_file()
+    state[get_device_id(session)] = {family: [packet.hex() for packet in packets] for family, packets in session.shadow_packets.items()}
+
+    with open(settings.state_file, "w") as json_file:
+        json.dump(state, json_file, indent=2)
+
+# Send a packet family through the session, or the current thread's, skipping the chunks the keyboard already has from the last upload.
+# Returns the number of packets sent. progress is called after each packet, sent or skipped.
+def send_packets(packets, paced = True, progress = None, session = None):
+    session = session if session != None else get_session()
+    with session.lock:
+        return send_packets_locked(session, packets, paced, progress)
+
+# Send a packet family. The session's lock must be held, so that packets from different threads don't mix up the shadow state.
+def send_packets_locked(session, packets, paced, progress):
+    family = start_packet_family(session, packets)
+    sent = 0
+    complete = False
+
+    try:
+        for index, packet in enumerate(packets):
+            if send_family_packet(session, family, index, packet, paced):
+                sent += 1
+            if progress != None:
+                progress()
+        complete = True
+    finally:
+        finish_packet_family(session, family, sent, complete, paced)
+
+    return sent
+
+# Get ready to send a packet family, dropping the shadow chunks past its end. Returns the family.
+def start_packet_family(session, packets):
+    family = packets[0][0:3].hex()
+    session.shadow_packets[family] = session.shadow_packets.get(family, [])[:len(packets)]
+    session.phase = get_packet_phase(packets[0])
+    session.failed_families.discard(family)
+    return family
+
+# Check if the keyboard already has a packet of a family, from the last upload
+def is_packet_applied(session, family, index, packet):
+    shadow = session.shadow_packets.get(family, [])
+    return not settings.full_upload and index < len(shadow) and shadow[index] == packet
+
+# Send a packet of a family, unless the keyboard already has it. Packets must be sent in order. Returns whether it was sent.
+def send_family_packet(session, family, index, packet, paced):
+    shadow = session.shadow_packets[family]
+    if is_packet_applied(session, family, index, packet):
+        if settings.upload_stats != None:
+            settings.upload_stats.record_skipped(session.phase)
+        return False
+    send_data(packet, session=session)
+
+    # Only remember the chunk once it has actually been written. Chunks sent right after another one without pacing can be dropped by the keyboard,
+    # so from the first of those on, what it has isn't known anymore and gets sent again by the next upload.
+    if not paced and index > 0:
+        del shadow[index:]
+    elif index < len(shadow):
+        shadow[index] = packet
+    elif index == len(shadow):
+        shadow.append(packet)
+    if paced:
+        pace(session=session)
+    return True
+
+# Finish sending a packet family. Persists whatever made it to the keyboard, even if the upload got interrupted.
+# A complete paced family that had at least two packets written without a failed one tightens the pacing. Fewer say nothing about the gap between them.
+def finish_packet_family(session, family, sent, complete, paced):
+    if complete and paced and sent >= 2 and family not in session.failed_families:
+        pacing_success(session)
+
+    # Only the default keyboard's state is kept
+    if sent > 0 and settings.state_file != None and session is default_session:
+        save_shadow_state(session)
@@ -0,0 +1,17 @@
+# Settings shared by the upload machinery. gibkey-config.py sets them from its command line; code using the package can set them directly:
+#
+#     from gibkey import settings
+#     settings.backend = "fake"
+import os
+
+# Pacing between packets is never tightened below this, in seconds
+PACING_MIN_GAP = 0.08
+
+backend = os.environ.get("GIBKEY_BACKEND", "usb")  # "usb", or "fake" for the simulated keyboard
+pacing_min_gap = PACING_MIN_GAP
+full_upload = False                 # Resend every packet, even the ones the keyboard should already have
+state_file = None                   # File the last applied packets are kept in between runs
+trace_file = None                   # File the packet trace is written to when a packet fails, instead of the log
+upload_stats = None                 # UploadStats to record into, None to not collect any
+daemon_socket_path = os.environ.get("GIBKEY_SOCKET")
+startup_times = {}                  # Seconds each startup phase took, by phase
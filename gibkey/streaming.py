@@ -0,0 +1,128 @@
+# Streaming per-key color frames to the keyboard, e.g. for effects computed live or colors piped in from another program.
+import json
+import logging
+import threading
+import time
+
+from gibkey.frames import encode_frame_packets
+from gibkey.session import send_packets
+
+logger = logging.getLogger("gibkey")
+
+# Streams per-key color frames to the keyboard from a dedicated sender thread.
+# Only the newest frame is kept: a frame that hasn't been sent by the time the next one arrives is dropped.
+# Frames aren't paced, so the keyboard's state isn't remembered for them: the next regular upload sends the whole per-key RGB table again.
+class FrameStreamer:
+    def __init__(self, fps = 30):
+        self.frame_interval = 1 / fps
+        self.condition = threading.Condition()
+        self.pending_frame = None
+        self.pending_time = None
+        self.running = False
+        self.thread = None
+        self.error = None
+        self.frames_pushed = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.latency_total = 0.0            # Running latency statistics, so a long stream doesn't keep every frame's
+        self.latency_max = 0.0
+        self.first_sent_time = None
+        self.last_sent_time = None
+        self.start_time = None
+
+    # Start the sender thread
+    def start(self):
+        self.running = True
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="gibkey-stream", daemon=True)
+        self.thread.start()
+
+    # Queue a frame (a KeyFrame or a key_color dict), replacing the one still waiting to be sent
+    def push(self, key_color):
+        with self.condition:
+            if self.error != None:
+                raise RuntimeError(f"Streaming stopped: {self.error}")
+            if self.pending_frame != None:
+                self.frames_dropped += 1
+            self.pending_frame = key_color
+            self.pending_time = time.perf_counter()
+            self.frames_pushed += 1
+            self.condition.notify()
+
+    # Send the remaining frame and stop the sender thread
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        if self.error != None:
+            raise RuntimeError(f"Streaming stopped: {self.error}")
+
+    # Sender thread loop. Sends the newest frame at most once per frame interval.
+    def run(self):
+        next_frame_time = time.perf_counter()
+        while True:
+            with self.condition:
+                while self.pending_frame is None and self.running:
+                    self.condition.wait()
+                if self.pending_frame is None:
+                    return
+                key_color, pushed_time = self.pending_frame, self.pending_time
+                self.pending_frame = None
+
+            try:
+                send_packets(encode_frame_packets(key_color), False)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.running = False
+                return
+            sent_time = time.perf_counter()
+            self.frames_sent += 1
+            self.latency_total += sent_time - pushed_time
+            self.latency_max = max(self.latency_max, sent_time - pushed_time)
+            if self.first_sent_time is None:
+                self.first_sent_time = sent_time
+            self.last_sent_time = sent_time
+
+            # Hold off until the next frame is due
+            next_frame_time = max(next_frame_time + self.frame_interval, time.perf_counter())
+            time.sleep(max(0, next_frame_time - time.perf_counter()))
+
+    # Get the streaming statistics. fps is the rate frames were sent at, from the first one sent to the last.
+    def get_stats(self):
+        stats = {"frames_pushed": self.frames_pushed, "frames_sent": self.frames_sent, "frames_dropped": self.frames_dropped, "fps": 0, "latency_avg": 0, "latency_max": self.latency_max}
+        if self.frames_sent > 1 and self.last_sent_time > self.first_sent_time:
+            stats["fps"] = (self.frames_sent - 1) / (self.last_sent_time - self.first_sent_time)
+        if self.frames_sent > 0:
+            stats["latency_avg"] = self.latency_total / self.frames_sent
+        return stats
+
+# Stream frames from an iterable of KeyFrames or key_color dicts. With pace_input, frames are taken from the iterable at the target FPS.
+def stream_frames(frames, fps = 30, pace_input = True):
+    streamer = FrameStreamer(fps)
+    streamer.start()
+    next_frame_time = time.perf_counter()
+    try:
+        for key_color in frames:
+            streamer.push(key_color)
+            if pace_input:
+                next_frame_time += streamer.frame_interval
+                time.sleep(max(0, next_frame_time - time.perf_counter()))
+    except BaseException:
+        # Stop the sender without its own error hiding the one that got here
+        try:
+            streamer.stop()
+        except RuntimeError as e:
+            logger.error("%s", e)
+        raise
+    streamer.stop()
+
+    return streamer.get_stats()
+
+# Read frames for streaming, one JSON key_color object per line
+def read_stream_frames(input_file):
+    for line in input_file:
+        line = line.strip()
+        if len(line) > 0:
+            yield json.loads(line)
@@ -0,0 +1,137 @@
+# Sending packets from asyncio code, through a dedicated I/O thread so the event loop never blocks on USB writes.
+import threading
+
+from gibkey.packets import RGB_PATTERNS, encode_pattern_packet, encode_key_rgb_packets, encode_key_map_packets
+from gibkey.session import get_session, session_local, start_packet_family, send_family_packet, finish_packet_family
+
+# Packets the async transport lets queue up for the I/O thread before making the uploader wait
+ASYNC_MAX_IN_FLIGHT = 4
+
+async_transport = None
+
+# Sends packets for asyncio code. The writes (and the pacing between them) run on a dedicated I/O thread, in the order they were
+# queued, while the event loop stays free for other coroutines. Up to max_in_flight packets can be queued before an upload waits.
+# Families are sent one at a time: a coroutine uploading while another one's family is still going waits for it to finish.
+class AsyncTransport:
+    def __init__(self, max_in_flight = ASYNC_MAX_IN_FLIGHT, session = None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.session = session if session != None else get_session()
+        self.max_in_flight = max_in_flight
+        self.loop = None
+        self.in_flight = None
+        self.family_lock = None
+        # A single worker runs the jobs one at a time, in order, which keeps the chunks of a family in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gibkey-io", initializer=self.start_io_thread)
+
+    # Make the I/O thread send through the transport's session
+    def start_io_thread(self):
+        session_local.session = self.session
+
+    # Get the running loop, along with the semaphore and lock for it. They belong to the loop they were made in, so each new loop gets its own.
+    def bind_loop(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.in_flight = asyncio.Semaphore(self.max_in_flight)
+            self.family_lock = asyncio.Lock()
+        return loop
+
+    # Run a function on the I/O thread, once there's room for it. Returns the future of its result.
+    async def submit(self, function, *args):
+        loop = self.bind_loop()
+        await self.in_flight.acquire()
+        future = loop.run_in_executor(self.executor, function, *args)
+        future.add_done_callback(lambda future: self.in_flight.release())
+        return future
+
+    # Send a packet family, skipping the chunks the keyboard already has. Returns the number of packets sent.
+    # Nothing else gets in between its chunks: other families sent through the transport wait on the family lock until it's finished,
+    # and uploads from other threads wait on the session's lock, which the I/O thread holds from the start of the family to its end.
+    # The session's lock alone wouldn't do, since the I/O thread sends every family and the lock lets the thread holding it take it again.
+    async def send_packets(self, packets, paced = True):
+        self.bind_loop()
+        async with self.family_lock:
+            return await self.send_family(packets, paced)
+
+    # Send a packet family through the I/O thread, once the family lock is held
+    async def send_family(self, packets, paced):
+        import asyncio
+        session = self.session
+        # Once a packet fails, the ones queued after it are dropped
+        failed = threading.Event()
+        family = [None]
+        sent = [0]
+
+        def start_family():
+            session.lock.acquire()
+            try:
+                family[0] = start_packet_family(session, packets)
+            except BaseException:
+                session.lock.release()
+                raise
+
+        def send_packet(index, packet):
+            if failed.is_set() or family[0] is None:
+                return False
+            try:
+                if send_family_packet(session, family[0], index, packet, paced):
+                    sent[0] += 1
+                    return True
+                return False
+            except Exception:
+                failed.set()
+                raise
+
+        def finish_family():
+            if family[0] is None:
+                return
+            try:
+                finish_packet_family(session, family[0], sent[0], not failed.is_set(), paced)
+            finally:
+                family[0] = None
+                session.lock.release()
+
+        try:
+            await (await self.submit(start_family))
+            futures = []
+            for index, packet in enumerate(packets):
+                futures.append(await self.submit(send_packet, index, packet))
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        except BaseException:
+            # Failed to start or got cancelled. The jobs already queued still run, and the family gets finished after them.
+            failed.set()
+            self.executor.submit(finish_family)
+            raise
+        # Not limited by max_in_flight, so it's queued right behind the family's packets
+        await asyncio.wrap_future(self.executor.submit(finish_family))
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return sent[0]
+
+    # Stop the I/O thread, after the queued packets are sent
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+# Get the async transport, creating it the first time
+def get_async_transport():
+    global async_transport
+    if async_transport is None:
+        async_transport = AsyncTransport()
+    return async_transport
+
+# Set light pattern, from asyncio code
+async def set_pattern_async(pattern_val, brightness_val, speed_val, direction_val, color = "000000", transport = None):
+    transport = transport if transport != None else get_async_transport()
+    await transport.send_packets([encode_pattern_packet(RGB_PATTERNS[pattern_val], brightness_val, speed_val, direction_val, color)], False)
+
+# Set individual key RGB, from asyncio code
+async def set_keys_color_async(key_color, transport = None):
+    transport = transport if transport != None else get_async_transport()
+    await transport.send_packets(encode_key_rgb_packets(key_color))
+
+# Set inidividual key mappings, from asyncio code
+async def set_key_map_async(key_map, transport = None):
+    transport = transport if transport != None else get_async_transport()
+    await transport.send_packets(encode_key_map_packets(key_map))
@@ -0,0 +1,154 @@
+# Uploading whole configs: the packets a config comes down to, planned against what the keyboard already has and sent as one upload.
+# Several keyboards can be uploaded to at once, each from its own thread and session.
+from gibkey import settings
+from gibkey.device import get_device_serial
+from gibkey.packets import RGB_PATTERNS, encode_pattern_packet, encode_key_rgb_packets, encode_key_map_packets
+from gibkey.session import (
+    PACING_TIGHTEN_FACTOR, DeviceSession, get_session, session_local, find_devices, get_packet_phase, pace,
+    start_upload_timer, finish_upload_timer, send_packets, send_packets_locked,
+)
+
+# Typical time of a single USB write, in seconds, for estimating how long an upload takes
+PLAN_WRITE_TIME = 0.002
+
+# Set light pattern
+def set_pattern(pattern_val, brightness_val, speed_val, direction_val, color = "000000"):
+    send_packets([encode_pattern_packet(RGB_PATTERNS[pattern_val], brightness_val, speed_val, direction_val, color)], False)
+
+# Set individual key RGB
+def set_keys_color(key_color):
+    send_packets(encode_key_rgb_packets(key_color))
+
+# Set inidividual key mappings
+def set_key_map(key_map):
+    send_packets(encode_key_map_packets(key_map))
+
+# Get a config's packets in upload order: the key map first, then a single pattern packet, then the per-key RGB.
+# The RGB table only goes with the custom pattern, which per-key colors pick when no pattern is given.
+# A key map is always included, even one that comes out the same as the default one, since the keyboard may hold another; plan_upload drops it once the keyboard is known to have it.
+# Packets are grouped as (packets, paced, pause), where paced paces between the group's packets and pause paces before the group.
+def get_config_packet_groups(pattern, brightness, color, direction, speed, key_map, key_color):
+    if pattern != None and pattern not in RGB_PATTERNS:
+        raise ValueError(f"Error: Pattern {pattern} is not valid.")
+    groups = []
+    if (len(key_map) > 0):
+        groups.append((encode_key_map_packets(key_map), True, False))
+
+    # Adding some pauses here just to be extra safe
+    if (pattern is None and len(key_color) > 0):
+        pattern = "custom"
+    if (pattern == "custom" and len(key_color) > 0):
+        groups.append(([encode_pattern_packet(RGB_PATTERNS['custom'], brightness, speed, direction, "000000")], False, len(groups) > 0))
+        groups.append((encode_key_rgb_packets(key_color), True, True))
+    elif (pattern != None):
+        groups.append(([encode_pattern_packet(RGB_PATTERNS[pattern], brightness, speed, direction, color)], False, len(groups) > 0))
+    return groups
+
+# Plan an upload: drop the packet groups the keyboard already has from the last upload, going by shadow_packets, and the pause before the first group left.
+# With --full (or no shadow packets), every group is kept.
+def plan_upload(groups, shadow_packets = None):
+    plan = []
+    for packets, paced, pause in groups:
+        family = packets[0][0:3].hex()
+        if shadow_packets != None and not settings.full_upload and shadow_packets.get(family) == packets:
+            continue
+        plan.append((packets, paced, pause and len(plan) > 0))
+    return plan
+
+# Count the packets of a group the keyboard doesn't have yet, the way send_packets skips them
+def count_packets_to_send(packets, shadow_packets = None):
+    shadow = []
+    if shadow_packets != None and not settings.full_upload:
+        shadow = shadow_packets.get(packets[0][0:3].hex(), [])
+    return sum(1 for index, packet in enumerate(packets) if index >= len(shadow) or shadow[index] != packet)
+
+# Estimate how long a plan takes to upload, starting from the current pacing gap and tightening it after every paced group like a clean upload would
+def estimate_plan_time(plan, shadow_packets = None):
+    gap = get_session().pacing_gap
+    estimate = 0.0
+    for packets, paced, pause in plan:
+        if pause:
+            estimate += gap
+        to_send = count_packets_to_send(packets, shadow_packets)
+        estimate += to_send * (PLAN_WRITE_TIME + (gap if paced else 0.0))
+        if paced and to_send >= 2:
+            gap = max(settings.pacing_min_gap, gap * PACING_TIGHTEN_FACTOR)
+    return estimate
+
+# Send a plan as one upload through the session, or the current thread's, holding the keyboard the whole time so nothing gets in between its groups.
+# Returns the upload time. progress is called after each packet, sent or skipped.
+def run_plan(plan, progress = None, session = None):
+    session = session if session != None else get_session()
+    upload_start = start_upload_timer(session)
+    with session.lock:
+        for packets, paced, pause in plan:
+            if pause:
+                pace(get_packet_phase(packets[0]), session)
+            send_packets_locked(session, packets, paced, progress)
+    return finish_upload_timer(upload_start, session)
+
+# Apply a config to the keyboard. Returns the upload time.
+def apply_config(pattern, brightness, color, direction, speed, key_map, key_color, session = None):
+    session = session if session != None else get_session()
+    return run_plan(plan_upload(get_config_packet_groups(pattern, brightness, color, direction, speed, key_map, key_color), session.shadow_packets), session=session)
+
+# Get a bus:address serial label for a keyboard
+def get_device_label(device):
+    return f"{device.bus:03d}:{device.address:03d} {get_device_serial(device)}"
+
+# Check if a keyboard matches a device selector, either bus:address or a serial number
+def match_device(device, selector):
+    if ":" in selector:
+        bus, address = selector.split(":", 1)
+        if bus.isdigit() and address.isdigit():
+            return int(bus) == device.bus and int(address) == device.address
+    return get_device_serial(device) == selector
+
+# Get the keyboards picked by (selector, config path) pairs, or every connected one with all_devices, as (device, config path) pairs.
+# The config path is the one given to that keyboard, or None.
+def select_devices(device_selectors, all_devices = False):
+    devices = find_devices()
+    if all_devices:
+        return [(device, None) for device in devices]
+
+    targets = []
+    for selector, config_path in device_selectors:
+        matches = [device for device in devices if match_device(device, selector)]
+        if len(matches) < 1:
+            raise ValueError(f"Error: No keyboard matches {selector}.")
+        if len(matches) > 1:
+            raise ValueError(f"Error: More than one keyboard matches {selector}, use bus:address instead.")
+        targets.append((matches[0], config_path))
+    return targets
+
+# Apply a config to the current thread's keyboard: a compiled profile, a JSON profile, or the given config. Returns the upload time.
+def apply_device_config(config_path, config):
+    from gibkey.profiles import is_compiled_profile, apply_compiled_profile, load_config
+    if config_path != None and is_compiled_profile(config_path):
+        return apply_compiled_profile(config_path)
+    if config_path != None:
+        pattern, brightness, color, direction, speed, key_map, key_color = load_config(None, None, None, None, None, {}, {}, config_path)
+        return apply_config(pattern, brightness if brightness != None else 50, color if color != None else "default", direction if direction != None else 0, speed if speed != None else 3, key_map, key_color)
+    return apply_config(*config)
+
+# Upload to one keyboard from a pool thread, in a session of its own. Returns (label, upload time, error).
+# A keyboard with neither a config of its own nor a shared one (config None) is skipped, with no upload time or error.
+def run_device_upload(device, config_path, config):
+    if config_path is None and config is None:
+        return (get_device_label(device), None, None)
+    session = DeviceSession(device)
+    session_local.session = session
+    try:
+        return (get_device_label(device), apply_device_config(config_path, config), None)
+    except (ValueError, RuntimeError, OSError) as e:
+        return (get_device_label(device), None, e)
+    finally:
+        session.close()
+        session_local.session = None
+
+# Upload to several keyboards at once, each from its own thread with its own handle and pacing. Returns a (label, upload time, error) per keyboard.
+def upload_to_devices(targets, config_path, config):
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [executor.submit(run_device_upload, device, device_config_path if device_config_path != None else config_path, config) for device, device_config_path in targets]
+        return [future.result() for future in futures]
@@ -0,0 +1,144 @@
+# The packet writer: a single thread owning a keyboard, sending packet families by priority so quick changes get in ahead of long table uploads.
+import threading
+
+from gibkey.packets import PATTERN_HEADER, KEY_MAP_HEADER, KEY_RGB_HEADER
+from gibkey.session import get_session, session_local, get_packet_phase, pace, save_pacing, start_packet_family, is_packet_applied, send_family_packet, finish_packet_family
+
+# Packet writer priorities, by packet header. Lower goes first: a single pattern packet is quick to send and changes what the keyboard shows right away.
+PACKET_PRIORITIES = {PATTERN_HEADER: 0, KEY_MAP_HEADER: 1, KEY_RGB_HEADER: 2}
+
+# A packet family queued on the packet writer
+class WriteJob:
+    def __init__(self, packets, paced, sequence):
+        self.packets = packets
+        self.paced = paced
+        self.family = packets[0][0:3].hex()
+        self.phase = get_packet_phase(packets[0])
+        self.priority = PACKET_PRIORITIES.get(bytes(packets[0][0:3]), len(PACKET_PRIORITIES))
+        self.sequence = sequence            # Submission order, among jobs of the same priority
+        self.index = 0                      # Next packet to send
+        self.sent = 0
+        self.superseded = False             # Replaced by a newer job of its family before it started
+        self.error = None
+        self.done = threading.Event()
+
+# Single writer for a keyboard, sending every submitted packet family from its own thread, one packet at a time.
+# Between any two packets, the job with the highest priority goes next, so a pattern change gets in between the chunks of a table being uploaded.
+# A new job replaces the one of its family that's still waiting to start. A table that's partially sent is finished first, so the keyboard never gets half of one and half of another.
+class PacketWriter:
+    def __init__(self, session = None):
+        self.session = session              # Session to write through, None for the default one
+        self.condition = threading.Condition()
+        self.pending = {}                   # Jobs waiting to start, by family
+        self.active = {}                    # Jobs partially sent, by family
+        self.sequence = 0
+        self.running = False
+        self.thread = None
+
+    # Start the writer thread
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="gibkey-writer", daemon=True)
+        self.thread.start()
+
+    # Stop the writer thread once the partially sent tables are finished. Jobs that haven't started are dropped.
+    def stop(self):
+        with self.condition:
+            self.running = False
+            for job in self.pending.values():
+                job.error = RuntimeError("The packet writer was stopped.")
+                job.done.set()
+            self.pending = {}
+            self.condition.notify()
+        if self.thread != None:
+            self.thread.join()
+
+    # Queue packet groups, as (packets, paced, pause). Pauses are left to the writer, which paces whenever it moves on to another job. Returns the jobs.
+    def submit(self, groups):
+        jobs = []
+        with self.condition:
+            for packets, paced, pause in groups:
+                job = WriteJob(packets, paced, self.sequence)
+                self.sequence += 1
+                replaced = self.pending.get(job.family)
+                if replaced != None:
+                    replaced.superseded = True
+                    replaced.done.set()
+                self.pending[job.family] = job
+                jobs.append(job)
+            self.condition.notify()
+        return jobs
+
+    # Wait for jobs to be done. Returns False if any of them got replaced by a newer one, raises the error of the first one that failed.
+    def wait(self, jobs):
+        for job in jobs:
+            job.done.wait()
+        for job in jobs:
+            if job.error != None:
+                raise job.error
+        return not any(job.superseded for job in jobs)
+
+    # Get the job to send the next packet of, moving it to the active jobs if it's just starting. Returns None when there's nothing to send.
+    # With wait, waits for a job to come in, only returning None once the writer is stopped.
+    def get_next_job(self, wait):
+        with self.condition:
+            while True:
+                # Only one job per family can be partially sent, the next one waits until it's done
+                jobs = list(self.active.values()) + [job for family, job in self.pending.items() if family not in self.active]
+                if len(jobs) > 0:
+                    job = min(jobs, key=lambda job: (job.priority, job.sequence))
+                    if job.family not in self.active:
+                        del self.pending[job.family]
+                        self.active[job.family] = job
+                    return job
+                if not wait or not self.running:
+                    return None
+                self.condition.wait()
+
+    # Writer thread loop
+    def run(self):
+        if self.session != None:
+            session_local.session = self.session
+        session = get_session()
+        last_job = None
+        last_paced = True
+
+        while True:
+            job = self.get_next_job(last_job is None)
+            if job is None:
+                if last_job is None:
+                    return  # Stopped
+                # Gone idle, remember the pacing for the next run
+                save_pacing(session)
+                last_job = None
+                continue
+
+            finished = False
+            with session.lock:
+                try:
+                    if job.index == 0:
+                        start_packet_family(session, job.packets)
+                    # Same as the pause between the groups of an upload, unless the last packet was paced already. Packets the keyboard has are skipped without one.
+                    packet = job.packets[job.index]
+                    if last_job != None and last_job is not job and not last_paced and not is_packet_applied(session, job.family, job.index, packet):
+                        pace(job.phase, session)
+                    session.phase = job.phase
+                    if send_family_packet(session, job.family, job.index, packet, job.paced):
+                        job.sent += 1
+                        last_job, last_paced = job, job.paced
+                    job.index += 1
+                    finished = job.index >= len(job.packets)
+                except Exception as e:
+                    # Drop the handle after a failed transfer, so the next job starts with a fresh one
+                    if isinstance(e, RuntimeError):
+                        session.close()
+                    job.error = e
+                    last_job, last_paced = None, True
+                    finished = True
+                if finished:
+                    finish_packet_family(session, job.family, job.sent, job.error is None, job.paced)
+
+            if finished:
+                with self.condition:
+                    del self.active[job.family]
+                job.done.set()
@@ -0,0 +1,45 @@
+import asyncio
+import itertools
+import os
+import sys
+import unittest
+
+# Run from anywhere: the gibkey package is in the folder above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gibkey
+from gibkey import settings
+
+# Uploads from several coroutines at once through one AsyncTransport, checked against the order the simulated keyboard got the packets in
+class AsyncTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.pacing_min_gap = settings.pacing_min_gap
+        settings.pacing_min_gap = 0.0
+        # Slow writes, so the families would interleave if nothing kept them apart
+        self.fake = gibkey.FakeDevice(latency=0.002)
+        self.session = gibkey.DeviceSession(self.fake, "fake")
+        self.session.pacing_gap = 0.0
+        self.transport = gibkey.AsyncTransport(2, self.session)
+
+    def tearDown(self):
+        self.transport.close()
+        self.session.close()
+        settings.pacing_min_gap = self.pacing_min_gap
+
+    def test_gathered_families_stay_contiguous(self):
+        async def upload():
+            await asyncio.gather(
+                gibkey.set_keys_color_async({"all": "000010", "a": "ff0000"}, self.transport),
+                gibkey.set_key_map_async({"a": "b", "capslock": "lctrl"}, self.transport),
+                gibkey.set_pattern_async("custom", 50, 3, 0, transport=self.transport),
+            )
+        asyncio.run(upload())
+
+        headers = [bytes(packet[0:3]) for packet in self.fake.packets]
+        runs = [header for header, packets in itertools.groupby(headers)]
+        self.assertEqual(sorted(runs), sorted([gibkey.PATTERN_HEADER, gibkey.KEY_MAP_HEADER, gibkey.KEY_RGB_HEADER]))
+        self.assertEqual(self.fake.get_key_colors()["a"], "ff0000")
+        self.assertEqual(self.fake.get_key_map()["capslock"], "lctrl")
+
+if __name__ == "__main__":
+    unittest.main()
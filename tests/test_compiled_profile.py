@@ -0,0 +1,77 @@
+import json
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+# Run from anywhere: the gibkey package is in the folder above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gibkey
+from gibkey.profiles import COMPILED_PROFILE_HEADER, COMPILED_PROFILE_VERSION
+
+PROFILE = {"pattern": "custom", "brightness": 80, "key_color": {"all": "000010", "a": "ff0000"}, "key_map": {"capslock": "lctrl"}}
+
+# Compiled profiles read back, and the ways a broken one gets turned away
+class CompiledProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.directory.name, "profile.json")
+        self.compiled_path = os.path.join(self.directory.name, "profile.g68bin")
+        with open(self.config_path, "w") as output_file:
+            json.dump(PROFILE, output_file)
+        gibkey.compile_profile(self.config_path, self.compiled_path)
+        with open(self.compiled_path, "rb") as input_file:
+            self.data = input_file.read()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_compiled(self, data):
+        with open(self.compiled_path, "wb") as output_file:
+            output_file.write(data)
+
+    def test_round_trip(self):
+        groups = gibkey.get_config_packet_groups("custom", 80, "default", 0, 3, PROFILE["key_map"], PROFILE["key_color"])
+        compiled_groups = gibkey.read_compiled_profile(self.compiled_path)
+        self.assertEqual(len(compiled_groups), len(groups))
+        for (compiled_packets, compiled_paced, compiled_pause), (packets, paced, pause) in zip(compiled_groups, groups):
+            self.assertEqual([bytes(packet) for packet in compiled_packets], [bytes(packet) for packet in packets])
+            self.assertEqual((compiled_paced, compiled_pause), (paced, pause))
+
+    def test_empty(self):
+        self.write_compiled(b"")
+        with self.assertRaisesRegex(ValueError, "empty or truncated"):
+            gibkey.read_compiled_profile(self.compiled_path)
+
+    def test_bad_magic(self):
+        self.write_compiled(b"NOPE" + self.data[4:])
+        with self.assertRaisesRegex(ValueError, "not a compiled profile"):
+            gibkey.read_compiled_profile(self.compiled_path)
+
+    def test_other_version(self):
+        self.write_compiled(self.data[0:4] + bytes([COMPILED_PROFILE_VERSION + 1]) + self.data[5:])
+        with self.assertRaisesRegex(ValueError, "different version"):
+            gibkey.read_compiled_profile(self.compiled_path)
+
+    def test_truncated_group_table(self):
+        # The header claims more groups than the file has room for
+        header = bytearray(self.data[0:struct.calcsize(COMPILED_PROFILE_HEADER)])
+        header[5] = 200
+        self.write_compiled(bytes(header) + self.data[len(header):len(header) + 4])
+        with self.assertRaisesRegex(ValueError, "truncated"):
+            gibkey.read_compiled_profile(self.compiled_path)
+
+    def test_truncated_packets(self):
+        self.write_compiled(self.data[:-1])
+        with self.assertRaisesRegex(ValueError, "truncated"):
+            gibkey.read_compiled_profile(self.compiled_path)
+
+    def test_trailing_data(self):
+        self.write_compiled(self.data + b"\x00")
+        with self.assertRaisesRegex(ValueError, "truncated"):
+            gibkey.read_compiled_profile(self.compiled_path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+
+# Run from anywhere: the gibkey package is in the folder above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gibkey
+from gibkey.packets import KEY_MAP_HEADER
+
+# Uploads through G68Device to the simulated keyboard, checked against what it rebuilt from the packets
+class FakeDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = gibkey.FakeDevice()
+        self.keyboard = gibkey.G68Device(self.fake, "fake").open()
+
+    def tearDown(self):
+        self.keyboard.close()
+
+    def test_pattern(self):
+        self.keyboard.set_pattern("wave", brightness=80, speed=1, direction=1, color="00ff00")
+        self.assertEqual(self.fake.pattern, {"pattern": gibkey.RGB_PATTERNS["wave"], "brightness": 80, "speed": 1, "direction": 1, "color": "00ff00"})
+
+    def test_keys_color(self):
+        self.keyboard.set_keys_color({"all": "000010", "a": "ff0000", "enter": "00ff00"})
+        key_colors = self.fake.get_key_colors()
+        self.assertEqual(key_colors["a"], "ff0000")
+        self.assertEqual(key_colors["enter"], "00ff00")
+        self.assertEqual(key_colors["b"], "000010")
+        self.assertEqual(self.fake.pattern["pattern"], gibkey.RGB_PATTERNS["custom"])
+
+    def test_key_map(self):
+        self.keyboard.set_key_map({"a": "b", "capslock": "lctrl"})
+        key_map = self.fake.get_key_map()
+        self.assertEqual(key_map["a"], "b")
+        self.assertEqual(key_map["capslock"], "lctrl")
+        self.assertEqual(key_map["b"], "b")
+
+    def test_key_map_ending_in_divider(self):
+        # A table cut off right after a 10 00 divider
+        self.fake.payloads[KEY_MAP_HEADER] = bytearray(b"\x10\x00\x04\x10\x00")
+        self.assertEqual(self.fake.get_key_map(), {})
+
+if __name__ == "__main__":
+    unittest.main()
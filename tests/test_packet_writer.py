@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+
+# Run from anywhere: the gibkey package is in the folder above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gibkey
+from gibkey import settings
+
+# Simulated keyboard that runs a callback once, right after it accepts its first packet
+class InterruptingDevice(gibkey.FakeDevice):
+    def __init__(self):
+        super().__init__()
+        self.on_write = None
+
+    def write(self, endpoint, data, timeout = None):
+        result = super().write(endpoint, data, timeout)
+        if self.on_write != None:
+            on_write, self.on_write = self.on_write, None
+            on_write()
+        return result
+
+# Packet families sent through the packet writer, checked against the order the simulated keyboard got them in
+class PacketWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.pacing_min_gap = settings.pacing_min_gap
+        settings.pacing_min_gap = 0.0
+        self.fake = InterruptingDevice()
+        self.session = gibkey.DeviceSession(self.fake, "fake")
+        self.session.pacing_gap = 0.0
+        self.writer = gibkey.PacketWriter(self.session)
+
+    def tearDown(self):
+        self.writer.stop()
+        self.session.close()
+        settings.pacing_min_gap = self.pacing_min_gap
+
+    def test_waiting_job_is_superseded(self):
+        # Both are queued before the writer starts, so the first one is still waiting when the second comes in
+        first_jobs = self.writer.submit([(gibkey.encode_key_rgb_packets({"all": "ff0000"}), True, False)])
+        second_packets = gibkey.encode_key_rgb_packets({"all": "0000ff"})
+        second_jobs = self.writer.submit([(second_packets, True, False)])
+        self.writer.start()
+
+        self.assertFalse(self.writer.wait(first_jobs))
+        self.assertTrue(self.writer.wait(second_jobs))
+        self.assertEqual(first_jobs[0].sent, 0)
+        self.assertEqual([bytes(packet) for packet in self.fake.packets], [bytes(packet) for packet in second_packets])
+        self.assertEqual(self.fake.get_key_colors()["a"], "0000ff")
+
+    def test_different_families_are_not_superseded(self):
+        jobs = self.writer.submit([(gibkey.encode_key_map_packets({"capslock": "lctrl"}), True, False)])
+        jobs += self.writer.submit([(gibkey.encode_key_rgb_packets({"all": "00ff00"}), True, False)])
+        self.writer.start()
+
+        self.assertTrue(self.writer.wait(jobs))
+        self.assertEqual(self.fake.get_key_map()["capslock"], "lctrl")
+        self.assertEqual(self.fake.get_key_colors()["a"], "00ff00")
+
+    def test_pattern_gets_in_between_rgb_chunks(self):
+        rgb_packets = gibkey.encode_key_rgb_packets({"all": "000010", "a": "ff0000"})
+        pattern_packet = gibkey.encode_pattern_packet(gibkey.RGB_PATTERNS["wave"], 80, 1, 0, "00ff00")
+        pattern_jobs = []
+        # The pattern comes in once the first RGB chunk is through
+        self.fake.on_write = lambda: pattern_jobs.extend(self.writer.submit([([pattern_packet], False, False)]))
+        self.writer.start()
+
+        self.assertTrue(self.writer.wait(self.writer.submit([(rgb_packets, True, False)])))
+        self.assertTrue(self.writer.wait(pattern_jobs))
+        headers = [bytes(packet[0:3]) for packet in self.fake.packets]
+        # The table that got interrupted is still finished after the pattern
+        self.assertEqual(headers, [gibkey.KEY_RGB_HEADER, gibkey.PATTERN_HEADER] + [gibkey.KEY_RGB_HEADER] * (len(rgb_packets) - 1))
+        self.assertEqual(self.fake.get_key_colors()["a"], "ff0000")
+        self.assertEqual(self.fake.pattern["pattern"], gibkey.RGB_PATTERNS["wave"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import errno
+import os
+import sys
+import threading
+import unittest
+
+# Run from anywhere: the gibkey package is in the folder above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gibkey
+from gibkey import settings
+from gibkey.device import get_fake_devices, reset_fake_devices
+from gibkey.session import send_data
+
+# Writes to a simulated keyboard that fails some of them or goes away, sent under different retry policies
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = settings.backend
+        self.pacing_min_gap = settings.pacing_min_gap
+        settings.backend = "fake"
+        settings.pacing_min_gap = 0.0
+        # A keyboard that went away is looked up again among the simulated ones
+        reset_fake_devices()
+        self.fake = get_fake_devices()[0]
+        self.session = gibkey.DeviceSession(self.fake, "fake").open()
+        self.session.pacing_gap = 0.0
+        self.packet = gibkey.encode_key_map_packets({"capslock": "lctrl"})[0]
+
+    def tearDown(self):
+        self.session.close()
+        reset_fake_devices()
+        settings.backend = self.backend
+        settings.pacing_min_gap = self.pacing_min_gap
+
+    def test_transient_errors_are_retried(self):
+        self.fake.errors = [errno.ETIMEDOUT, errno.ETIMEDOUT]
+        with self.assertLogs("gibkey", "WARNING"):
+            send_data(self.packet, gibkey.RetryPolicy(retries=3, base_delay=0.0), self.session)
+        self.assertEqual(len(self.fake.packets), 1)
+        self.assertIn(self.packet[0:3].hex(), self.session.failed_families)
+
+    def test_gives_up_after_retries(self):
+        self.fake.errors = [errno.ETIMEDOUT, errno.ETIMEDOUT]
+        with self.assertLogs("gibkey", "WARNING"):
+            with self.assertRaisesRegex(RuntimeError, "Max retries reached"):
+                send_data(self.packet, gibkey.RetryPolicy(retries=2, base_delay=0.0), self.session)
+        self.assertEqual(self.fake.packets, [])
+
+    def test_fatal_error_is_not_retried(self):
+        self.fake.errors = [errno.EPIPE, None]
+        with self.assertLogs("gibkey", "WARNING"):
+            with self.assertRaisesRegex(RuntimeError, "Failed to send chunk"):
+                send_data(self.packet, gibkey.RetryPolicy(retries=3, base_delay=0.0), self.session)
+        self.assertEqual(self.fake.errors, [None])
+        self.assertEqual(self.fake.packets, [])
+
+    def test_resumes_after_replug(self):
+        self.fake.present = False
+        replug = threading.Timer(0.2, setattr, (self.fake, "present", True))
+        replug.start()
+        try:
+            with self.assertLogs("gibkey", "WARNING"):
+                send_data(self.packet, gibkey.RetryPolicy(retries=2, base_delay=0.0, reconnect_timeout=5.0), self.session)
+        finally:
+            replug.cancel()
+        self.assertEqual(len(self.fake.packets), 1)
+        self.assertEqual(len(self.session.resumes), 1)
+        self.assertEqual(self.session.resumes[0][0:2], (gibkey.KEY_MAP_HEADER, 0))
+
+    def test_reconnect_on_last_attempt_still_writes(self):
+        self.fake.errors = [errno.ENODEV]
+        with self.assertLogs("gibkey", "WARNING"):
+            send_data(self.packet, gibkey.RetryPolicy(retries=1, base_delay=0.0), self.session)
+        self.assertEqual(len(self.fake.packets), 1)
+
+    def test_gives_up_when_keyboard_stays_away(self):
+        self.fake.present = False
+        with self.assertLogs("gibkey", "WARNING"):
+            with self.assertRaisesRegex(RuntimeError, "could not reconnect"):
+                send_data(self.packet, gibkey.RetryPolicy(retries=3, base_delay=0.0, reconnect_timeout=0.3), self.session)
+        self.assertEqual(self.fake.packets, [])
+
+    def test_no_reconnect_without_policy(self):
+        self.fake.errors = [errno.ENODEV]
+        with self.assertLogs("gibkey", "WARNING"):
+            with self.assertRaisesRegex(RuntimeError, "Failed to send chunk"):
+                send_data(self.packet, gibkey.RetryPolicy(retries=3, base_delay=0.0, reconnect=False), self.session)
+        self.assertEqual(self.session.resumes, [])
+
+if __name__ == "__main__":
+    unittest.main()
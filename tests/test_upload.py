@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+
+# Run from anywhere: the gibkey package is in the folder above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gibkey
+from gibkey import settings
+from gibkey.upload import count_packets_to_send
+
+KEY_COLOR = {"all": "000010", "a": "ff0000", "enter": "00ff00"}
+
+# Planned uploads through a DeviceSession, skipping what the simulated keyboard already has from the last one
+class UploadPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.pacing_min_gap = settings.pacing_min_gap
+        self.full_upload = settings.full_upload
+        settings.pacing_min_gap = 0.0
+        settings.full_upload = False
+        self.fake = gibkey.FakeDevice()
+        self.session = gibkey.DeviceSession(self.fake, "fake")
+        self.session.pacing_gap = 0.0
+
+    def tearDown(self):
+        self.session.close()
+        settings.pacing_min_gap = self.pacing_min_gap
+        settings.full_upload = self.full_upload
+
+    def get_groups(self, key_color, key_map = {}):
+        return gibkey.get_config_packet_groups("custom", 50, "default", 0, 3, key_map, key_color)
+
+    def test_first_upload_sends_everything(self):
+        groups = self.get_groups(KEY_COLOR, {"capslock": "lctrl"})
+        self.assertEqual(len(gibkey.plan_upload(groups, self.session.shadow_packets)), len(groups))
+        gibkey.run_plan(gibkey.plan_upload(groups, self.session.shadow_packets), session=self.session)
+        self.assertEqual(len(self.fake.packets), sum(len(packets) for packets, paced, pause in groups))
+        self.assertEqual(self.fake.get_key_colors()["a"], "ff0000")
+        self.assertEqual(self.fake.get_key_map()["capslock"], "lctrl")
+
+    def test_same_config_is_skipped(self):
+        gibkey.apply_config("custom", 50, "default", 0, 3, {}, KEY_COLOR, session=self.session)
+        sent = len(self.fake.packets)
+        self.assertEqual(gibkey.plan_upload(self.get_groups(KEY_COLOR), self.session.shadow_packets), [])
+        gibkey.apply_config("custom", 50, "default", 0, 3, {}, KEY_COLOR, session=self.session)
+        self.assertEqual(len(self.fake.packets), sent)
+
+    def test_only_changed_chunks_are_sent(self):
+        gibkey.apply_config("custom", 50, "default", 0, 3, {}, KEY_COLOR, session=self.session)
+        sent = len(self.fake.packets)
+        key_color = dict(KEY_COLOR, a="0000ff")
+        rgb_packets = gibkey.encode_key_rgb_packets(key_color)
+        self.assertEqual(count_packets_to_send(rgb_packets, self.session.shadow_packets), 1)
+
+        gibkey.apply_config("custom", 50, "default", 0, 3, {}, key_color, session=self.session)
+        self.assertEqual(len(self.fake.packets), sent + 1)
+        self.assertEqual(bytes(self.fake.packets[-1][0:3]), gibkey.KEY_RGB_HEADER)
+        self.assertEqual(self.fake.get_key_colors()["a"], "0000ff")
+        self.assertEqual(self.fake.get_key_colors()["enter"], "00ff00")
+
+    def test_full_upload_keeps_every_group(self):
+        gibkey.apply_config("custom", 50, "default", 0, 3, {}, KEY_COLOR, session=self.session)
+        settings.full_upload = True
+        groups = self.get_groups(KEY_COLOR)
+        self.assertEqual(len(gibkey.plan_upload(groups, self.session.shadow_packets)), len(groups))
+        sent = len(self.fake.packets)
+        gibkey.apply_config("custom", 50, "default", 0, 3, {}, KEY_COLOR, session=self.session)
+        self.assertEqual(len(self.fake.packets), sent * 2)
+
+    def test_pause_is_dropped_with_first_group(self):
+        groups = self.get_groups(KEY_COLOR, {"capslock": "lctrl"})
+        gibkey.apply_config("custom", 50, "default", 0, 3, {"capslock": "lctrl"}, {}, session=self.session)
+        plan = gibkey.plan_upload(groups, self.session.shadow_packets)
+        self.assertEqual(len(plan), len(groups) - 1)
+        self.assertFalse(plan[0][2])
+
+if __name__ == "__main__":
+    unittest.main()